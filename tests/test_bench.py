@@ -0,0 +1,17 @@
+import vimlm
+
+def test_no_regression_within_tolerance():
+    base = dict(a=dict(mean_ms=100.0, tok_per_s=50.0), speedup=2.0)
+    assert vimlm.compare_bench(dict(a=dict(mean_ms=110.0, tok_per_s=45.0), speedup=1.9), base) == []
+
+def test_reports_slower_and_lower_throughput():
+    base = dict(a=dict(mean_ms=100.0, tok_per_s=50.0), total_s=1.0, completed=10)
+    result = dict(a=dict(mean_ms=200.0, tok_per_s=20.0), total_s=2.0, completed=5)
+    assert sorted(vimlm.compare_bench(result, base)) == ['a.mean_ms: 100.0 -> 200.0', 'a.tok_per_s: 50.0 -> 20.0', 'completed: 10 -> 5', 'total_s: 1.0 -> 2.0']
+
+def test_ignores_tiny_ms_changes_and_unknown_keys():
+    assert vimlm.compare_bench(dict(p50_ms=0.9, files=1), dict(p50_ms=0.3, files=100)) == []
+
+def test_missing_baseline_keys():
+    assert vimlm.compare_bench(dict(new=dict(mean_ms=5.0)), {}) == []
+    assert vimlm.compare_bench(dict(mean_ms=5.0, flag=True), dict(mean_ms=0, flag=False)) == []
@@ -0,0 +1,32 @@
+import vimlm
+
+def block(text='', lang='', file=None, heading=''):
+    return dict(text=text, lang=lang, file=file, heading=heading)
+
+def test_header_wins():
+    assert vimlm.infer_filename(block('x = 1', 'python', file='`app.py`')) == ('app.py', 'header')
+    assert vimlm.infer_filename(block('x = 1', 'python', heading='Save this as src/util.py:')) == ('util.py', 'header')
+
+def test_fence_and_comment():
+    assert vimlm.infer_filename(block('fn main() {}', 'rust title="lib.rs"')) == ('lib.rs', 'fence')
+    assert vimlm.infer_filename(block('# app/models.py\nx = 1', 'python')) == ('models.py', 'comment')
+    assert vimlm.infer_filename(block('// file: index.ts\nexport {}', 'ts')) == ('index.ts', 'comment')
+
+def test_language_and_code():
+    assert vimlm.infer_filename(block('FROM python:3.12', 'dockerfile')) == ('Dockerfile', 'lang')
+    assert vimlm.infer_filename(block('class HttpClient:\n    pass', 'python')) == ('http_client.py', 'code')
+    assert vimlm.infer_filename(block('public class HttpClient {}', 'java')) == ('HttpClient.java', 'code')
+    assert vimlm.infer_filename(block('package main\n\nfunc main() {}', 'go')) == ('main.go', 'code')
+
+def test_unknown():
+    assert vimlm.infer_filename(block('x = 1', 'python')) == (None, None)
+    assert vimlm.infer_filename(block('whatever', 'text')) == (None, None)
+
+def test_deploy_renames_name_clashes(tmp_path, monkeypatch):
+    monkeypatch.setattr(vimlm, 'toout', lambda *args, **kwargs: None)
+    src = tmp_path / 'response.md'
+    src.write_text('**app.py**\n```python\nx = 1\n```\n\n**app.py**\n```python\nx = 2\n```\n\n**app.py**\n```python\nx = 1\n```\n')
+    written = vimlm.deploy(str(tmp_path / 'out'), src=str(src), reformat=False)
+    assert sorted(vimlm.os.path.basename(p) for p in written) == ['app.py', 'app_2.py']
+    assert (tmp_path / 'out' / 'app.py').read_text() == 'x = 1\n'
+    assert (tmp_path / 'out' / 'app_2.py').read_text() == 'x = 2\n'
@@ -0,0 +1,45 @@
+import vimlm
+
+def line_diff(old, new):
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    keep = 0
+    while keep < min(len(old), len(new)) - start and old[len(old) - 1 - keep] == new[len(new) - 1 - keep]:
+        keep += 1
+    return start, len(old) - keep, new[start:len(new) - keep]
+
+def send(key, base, rev, old, new, line=1, col=1):
+    start, end, changed = line_diff(old, new) if base >= 0 else (0, 0, new)
+    diff = dict(key=key, base=base, rev=rev, start=start, end=end, n=len(changed), line=line, col=col)
+    return vimlm.receive_fim(dict(fim=True, context='\n'.join(changed), yank='', user='', tree='a.py'), diff)
+
+def test_full_then_incremental():
+    v1 = ['def f(x):', '    return x', '', 'print(f(1))']
+    v2 = ['def f(x):', '    y = x + 1', '    return y', '', 'print(f(1))']
+    v3 = ['def f(x):', '    y = x + 1', '    return y', '']
+    assert send('full', -1, 1, [], v1)['fim_lines'] == v1
+    data = send('full', 1, 2, v1, v2, line=2, col=9)
+    assert data['fim_lines'] == v2
+    assert data['cursor'] == (2, 9)
+    assert send('full', 2, 3, v2, v3)['fim_lines'] == v3
+
+def test_deleted_and_blank_lines():
+    v1 = ['a', '', 'b', '']
+    send('blank', -1, 1, [], v1)
+    assert send('blank', 1, 2, v1, ['a', 'b'])['fim_lines'] == ['a', 'b']
+    assert send('blank', 2, 3, ['a', 'b'], ['a', '', '', 'b'])['fim_lines'] == ['a', '', '', 'b']
+
+def test_unknown_base_is_stale():
+    data = send('stale', 7, 8, ['x'], ['y'])
+    assert data['status'] == 'stale'
+    assert 'fim_lines' not in data
+
+def test_old_revisions_are_evicted():
+    lines = ['0']
+    send('evict', -1, 1, [], lines)
+    for rev in range(2, vimlm.FIM_REVS + 3):
+        new = lines + [str(rev)]
+        send('evict', rev - 1, rev, lines, new)
+        lines = new
+    assert send('evict', 1, 100, ['0'], ['0', 'x']).get('status') == 'stale'
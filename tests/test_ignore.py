@@ -0,0 +1,66 @@
+import os
+import vimlm
+
+def rules(*lines, base='/repo'):
+    return vimlm.IgnoreRules([(base, line) for line in lines])
+
+def test_basename_patterns():
+    r = rules('*.pyc', '__pycache__/')
+    assert r.ignored('/repo/pkg/mod.pyc')
+    assert not r.ignored('/repo/pkg/mod.py')
+    assert r.ignored('/repo/pkg/__pycache__', is_dir=True)
+    assert not r.ignored('/repo/pkg/__pycache__')
+
+def test_negation_and_order():
+    r = rules('*.log', '!keep.log')
+    assert r.ignored('/repo/a.log')
+    assert not r.ignored('/repo/sub/keep.log')
+
+def test_anchored_patterns_are_relative_to_their_gitignore():
+    r = rules('/build', 'docs/*.html')
+    assert r.ignored('/repo/build', is_dir=True)
+    assert not r.ignored('/repo/src/build', is_dir=True)
+    assert r.ignored('/repo/docs/index.html')
+    assert not r.ignored('/repo/src/docs/index.html')
+
+def test_double_star_matches_any_depth():
+    r = rules('**/gen', 'docs/**/*.md', 'logs/**')
+    assert r.ignored('/repo/gen', is_dir=True)
+    assert r.ignored('/repo/a/b/gen', is_dir=True)
+    assert r.ignored('/repo/docs/x.md')
+    assert r.ignored('/repo/docs/a/b/x.md')
+    assert not r.ignored('/repo/src/docs/x.md')
+    assert r.ignored('/repo/logs/a/b.txt')
+    assert not r.ignored('/repo/logs', is_dir=True)
+
+def test_star_does_not_cross_slash():
+    r = rules('src/*.py', 'a?c', 'file[0-9].txt', 'x[!a].txt')
+    assert r.ignored('/repo/src/a.py')
+    assert not r.ignored('/repo/src/pkg/a.py')
+    assert r.ignored('/repo/abc') and not r.ignored('/repo/a/c')
+    assert r.ignored('/repo/file3.txt') and not r.ignored('/repo/filex.txt')
+    assert r.ignored('/repo/xb.txt') and not r.ignored('/repo/xa.txt')
+
+def test_anchored_pattern_ignores_children():
+    r = rules('build/', '/out')
+    assert r.ignored('/repo/out/x.js')
+    assert not r.ignored('/repo/build')
+    assert r.ignored('/repo/build', is_dir=True)
+
+def test_load_inherits_parent(tmp_path):
+    (tmp_path / '.gitignore').write_text('*.tmp\n# comment\n\n')
+    sub = tmp_path / 'sub'
+    sub.mkdir()
+    (sub / '.gitignore').write_text('data/\n')
+    r = vimlm.IgnoreRules.load(str(sub), vimlm.IgnoreRules.load(str(tmp_path)))
+    assert r.ignored(str(sub / 'x.tmp'))
+    assert r.ignored(str(sub / 'data'), is_dir=True)
+    assert vimlm.IgnoreRules.load(str(sub / 'missing'), r) is r
+
+def test_scan_dir_skips_ignored(tmp_path):
+    (tmp_path / '.gitignore').write_text('out/\n')
+    for name in ('a.py', 'out/b.py', 'src/c.py'):
+        os.makedirs(tmp_path / os.path.dirname(name), exist_ok=True)
+        (tmp_path / name).write_text('x = 1\n')
+    found = {os.path.relpath(p, tmp_path) for p, _ in vimlm.scan_dir(str(tmp_path), depth=2)}
+    assert found == {'a.py', os.path.join('src', 'c.py')}
@@ -0,0 +1,39 @@
+import vimlm
+
+def test_budget_buckets():
+    assert [vimlm.summary_budget(2000, n) for n in (0, 1, 2, 3, 4, 5, 8, 9)] == [2000, 2000, 1000, 500, 500, 250, 250, 125]
+    assert all(n * vimlm.summary_budget(2000, n) <= 2000 for n in range(1, 100))
+
+def test_adding_a_file_keeps_summaries(tmp_path):
+    src = tmp_path / 'project'
+    src.mkdir()
+    def add(i):
+        (src / f'module_{i}.py').write_text(''.join(f'def op_{i}_{j}(value):\n    return value * {j}\n\n' for j in range(80)))
+    for i in range(5):
+        add(i)
+    with vimlm.sandbox(vimlm.StubChat(reply='summary ' * 40)):
+        vimlm.ingest(str(src), max_len=400)
+        first = vimlm.ENGINE.sequences
+        add(5)
+        vimlm.ingest(str(src), max_len=400)
+        added = vimlm.ENGINE.sequences - first
+        vimlm.ingest(str(src), max_len=400)
+        assert vimlm.ENGINE.sequences == first + added
+    assert added == first // 5
+
+def test_legacy_cache_is_imported_once(tmp_path):
+    src = tmp_path / 'project'
+    src.mkdir()
+    path, stale = src / 'module.py', src / 'stale.py'
+    path.write_text(''.join(f'def op_{j}(value):\n    return value * {j}\n\n' for j in range(80)))
+    stale.write_text('x = 1\n')
+    legacy = tmp_path / 'cache.json'
+    legacy.write_text(vimlm.json.dumps({str(path): dict(timestamp=path.stat().st_mtime, summary='Old summary', ntok=3),
+                                        str(stale): dict(timestamp=0, summary='Outdated', ntok=1)}))
+    with vimlm.sandbox(vimlm.StubChat(reply='summary ' * 40)):
+        vimlm.LTM_STORE.migrate(str(legacy), max_len=400)
+        assert not legacy.exists()
+        result = vimlm.ingest(str(path), max_len=400)
+        assert vimlm.ENGINE.sequences == 0
+        assert 'Old summary' in result
+        assert vimlm.LTM_STORE.connect().execute('SELECT COUNT(*) FROM summaries WHERE summary = ?', ('Outdated',)).fetchone()[0] == 0
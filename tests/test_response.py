@@ -0,0 +1,32 @@
+import vimlm
+
+TEXT = 'Intro\n\n**app.py**\n```python\ndef main():\n    return 0\n```\n\nThen:\n```sh\nrun it\n```\n'
+
+def parse(*parts):
+    parser = vimlm.ResponseParser()
+    for part in parts:
+        parser.feed(part)
+    return parser
+
+def test_blocks_and_spans():
+    model = parse(TEXT).model()
+    assert [(b['file'], b['lang'], b['text']) for b in model['blocks']] == [('app.py', 'python', 'def main():\n    return 0'), (None, 'sh', 'run it')]
+    assert model['blocks'][1]['heading'] == 'Then:'
+    assert model['spans'] == [('text', 1, 3), ('code', 4, 7), ('text', 8, 9), ('code', 10, 12)]
+
+def test_streamed_feed_matches_whole():
+    whole = parse(TEXT).model()
+    streamed = parse(*[TEXT[i:i + 3] for i in range(0, len(TEXT), 3)]).model()
+    assert streamed == whole
+
+def test_unclosed_block_only_when_final():
+    parser = parse('```python\nx = 1\ny = 2')
+    assert parser.model()['blocks'] == []
+    assert parser.model(final=True)['blocks'][0]['text'] == 'x = 1\ny = 2'
+
+def test_reset_bumps_version():
+    parser = parse(TEXT)
+    version = parser.version
+    parser.reset()
+    assert parser.version == version + 1
+    assert parser.model()['blocks'] == []
@@ -0,0 +1,19 @@
+import vimlm
+
+def test_single_file_is_read(tmp_path):
+    path = tmp_path / 'a.py'
+    path.write_text('x = 1\n')
+    result = vimlm.retrieve(str(path), lazy=True)
+    assert result[str(path)]['content'] == 'x = 1\n'
+
+def test_single_file_skips_large_and_binary(tmp_path):
+    big, blob = tmp_path / 'big.py', tmp_path / 'blob.bin'
+    big.write_text('x = 1\n' * 100)
+    blob.write_bytes(b'\x00\x01\x02' * 10)
+    assert vimlm.retrieve(str(big), max_bytes=100) == {}
+    assert vimlm.retrieve(str(blob)) == {}
+
+def test_directory_and_file_agree(tmp_path):
+    (tmp_path / 'a.py').write_text('x = 1\n')
+    (tmp_path / 'big.py').write_text('y = 2\n' * 100)
+    assert set(vimlm.retrieve(str(tmp_path), max_bytes=100)) == {str(tmp_path / 'a.py')}
@@ -0,0 +1,44 @@
+import vimlm
+
+DOC = ''.join(f'def op_{i}(value):\n    return value * {i}\n\n' for i in range(40)) + 'tail = 1\n\n\n'
+
+class Tokenizer:
+    def __call__(self, doc, add_special_tokens=False, return_offsets_mapping=False):
+        spans = [m.span() for m in vimlm.re.finditer(r'\s*\S+|\s+', doc)]
+        return dict(input_ids=list(range(len(spans))), offset_mapping=spans)
+
+def test_matches_split_str_boundaries():
+    for max_len in (10, 50, 200, 5000):
+        assert [c for c, _ in vimlm.split_tokens(DOC, max_len)] == vimlm.split_str(DOC, max_len)
+
+def test_chunks_cover_document():
+    chunks = vimlm.split_tokens(DOC, 60)
+    assert ''.join(c for c, _ in chunks) == DOC
+    assert all(n == len(c) for c, n in chunks)
+
+def test_offsets_count_tokens_once():
+    get_ntok = lambda s: len(Tokenizer()(s)['input_ids'])
+    counter = vimlm.TokenCounter(get_ntok, Tokenizer())
+    chunks = vimlm.split_tokens(DOC, 40, counter)
+    assert ''.join(c for c, _ in chunks) == DOC
+    assert sum(n for _, n in chunks) == get_ntok(DOC)
+    assert counter.calls == 1
+
+def test_unwraps_tokenizer_wrapper():
+    wrapper = type('TokenizerWrapper', (), dict(_tokenizer=Tokenizer()))()
+    counter = vimlm.TokenCounter(lambda s: len(Tokenizer()(s)['input_ids']), wrapper)
+    vimlm.split_tokens(DOC, 40, counter)
+    assert counter.calls == 1
+
+def test_fallback_is_logged_once(monkeypatch):
+    logs = []
+    monkeypatch.setattr(vimlm, 'tolog', lambda log, key='debug': logs.append(key))
+    def slow(doc, **kwargs):
+        raise NotImplementedError('return_offsets_mapping is only available for fast tokenizers')
+    counter = vimlm.TokenCounter(len, slow)
+    for max_len in (40, 80):
+        assert [c for c, _ in vimlm.split_tokens(DOC, max_len, counter)] == vimlm.split_str(DOC, max_len)
+    assert logs == ['tokenizer']
+
+def test_empty_document():
+    assert vimlm.split_tokens('') == []
@@ -12,8 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import nanollama
-import mlx_lm_utils
 import asyncio
 import subprocess
 import json
@@ -31,11 +29,37 @@ import re
 import sys
 import tty
 import termios
+import threading
+import queue
+import atexit
+import time
+import codecs
+import hashlib
+import sqlite3
+import statistics
+import ast
+import heapq
+import math
+import pickle
+import mmap
+import copy
+import fcntl
+import signal
+import tracemalloc
+from collections import deque, OrderedDict, Counter
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
+import urllib.request
 
 DEFAULTS = dict(
     LLM_MODEL = "mlx-community/Qwen2.5-Coder-3B-Instruct-4bit", # None | "mlx-community/DeepSeek-R1-Distill-Qwen-7B-4bit" | "mlx-community/deepseek-r1-distill-qwen-1.5b" |  "mlx-community/phi-4-4bit" (8.25gb) |  "mlx-community/Qwen2.5-Coder-14B-Instruct-4bit" (8.31gb) |  "mlx-community/Qwen2.5-Coder-3B-Instruct-4bit" (1.74gb) | "mlx-community/phi-4-4bit" (8.25gb)
     FIM_MODEL = "mlx-community/Qwen2.5-Coder-0.5B-4bit", # None | "mlx-community/Qwen2.5-Coder-32B-4bit" |  "mlx-community/Qwen2.5-Coder-0.5B-4bit" (278mb)
+    MODEL_BACKEND = 'mlx', # 'mlx' | 'stub' | 'package.module:factory'
+    STUB_MODEL = dict(prefill_rate=4000, decode_rate=60),
     NUM_TOKEN = 2000,
+    HISTORY_TOKENS = 8192,
+    HISTORY_COMPACT = 'summary', # 'summary' | 'drop'
     USE_LEADER = False,
     KEY_MAP = {},
     DO_RESET = True,
@@ -44,20 +68,67 @@ DEFAULTS = dict(
     THINK = ('<think>', '</think>'),
     VERSION = '0.1.2',
     DEBUG = False,
+    TRACE = False,
+    TRANSPORT = 'file', # 'file' | 'socket'
+    DAEMON = True,
+    DAEMON_IDLE = 600,
+    TIMEOUT = 300,
+    FIM_TIMEOUT = 10,
+    FIM_TOKENS = 2048,
+    CONTEXT_TOKENS = 8192,
+    REPO_TOKENS = 4096,
+    SEARCH_TOP_K = 8,
+    BATCH_SIZE = 8,
+    SPECULATIVE = False,
+    DRAFT_TOKENS = 4,
+    ENGINE_BACKEND = 'mlx', # 'mlx' | 'openai'
+    OPENAI_BASE_URL = 'http://localhost:8080/v1',
+    SCAN_DEPTH = 0,
+    SCAN_MAX_BYTES = 2**20,
+    KV_CACHE_MB = 512,
+    KV_SPILL = False,
 )
 
 DATE_FORM = "%Y_%m_%d_%H_%M_%S"
 VIMLM_DIR = os.path.expanduser("~/.vimlm")
 WATCH_DIR = os.path.expanduser("~/.vimlm/watch_dir")
 CFG_FILE = 'cfg.json'
-LOG_FILE = "log.json"
-LTM_FILE = "cache.json"
+LOG_FILE = "log.jsonl"
+LEGACY_LOG_FILE = "log.json"
+LEGACY_LTM_FILE = "cache.json"
+METRICS_FILE = "metrics.jsonl"
+LTM_FILE = "cache.sqlite"
+INDEX_FILE = "index.sqlite"
+BENCH_FILE = "bench.json"
 OUT_FILE = "response.md"
+MODEL_FILE = "response.json"
+SOCK_FILE = "vimlm.sock"
+SESSION_FILE = "session.json"
+DAEMON_FILE = "daemon.pid"
+KV_DIR = "kv"
 IN_FILES = ["context", "yank", "user", "tree"]
 CFG_PATH = os.path.join(VIMLM_DIR, CFG_FILE)
 LOG_PATH = os.path.join(VIMLM_DIR, LOG_FILE)
+METRICS_PATH = os.path.join(VIMLM_DIR, METRICS_FILE)
 LTM_PATH = os.path.join(VIMLM_DIR, LTM_FILE)
+INDEX_PATH = os.path.join(VIMLM_DIR, INDEX_FILE)
+BENCH_PATH = os.path.join(VIMLM_DIR, BENCH_FILE)
+BENCH_TOLERANCE = 0.25
 OUT_PATH = os.path.join(WATCH_DIR, OUT_FILE) 
+SOCK_PATH = os.path.join(VIMLM_DIR, SOCK_FILE)
+SESSIONS_DIR = os.path.join(VIMLM_DIR, "sessions")
+DAEMON_PATH = os.path.join(VIMLM_DIR, DAEMON_FILE)
+LOG_MAX_BYTES = 8 * 2**20
+LOG_MAX_SEGMENTS = 4
+LTM_MAX_BYTES = 64 * 2**20
+SEARCH_DEPTH = 8
+SEARCH_MAX_FILES = 20000
+INDEX_VERSION = 1
+CHUNK_LINES = 40
+SCAN_WORKERS = min(8, os.cpu_count() or 1)
+SCAN_IGNORE = ['.*', '__pycache__/', 'node_modules/', '*.log']
+OUT_FLUSH_BYTES = 4096
+CONTEXT_BYTES_PER_TOKEN = 8
 
 def reset_dir(dir_path):
     if os.path.exists(dir_path):
@@ -89,29 +160,203 @@ def initialize():
 
 initialize()
 
-def toout(s, key=None, mode=None):
+def toout(s, key=None, mode=None, tail=None):
+    if is_cancelled():
+        return
     key = '' if key is None else ':'+key
     mode = 'w' if mode is None else mode
-    with open(OUT_PATH, mode, encoding='utf-8') as f:
-        f.write(s)
+    with span('toout'):
+        (TAIL if tail is None else tail).write(s, mode)
     tolog(s, key='tovim'+key+':'+mode)
 
+class LogStore:
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, max_segments=LOG_MAX_SEGMENTS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.failed = False
+
+    def append(self, entry):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+        self.queue.put(entry)
+
+    def flush(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                if not self.failed:
+                    self.failed = True
+                    print(f'VimLM: failed to write {self.path} ({e!r}); further failures are not reported', file=sys.stderr, flush=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in batch:
+                f.write(json.dumps(entry, default=str) + '\n')
+            size = f.tell()
+        if size > self.max_bytes:
+            self.rotate()
+
+    def segments(self):
+        return [f'{self.path}.{i}' for i in range(self.max_segments, 0, -1)] + [self.path]
+
+    def migrate(self, legacy_path):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                logs = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f'VimLM: could not read {legacy_path} ({e!r}); leaving it in place', file=sys.stderr, flush=True)
+            return
+        self.flush()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as dst:
+            for log in logs if isinstance(logs, list) else []:
+                dst.write(json.dumps(log, default=str) + '\n')
+            try:
+                with open(self.path, 'r', encoding='utf-8') as src:
+                    shutil.copyfileobj(src, dst)
+            except FileNotFoundError:
+                pass
+        os.replace(tmp_path, self.path)
+        os.remove(legacy_path)
+
+    def rotate(self):
+        oldest = f'{self.path}.{self.max_segments}'
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.max_segments - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i+1}')
+        os.replace(self.path, f'{self.path}.1')
+        self.compact(f'{self.path}.1')
+
+    def compact(self, path):
+        tmp_path = path + '.tmp'
+        with open(path, 'r', encoding='utf-8') as src, open(tmp_path, 'w', encoding='utf-8') as dst:
+            for line in src:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'debug' not in entry.get('key', ''):
+                    dst.write(line)
+        os.replace(tmp_path, path)
+
+    def iter(self, key=None, since=None, until=None):
+        self.flush()
+        for path in self.segments():
+            try:
+                f = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        log = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if key is not None and not any(k in log['key'] for k in key):
+                        continue
+                    if since and log['timestamp'] < since:
+                        continue
+                    if until and log['timestamp'][:len(until)] > until:
+                        continue
+                    yield log
+
+LOG_STORE = LogStore(LOG_PATH)
+atexit.register(LOG_STORE.flush)
+
 def tolog(log, key='debug'):
     if not DEBUG and 'debug' in key:
         return
+    with span('tolog'):
+        LOG_STORE.append(dict(key=key, log=log, timestamp=datetime.now().strftime(DATE_FORM)))
+
+METRICS_STORE = LogStore(METRICS_PATH)
+atexit.register(METRICS_STORE.flush)
+TRACE_LOCAL = threading.local()
+NO_SPAN = nullcontext()
+
+@contextmanager
+def timed_span(name):
+    t0 = time.perf_counter()
     try:
-        with open(LOG_PATH, "r", encoding="utf-8") as log_f:
-            logs = json.load(log_f)
-    except:
-        logs = []
-    logs.append(dict(key=key, log=log, timestamp=datetime.now().strftime(DATE_FORM)))
-    with open(LOG_PATH, "w", encoding="utf-8") as log_f:
-        json.dump(logs, log_f, indent=2)
-
-def print_log():
-    with open(LOG_PATH, 'r') as f:
-        logs = json.load(f)
-    for log in logs:
+        yield
+    finally:
+        spans = getattr(TRACE_LOCAL, 'spans', None)
+        if spans is not None:
+            spans[name] = spans.get(name, 0.0) + time.perf_counter() - t0
+
+def span(name):
+    return timed_span(name) if TRACE else NO_SPAN
+
+def trace_count(**counts):
+    if TRACE and getattr(TRACE_LOCAL, 'counts', None) is not None:
+        for k, v in counts.items():
+            TRACE_LOCAL.counts[k] = TRACE_LOCAL.counts.get(k, 0) + v
+
+def trace_begin(req):
+    TRACE_LOCAL.spans = dict(req.data.pop('trace', {}), queue=req.started - req.submitted)
+    TRACE_LOCAL.counts = {}
+
+def trace_end(req, status):
+    spans, counts = getattr(TRACE_LOCAL, 'spans', None), getattr(TRACE_LOCAL, 'counts', None)
+    if spans is None:
+        return
+    TRACE_LOCAL.spans = TRACE_LOCAL.counts = None
+    spans['total'] = time.monotonic() - req.submitted
+    for stage in ('prefill', 'decode'):
+        if counts.get(f'{stage}_tokens') and spans.get(stage):
+            counts[f'{stage}_tps'] = round(counts[f'{stage}_tokens'] / spans[stage], 1)
+    METRICS_STORE.append(dict(key=f'metrics:{req.kind}', timestamp=datetime.now().strftime(DATE_FORM), status=status,
+                              ms={k: round(1000 * v, 2) for k, v in spans.items()}, **counts))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def print_stats(kinds=None, since=None, until=None):
+    table = {}
+    for entry in METRICS_STORE.iter(key=[f'metrics:{k}' for k in kinds] if kinds else ['metrics:'], since=since, until=until):
+        kind = entry['key'].split(':', 1)[1]
+        for stage, ms in entry.get('ms', {}).items():
+            table.setdefault(kind, {}).setdefault(stage, []).append(ms)
+        for name in ('prefill_tps', 'decode_tps'):
+            if name in entry:
+                table.setdefault(kind, {}).setdefault(name, []).append(entry[name])
+    if not table:
+        print(f'No metrics in {METRICS_PATH}; set "TRACE": true in {CFG_PATH} to record them')
+        return
+    for kind, stages in table.items():
+        print(f'\033[37m{kind} ({len(stages["total"]) if "total" in stages else 0} requests)\033[0m')
+        print(f'  {"stage":<12}{"n":>6}{"p50":>10}{"p95":>10}{"p99":>10}')
+        for stage, values in sorted(stages.items(), key=lambda kv: (kv[0].endswith('_tps'), -percentile(kv[1], .5))):
+            unit = ' tok/s' if stage.endswith('_tps') else ' ms'
+            print(f'  {stage:<12}{len(values):>6}' + ''.join(f'{percentile(values, q):>10.1f}' for q in (.5, .95, .99)) + unit)
+
+def print_log(key=None, since=None, until=None):
+    for log in LOG_STORE.iter(key=key, since=since, until=until):
         print(f'\033[37m{log["key"]} {log["timestamp"]}\033[0m')
         if 'tovim' in log["key"]:
             print('\033[33m')
@@ -120,52 +365,308 @@ def print_log():
         print(log["log"])
         print('\033[0m')
 
+FILENAME_PATTERN = re.compile(r"^\*\*(.+?)\*\*$")
+
+class ResponseParser:
+    def __init__(self):
+        self.version = 0
+        self.reset()
+
+    def reset(self):
+        self.version += 1
+        self.partial = ''
+        self.nlines = 0
+        self.blocks = []
+        self.block = None
+        self.filename = None
+        self.heading = ''
+
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line.rstrip('\r'))
+
+    def line(self, line):
+        self.nlines += 1
+        if line.startswith('```'):
+            if self.block is None:
+                self.block = dict(lang=line[3:].strip(), file=self.filename, heading=self.heading, start=self.nlines, lines=[])
+                self.filename, self.heading = None, ''
+            else:
+                self.blocks.append(self.close(self.block, self.nlines))
+                self.block = None
+        elif self.block is not None:
+            self.block['lines'].append(line)
+        elif match := FILENAME_PATTERN.match(line.rstrip()):
+            self.filename = match.group(1)
+        elif line.strip():
+            self.heading = line.strip()
+
+    def close(self, block, end, tail=()):
+        return dict(lang=block['lang'], file=block['file'], heading=block['heading'], start=block['start'], end=end, text='\n'.join([*block['lines'], *tail]))
+
+    def model(self, final=False):
+        blocks = list(self.blocks)
+        nlines = self.nlines + bool(self.partial)
+        if final and self.block is not None:
+            tail = [self.partial.rstrip('\r')] if self.partial and not self.partial.startswith('```') else []
+            blocks.append(self.close(self.block, nlines, tail))
+        spans, line = [], 1
+        for block in blocks:
+            if block['start'] > line:
+                spans.append(('text', line, block['start'] - 1))
+            spans.append(('code', block['start'], block['end']))
+            line = block['end'] + 1
+        if line <= nlines:
+            spans.append(('text', line, nlines))
+        return dict(version=self.version, lines=nlines, spans=spans, blocks=blocks)
+
+def write_atomic(path, text):
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+LANG_EXT = dict(python='py', py='py', javascript='js', js='js', jsx='jsx', typescript='ts', ts='ts', tsx='tsx', java='java', kotlin='kt', scala='scala', swift='swift', csharp='cs', cs='cs', c='c', cpp='cpp', go='go', rust='rs', rs='rs', ruby='rb', rb='rb', php='php', lua='lua', r='r', bash='sh', sh='sh', shell='sh', zsh='sh', html='html', css='css', scss='scss', json='json', yaml='yaml', yml='yaml', toml='toml', sql='sql', markdown='md', md='md', vim='vim', xml='xml')
+LANG_FILE = dict(dockerfile='Dockerfile', makefile='Makefile', make='Makefile')
+KNOWN_EXTS = set(LANG_EXT.values()) | {'h', 'hpp', 'txt', 'cfg', 'ini', 'env', 'lock', 'svg', 'mjs', 'cjs', 'vue', 'ex', 'exs'}
+CAMEL_EXTS = {'java', 'kt', 'scala', 'swift', 'cs', 'js', 'jsx', 'ts', 'tsx', 'php', 'vue'}
+PATH_PATTERN = re.compile(r'(?<![\w/.-])((?:[\w.-]+/)*[\w-][\w.-]*\.([A-Za-z0-9]{1,6}))(?![\w/-])')
+PATH_COMMENT = re.compile(r'^\s*(?:#|//|--|;|/\*|<!--)\s*(?:(?:file(?:name)?|path)\s*:\s*)?(\S+)\s*(?:\*/|-->)?\s*$', re.I)
+CLASS_PATTERN = re.compile(r'^[ \t]*(?:(?:export|default|public|private|protected|internal|abstract|final|sealed|data|pub)\s+)*(?:class|struct|interface|trait|enum|object)\s+([A-Za-z_]\w*)', re.M)
+MODULE_PATTERN = re.compile(r'^\s*(?:package|module|defmodule)\s+([A-Za-z_][\w.]*)', re.M)
+FORMAT_FILENAME = 'Suggest a filename for the code block below. Reply with the filename only, in **filename.ext** format.\n\n{heading}\n```{lang}\n{head}\n```'
+FORMAT_DEPLOY = 'Reformat the response to ensure each code block is preceded by a filename in **filename.ext** format, with only alphanumeric characters, dots, underscores, or hyphens in the filename. Remove any extraneous characters from filenames.'
+
+def clean_filename(name):
+    return re.sub(r"[^a-zA-Z0-9_.-]", "", os.path.basename(name.strip().strip('`*"\'')))
+
+def find_path(text):
+    for match in PATH_PATTERN.finditer(text):
+        if match.group(2).lower() in KNOWN_EXTS:
+            return clean_filename(match.group(1))
+
+def infer_filename(block):
+    if block['file'] and (name := clean_filename(block['file'])):
+        return name, 'header'
+    if name := find_path(block['heading']):
+        return name, 'header'
+    if name := find_path(block['lang'].replace(':', ' ').replace('=', ' ')):
+        return name, 'fence'
+    lang = re.split(r'[\s:{]', block['lang'], 1)[0].lower()
+    for line in block['text'].splitlines()[:3]:
+        if (match := PATH_COMMENT.match(line)) and (name := find_path(match.group(1))):
+            return name, 'comment'
+    if lang in LANG_FILE:
+        return LANG_FILE[lang], 'lang'
+    ext = LANG_EXT.get(lang)
+    if ext is None:
+        return None, None
+    names = CLASS_PATTERN.findall(block['text']) or [m.split('.')[-1] for m in MODULE_PATTERN.findall(block['text'])]
+    if not names:
+        return None, None
+    name = names[0] if ext in CAMEL_EXTS else re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', names[0]).lower()
+    return f'{name}.{ext}', 'code'
+
 def deploy(dest=None, src=None, reformat=True):
-    prompt_deploy = 'Reformat the response to ensure each code block is preceded by a filename in **filename.ext** format, with only alphanumeric characters, dots, underscores, or hyphens in the filename. Remove any extraneous characters from filenames.'
     tolog(f'deploy {dest=} {src=} {reformat=}')
     if src:
-        chat.reset()
-        with open(src, 'r') as f:
-            prompt_deploy = f.read().strip() + '\n\n---\n\n' + prompt_deploy
-    if reformat:
-        toout('Deploying...')
-        response = chat(prompt_deploy, max_new=NUM_TOKEN, verbose=False, stream=False)['text']
-        toout(response, 'deploy')
-        lines = response.splitlines()
+        with open(src, 'r', encoding='utf-8') as f:
+            text = f.read()
+        parser = ResponseParser()
+        parser.feed(text)
+        blocks = parser.model(final=True)['blocks']
     else:
-        with open(OUT_PATH, 'r') as f:
-            lines = f.readlines()
+        blocks = TAIL.model(final=True)['blocks']
+    inferred = [infer_filename(block) for block in blocks]
+    tolog(dict(Counter(how for _, how in inferred)), 'deploy')
+    ambiguous = [i for i, (name, _) in enumerate(inferred) if name is None]
+    used = saved = 0
+    if reformat and ambiguous:
+        counter = get_counter(chat)
+        prompts = {i: FORMAT_FILENAME.format(heading=blocks[i]['heading'], lang=blocks[i]['lang'], head='\n'.join(blocks[i]['text'].splitlines()[:20])) for i in ambiguous}
+        futures = {i: ENGINE.submit(prompt, 16) for i, prompt in prompts.items()}
+        for i, future in futures.items():
+            if is_cancelled():
+                future.cancel()
+                continue
+            reply = future.result()
+            used += counter(prompts[i]) + counter(reply)
+            match = FILENAME_PATTERN.search(reply.strip()) or re.search(r"\*\*(.+?)\*\*", reply)
+            inferred[i] = (clean_filename(match.group(1)) if match else find_path(reply)) or None, 'llm'
+    if reformat:
+        if not src:
+            with open(OUT_PATH, 'r', encoding='utf-8') as f:
+                text = f.read()
+        counter = get_counter(chat)
+        saved = counter(FORMAT_DEPLOY) + counter(text) - used
+    if is_cancelled():
+        return
     dest = get_path(dest)
     os.makedirs(dest, exist_ok=True)
-    current_filename = None
-    code_block = []
-    in_code_block = False
-    for line in lines:
-        line = line.rstrip()
-        if line.startswith("```"):
-            if in_code_block and current_filename:
-                with open(os.path.join(dest, os.path.basename(current_filename)), "w", encoding="utf-8") as code_file:
-                    code_file.write("\n".join(code_block) + "\n")
-                code_block = []
-            in_code_block = not in_code_block
-        elif in_code_block:
-            code_block.append(line)
-        else:
-            match = re.match(r"^\*\*(.+?)\*\*$", line)
-            if match:
-                current_filename = re.sub(r"[^a-zA-Z0-9_.-]", "", match.group(1))
+    files, renamed = {}, 0
+    for block, (name, _) in zip(blocks, inferred):
+        if not name:
+            tolog(f'No filename for {block["lang"] or "untagged"} block at line {block["start"]}', 'deploy')
+            continue
+        text, path = block['text'] + '\n', os.path.join(dest, name)
+        if files.get(path, text) != text:
+            stem, ext = os.path.splitext(name)
+            n = 2
+            while files.get(path := os.path.join(dest, f'{stem}_{n}{ext}'), text) != text:
+                n += 1
+            tolog(f'{name} names more than one block; writing the block at line {block["start"]} to {os.path.basename(path)}', 'deploy')
+            renamed += 1
+        files[path] = text
+    def write(item):
+        try:
+            write_atomic(*item)
+            return item[0]
+        except OSError as e:
+            tolog(f'Failed to deploy {item[0]} due to {e}', 'deploy')
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        written = [path for path in pool.map(write, files.items()) if path]
+    tolog(dict(dest=dest, files=len(written), blocks=len(blocks), renamed=renamed, asked=len(ambiguous) if reformat else 0, tokens_used=used, tokens_saved=saved), 'deploy')
+    toout(f"\n\n---\n\nDeployed {len(written)} file{'s' * (len(written) != 1)} to {dest}" + (f', {renamed} renamed to avoid a name clash' if renamed else '') + (f' (~{saved} tokens saved)' if reformat else ''), mode='a')
+    return written
 
 def is_binary(file_path):
     try:
         with open(file_path, 'rb') as f:
-            chunk = f.read(1024)
-            chunk.decode('utf-8') 
-        return False 
-    except UnicodeDecodeError:
-        return True
+            return sniff_binary(f.read(1024))
     except Exception as e:
         return f"Error: {e}"
 
+def sniff_binary(data):
+    head = data[:1024]
+    if b'\0' in head:
+        return True
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+        return False
+    except UnicodeDecodeError:
+        return True
+
+def ignore_regex(pattern):
+    out, i = '', 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            out, i = out + '(?:.*/)?', i + 3
+        elif pattern.startswith('**', i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == '/'):
+            out, i = out + '.*', i + 2
+        elif c == '*':
+            out, i = out + '[^/]*', i + 1
+        elif c == '?':
+            out, i = out + '[^/]', i + 1
+        elif c == '[' and (j := pattern.find(']', i + 2 + (pattern[i + 1:i + 2] in ('!', '^')))) > 0:
+            body = pattern[i + 1:j]
+            body = '^' + body[1:] if body[:1] in ('!', '^') else body
+            out, i = out + '[' + body.replace('\\', '\\\\') + ']', j + 1
+        elif c == '\\' and i + 1 < len(pattern):
+            out, i = out + re.escape(pattern[i + 1]), i + 2
+        else:
+            out, i = out + re.escape(c), i + 1
+    return re.compile(out + '(/.*)?', re.S)
+
+class IgnoreRules:
+    def __init__(self, rules=(), parent=None):
+        self.rules = list(parent.rules) if parent else []
+        for base, line in rules:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            line = line[1:] if negate else line
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            self.rules.append((base, ignore_regex(line.lstrip('/')), negate, dir_only, anchored))
+
+    @classmethod
+    def load(cls, dir_path, parent=None):
+        try:
+            with open(os.path.join(dir_path, '.gitignore'), 'r', encoding='utf-8', errors='ignore') as f:
+                lines = f.readlines()
+        except OSError:
+            return parent
+        return cls([(dir_path, line) for line in lines], parent)
+
+    def ignored(self, path, is_dir=False):
+        name, result = os.path.basename(path), False
+        for base, pattern, negate, dir_only, anchored in self.rules:
+            match = pattern.fullmatch((os.path.relpath(path, base) if base else path) if anchored else name)
+            if match and (is_dir or not dir_only or match.group(1)):
+                result = not negate
+        return result
+
+def scan_dir(root, depth=SCAN_DEPTH, ignore=None):
+    ignore = IgnoreRules.load(root, ignore or IgnoreRules([(None, p) for p in SCAN_IGNORE]))
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        tolog(f'Failed to scan({root}) due to {e}', 'retrieve')
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if depth > 0 and not ignore.ignored(entry.path, True):
+                    yield from scan_dir(entry.path, depth - 1, ignore)
+            elif entry.is_file() and not ignore.ignored(entry.path):
+                yield entry.path, entry.stat()
+        except OSError as e:
+            tolog(f'Failed to scan({entry.path}) due to {e}', 'retrieve')
+
+def read_text(file_path, max_bytes=SCAN_MAX_BYTES):
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > max_bytes:
+            return None, 'too large'
+        data = f.read()
+    if sniff_binary(data):
+        return None, 'binary'
+    return data.decode('utf-8', errors='ignore'), None
+
+def scan_files(src_path, depth=SCAN_DEPTH, max_bytes=SCAN_MAX_BYTES, workers=SCAN_WORKERS, batch_size=32):
+    def load(batch):
+        result = []
+        for file_path, st in batch:
+            try:
+                content, reason = read_text(file_path, max_bytes)
+            except Exception as e:
+                content, reason = None, e
+            if reason:
+                tolog(f'Skipped {file_path}: {reason}', 'debug:retrieve')
+            else:
+                result.append((file_path, st.st_mtime, content))
+        return result
+    def batches():
+        batch = []
+        for file_path, st in scan_dir(src_path, depth):
+            if st.st_size > max_bytes:
+                tolog(f'Skipped {file_path}: too large', 'debug:retrieve')
+                continue
+            batch.append((file_path, st))
+            if len(batch) >= batch_size or not inflight:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        inflight = deque()
+        for batch in batches():
+            inflight.append(pool.submit(load, batch))
+            if len(inflight) >= 2 * workers:
+                yield from inflight.popleft().result()
+        while inflight:
+            yield from inflight.popleft().result()
+
 def split_str(doc, max_len=2000, get_len=len):
     chunks, current_chunk, current_len = [], [], 0
     lines = doc.splitlines(keepends=True)
@@ -193,7 +694,102 @@ def split_str(doc, max_len=2000, get_len=len):
             chunks.append("".join(current_chunk))
     return chunks
 
-def retrieve(src_path, max_len=2000, get_len=len):
+def shared_prefix(a, b):
+    return next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+
+def content_digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode('utf-8', errors='ignore'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+class TokenCounter:
+    def __init__(self, get_ntok=len, tokenizer=None, maxsize=2**16):
+        self.get_ntok = get_ntok
+        self.tokenizer = getattr(tokenizer, '_tokenizer', tokenizer)
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.last = None
+        self.calls = 0
+
+    def __call__(self, s):
+        key = s if len(s) < 64 else content_digest(s)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.calls += 1
+        with span('tokenize'):
+            n = self.cache[key] = self.get_ntok(s)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return n
+
+    def offsets(self, doc):
+        if self.tokenizer is None:
+            return None
+        key = content_digest(doc)
+        if self.last is not None and self.last[0] == key:
+            return self.last[1]
+        try:
+            mapping = self.tokenizer(doc, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+        except Exception as e:
+            tolog(f'Token offsets unavailable from {type(self.tokenizer).__name__} due to {e!r}; counting each span instead', 'tokenizer')
+            self.tokenizer = None
+            return None
+        self.calls += 1
+        self.last = (key, [start for start, _ in mapping])
+        return self.last[1]
+
+    def spans(self, doc, spans):
+        starts = self.offsets(doc)
+        if starts is None:
+            return [self(doc[start:end]) for start, end in spans]
+        return [bisect_left(starts, end) - bisect_left(starts, start) for start, end in spans]
+
+COUNTERS = {}
+
+def get_counter(model=None):
+    model = chat if model is None else model
+    if id(model) not in COUNTERS:
+        COUNTERS[id(model)] = TokenCounter(model.get_ntok, getattr(model, 'tokenizer', None))
+    return COUNTERS[id(model)]
+
+def split_tokens(doc, max_len=2000, counter=None):
+    counter = TokenCounter() if counter is None else counter
+    spans, para_start, end = [], None, 0
+    for line in doc.splitlines(keepends=True):
+        start, end = end, end + len(line)
+        if line.strip():
+            if para_start is None:
+                para_start = start
+        else:
+            if para_start is not None:
+                spans.append((para_start, start))
+                para_start = None
+            spans.append((start, end))
+    if para_start is not None:
+        spans.append((para_start, len(doc)))
+    chunks, current = [], None
+    for (start, end), n in zip(spans, counter.spans(doc, spans)):
+        if current is not None and current[2] + n > max_len:
+            chunks.append(current)
+            current = None
+        current = [start, end, n] if current is None else [current[0], end, current[2] + n]
+    if current is not None:
+        if current[2] < max_len / 2 and len(chunks) > 0:
+            chunks[-1] = [chunks[-1][0], current[1], chunks[-1][2] + current[2]]
+        else:
+            chunks.append(current)
+    return [(doc[start:end], n) for start, end, n in chunks]
+
+def retrieve(src_path, max_len=2000, counter=None, lazy=False, depth=SCAN_DEPTH, max_bytes=SCAN_MAX_BYTES):
+    def load(timestamp, content):
+        digest = content_digest(content)
+        if lazy:
+            return dict(timestamp=timestamp, digest=digest, content=content)
+        chunks = split_tokens(content, max_len=max_len, counter=counter)
+        return dict(timestamp=timestamp, digest=digest, list_str=[c for c, _ in chunks], list_ntok=[n for _, n in chunks])
     src_path = get_path(src_path)
     result = {}
     if not os.path.exists(src_path):
@@ -201,24 +797,18 @@ def retrieve(src_path, max_len=2000, get_len=len):
         return result
     if os.path.isfile(src_path):
         try:
-            with open(src_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-            result = {src_path:dict(timestamp=os.path.getmtime(src_path), list_str=split_str(content, max_len=max_len, get_len=get_len))}
+            content, reason = read_text(src_path, max_bytes)
+            if reason:
+                tolog(f'Skipped {src_path}: {reason}', 'retrieve')
+            else:
+                result = {src_path:load(os.path.getmtime(src_path), content)}
         except Exception as e:
-            tolog(f'Failed to retrieve({filename}) due to {e}')
+            tolog(f'Failed to retrieve({src_path}) due to {e}')
     else:
-        for filename in os.listdir(src_path):
-            try:
-                file_path = os.path.join(src_path, filename)
-                if filename.startswith('.') or is_binary(file_path):
-                    continue
-                if os.path.isfile(file_path):
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-                    result[file_path] = dict(timestamp=os.path.getmtime(file_path), list_str=split_str(content, max_len=max_len, get_len=get_len))
-            except Exception as e:
-                tolog(f'Failed to retrieve({filename}) due to {e}')
-                continue
+        for file_path, timestamp, content in scan_files(src_path, depth=depth, max_bytes=max_bytes):
+            if is_cancelled():
+                break
+            result[file_path] = load(timestamp, content)
     return result
 
 def get_path(s):
@@ -229,19 +819,186 @@ def get_path(s):
     s = os.path.abspath(s)
     return s
 
+class SummaryStore:
+    def __init__(self, path, max_bytes=LTM_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, ntok INTEGER, dir TEXT, size INTEGER, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS summaries_dir ON summaries (dir)')
+            conn.execute('CREATE INDEX IF NOT EXISTS summaries_accessed ON summaries (accessed)')
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self.connect().execute('SELECT summary, ntok FROM summaries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else dict(summary=row[0], ntok=row[1])
+
+    def entries(self, dir_path):
+        rows = self.connect().execute('SELECT key, summary, ntok FROM summaries WHERE dir = ?', (dir_path,))
+        return {key: dict(summary=summary, ntok=ntok) for key, summary, ntok in rows}
+
+    def put(self, key, summary, ntok=None, path=''):
+        with self.connect() as conn:
+            conn.execute('INSERT INTO summaries (key, summary, ntok, dir, size, accessed) VALUES (?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET summary = excluded.summary, ntok = excluded.ntok, dir = excluded.dir, size = excluded.size, accessed = excluded.accessed',
+                         (key, summary, ntok, os.path.dirname(path), len(summary.encode('utf-8')), time.time()))
+
+    def touch(self, keys):
+        with self.connect() as conn:
+            conn.executemany('UPDATE summaries SET accessed = ? WHERE key = ?', [(time.time(), key) for key in keys])
+
+    def evict(self):
+        conn = self.connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM summaries').fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        stale = []
+        for key, size in conn.execute('SELECT key, size FROM summaries ORDER BY accessed'):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        with conn:
+            conn.executemany('DELETE FROM summaries WHERE key = ?', stale)
+        return len(stale)
+
+    def migrate(self, legacy_path, max_len=NUM_TOKEN):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f'VimLM: could not read {legacy_path} ({e!r}); leaving it in place', file=sys.stderr, flush=True)
+            return
+        imported = 0
+        for path, entry in cache.items() if isinstance(cache, dict) else []:
+            try:
+                if not isinstance(entry, dict) or os.path.getmtime(path) != entry.get('timestamp'):
+                    continue
+                content, reason = read_text(path)
+            except (OSError, TypeError):
+                continue
+            if reason or not isinstance(summary := entry.get('summary'), str):
+                continue
+            ntok, digest = entry.get('ntok'), content_digest(content)
+            budgets = {max_len >> b for b in range(max_len.bit_length())}
+            for budget in budgets:
+                if ntok is None or ntok <= budget:
+                    self.put(summary_key(budget, digest), summary, ntok=ntok, path=path)
+            imported += 1
+        tolog(dict(legacy=legacy_path, files=len(cache) if isinstance(cache, dict) else 0, imported=imported), 'ingest')
+        try:
+            os.remove(legacy_path)
+        except FileNotFoundError:
+            pass
+
+class StoreView:
+    def __init__(self, store, dir_path):
+        self.store = store
+        self.hot = store.entries(dir_path)
+        self.used = set()
+
+    def get(self, key):
+        if key not in self.hot:
+            entry = self.store.get(key)
+            if entry is None:
+                return None
+            self.hot[key] = entry
+        self.used.add(key)
+        return self.hot[key]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, summary, ntok=None, path=''):
+        self.store.put(key, summary, ntok=ntok, path=path)
+        self.hot[key] = dict(summary=summary, ntok=ntok)
+
+LTM_STORE = SummaryStore(LTM_PATH)
+
+FORMAT_INGEST = '{volat}{incoming}\n\n---\n\nPlease provide a succint bullet point summary for above:' 
+FORMAT_VOLAT = 'Here is a summary of part 1 of **{k}**:\n\n---\n\n{newsum}\n\n---\n\nHere is the next part:\n\n---\n\n' 
+
+class Progress:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.cached = 0
+        self.start = time.monotonic()
+
+    def update(self, generated=0, cached=0):
+        self.done += generated + cached
+        self.cached += cached
+        self.total = max(self.total, self.done)
+        elapsed = time.monotonic() - self.start
+        n_generated = self.done - self.cached
+        eta = f'{int(elapsed / n_generated * (self.total - self.done))}s' if n_generated else '?'
+        toout(f'{self.label}: {self.done}/{self.total} parts ({self.cached} cached), ETA {eta}')
+
+def summarize_doc(k, list_str, max_new_sum, max_new_accum, counter):
+    volat = f'**{k}**:\n'
+    newsum = ''
+    accum = ''
+    for s in list_str:
+        key = content_digest('chunk', max_new_sum, newsum, s)
+        newsum = (yield key, FORMAT_INGEST.format(volat=volat, incoming=s.rstrip()), max_new_sum).rstrip()
+        accum += newsum + ' ...\n'
+        volat = FORMAT_VOLAT.format(k=k, newsum=newsum)
+    if counter(accum) <= max_new_accum:
+        return accum.strip()
+    key = content_digest('accum', max_new_accum, accum)
+    return (yield key, FORMAT_INGEST.format(volat=f'**{k}**:\n', incoming=accum), max_new_accum).strip()
+
+def summarize_batch(batch, cache, progress):
+    futures = {}
+    for k, (key, prompt, max_new) in batch:
+        if key in cache:
+            progress.update(cached=1)
+        elif key not in futures:
+            futures[key] = (k, ENGINE.submit(prompt, max_new))
+    for key, (k, future) in futures.items():
+        if is_cancelled():
+            future.cancel()
+            continue
+        cache.put(key, future.result(), path=k)
+        progress.update(generated=1)
+    return [cache.get(key)['summary'] if key in cache else '' for _, (key, _, _) in batch]
+
+def run_summaries(jobs, cache, progress):
+    active, results = {}, {}
+    def advance(k, value):
+        try:
+            active[k] = jobs[k].send(value)
+        except StopIteration as e:
+            active.pop(k, None)
+            results[k] = e.value
+    for k in jobs:
+        advance(k, None)
+    while active and not is_cancelled():
+        batch = list(active.items())
+        texts = summarize_batch(batch, cache, progress)
+        for (k, _), text in zip(batch, texts):
+            advance(k, text)
+    return results
+
+def summary_budget(max_len, n):
+    return max(1, max_len >> max(0, n - 1).bit_length())
+
+def summary_key(budget, digest):
+    return content_digest('summary', budget, digest)
+
 def ingest(src, max_len=NUM_TOKEN):
-    def load_cache(cache_path=LTM_PATH):
-        if os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-    def dump_cache(new_data, cache_path=LTM_PATH):
-        current_data = load_cache(cache_path)
-        for k, v in new_data.items():
-            if k not in current_data or v['timestamp'] > current_data[k]['timestamp']:
-                current_data[k] = v
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(current_data, f, indent=2)
     src = get_path(src)
     tolog(f'ingest {src=}')
     result = ''
@@ -254,62 +1011,281 @@ def ingest(src, max_len=NUM_TOKEN):
     else:
         tolog(f'Failed to ingest({src})')
         return ''
-    dict_doc = retrieve(src, max_len=max_len, get_len=chat.get_ntok)
     toout(f'Ingesting {src}...')
-    format_ingest = '{volat}{incoming}\n\n---\n\nPlease provide a succint bullet point summary for above:' 
-    format_volat = 'Here is a summary of part 1 of **{k}**:\n\n---\n\n{newsum}\n\n---\n\nHere is the next part:\n\n---\n\n' 
-    dict_sum = {}
-    cache = load_cache()
-    max_new_accum = int(max_len/len(dict_doc)) if len(dict_doc) > 0 else max_len
+    cache = StoreView(LTM_STORE, src if os.path.isdir(src) else os.path.dirname(src))
+    counter = get_counter()
+    dict_doc = retrieve(src, max_len=max_len, counter=counter, lazy=True)
+    max_new_accum = summary_budget(max_len, len(dict_doc))
+    dict_sum, jobs = {}, {}
     for k, v in dict_doc.items():
+        v['key'] = summary_key(max_new_accum, v['digest'])
+        content = v.pop('content')
+        chunks = [] if v['key'] in cache else split_tokens(content, max_len=max_len, counter=counter)
+        v.update(list_str=[c for c, _ in chunks], list_ntok=[n for _, n in chunks])
         list_str = v['list_str']
-        v_stamp = v['timestamp']
-        if len(list_str) == 0:
-            continue
-        if len(list_str) == 1 and chat.get_ntok(list_str[0]) <= max_new_accum:
-            chat_summary = list_str[0]
-        else:
-            k_base = os.path.basename(k)
-            if v_stamp == cache.get(k, {}).get('timestamp'):
-                dict_sum[k] = cache[k]
-                continue
-            max_new_sum = int(max_len/len(list_str))
-            volat = f'**{k}**:\n'
-            accum = ''
-            for i, s in enumerate(list_str):
-                chat.reset()
-                toout(f'\n\nIngesting {k_base} {i+1}/{len(list_str)}...\n\n', mode='a')
-                newsum = chat(format_ingest.format(volat=volat, incoming=s.rstrip()), max_new=max_new_sum, verbose=False, stream=OUT_PATH)['text'].rstrip()
-                accum += newsum + ' ...\n'
-                volat = format_volat.format(k=k, newsum=newsum)
-            toout(f'\n\nIngesting {k_base}...\n\n', mode='a')
-            if chat.get_ntok(accum) <= max_new_accum:
-                chat_summary = accum.strip()
-            else:
-                chat.reset()
-                chat_summary = chat(format_ingest.format(volat=f'**{k}**:\n', incoming=accum), max_new=max_new_accum, verbose=False, stream=OUT_PATH)['text'].strip()
-        dict_sum[k] = dict(timestamp=v_stamp, summary=chat_summary, ntok=chat.get_ntok(chat_summary))
-    dump_cache(dict_sum)
-    for k, v in dict_sum.items():
-        result += f'--- **{os.path.basename(k)}** ---\n{v["summary"].strip()}\n\n'
+        if v['key'] in cache:
+            dict_sum[k] = cache.get(v['key'])
+        elif len(list_str) == 1 and v['list_ntok'][0] <= max_new_accum:
+            dict_sum[k] = dict(summary=list_str[0])
+        elif len(list_str) > 0:
+            jobs[k] = summarize_doc(k, list_str, int(max_len/len(list_str)), max_new_accum, counter)
+    progress = Progress(f'Ingesting {src}', total=sum(len(dict_doc[k]['list_str']) for k in jobs))
+    for k, summary in run_summaries(jobs, cache, progress).items():
+        dict_sum[k] = dict(summary=summary, ntok=counter(summary))
+        cache.put(dict_doc[k]['key'], summary, ntok=dict_sum[k]['ntok'], path=k)
+    LTM_STORE.touch(cache.used)
+    LTM_STORE.evict()
+    for k in dict_doc:
+        if k in dict_sum:
+            result += f'--- **{os.path.basename(k)}** ---\n{dict_sum[k]["summary"].strip()}\n\n'
     result += '---\n\n'
     toout(result, 'ingest')
     return result
 
+DEF_PATTERN = re.compile(r'^[ \t]*(?:export\s+)?(?:pub\s+)?(?:async\s+)?(def|class|function|func|fn|struct|interface|impl|trait|type)\s+([A-Za-z_]\w*)', re.M)
+
+def code_chunks(path, text, max_lines=CHUNK_LINES):
+    lines = text.splitlines()
+    spans = []
+    if path.endswith('.py'):
+        def leaves(node):
+            nested = False
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                for child in ast.iter_child_nodes(node):
+                    nested |= leaves(child)
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if not nested:
+                    start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                    spans.append((node.name, 'class' if isinstance(node, ast.ClassDef) else 'def', start, node.end_lineno))
+                return True
+            return nested
+        try:
+            leaves(ast.parse(text))
+        except (SyntaxError, ValueError, RecursionError):
+            spans = []
+    if not spans and os.path.splitext(path)[1] not in ('', '.md', '.txt', '.rst'):
+        starts = [(m.group(2), m.group(1), text.count('\n', 0, m.start()) + 1) for m in DEF_PATTERN.finditer(text)]
+        for (name, kind, start), nxt in zip(starts, starts[1:] + [(None, None, len(lines) + 1)]):
+            spans.append((name, kind, start, nxt[2] - 1))
+    covered = bytearray(len(lines) + 2)
+    chunks = []
+    for name, kind, start, end in spans:
+        end = min(end, start + 2 * max_lines - 1)
+        covered[start:end + 1] = b'\1' * (end + 1 - start)
+        chunks.append((name, kind, start, end))
+    start = None
+    for i in range(1, len(lines) + 2):
+        free = i <= len(lines) and not covered[i]
+        if free and start is None:
+            start = i
+        if start is not None and (not free or i - start + 1 == max_lines):
+            end = i if free else i - 1
+            if any(line.strip() for line in lines[start - 1:end]):
+                chunks.append(('', 'text', start, end))
+            start = None
+    return [(name, kind, start, end, '\n'.join(lines[start - 1:end])) for name, kind, start, end in chunks]
+
+class CodeIndex:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, digest TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, path TEXT, name TEXT, kind TEXT, start INTEGER, end INTEGER, body TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path)')
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(name, body, content='chunks', content_rowid='id', tokenize='unicode61 tokenchars _')")
+            if conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+                conn.execute('DELETE FROM files')
+                conn.execute('DELETE FROM chunks')
+                conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+                conn.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def update(self, root, depth=SEARCH_DEPTH, max_bytes=SCAN_MAX_BYTES, max_files=SEARCH_MAX_FILES):
+        conn = self.connect()
+        lo, hi = root.rstrip(os.sep) + os.sep, root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+        known = {path: (mtime, size, digest) for path, mtime, size, digest in conn.execute('SELECT path, mtime, size, digest FROM files WHERE path >= ? AND path < ?', (lo, hi))}
+        seen, indexed, truncated = set(), 0, False
+        for path, st in scan_dir(root, depth):
+            if len(seen) >= max_files:
+                truncated = True
+                break
+            seen.add(path)
+            old = known.get(path)
+            if st.st_size > max_bytes or (old and old[:2] == (st.st_mtime_ns, st.st_size)):
+                continue
+            try:
+                text, reason = read_text(path, max_bytes)
+            except Exception as e:
+                text, reason = None, e
+            digest = content_digest(text) if text is not None else None
+            if old and old[2] == digest:
+                conn.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?', (st.st_mtime_ns, st.st_size, path))
+                continue
+            if old:
+                self.drop(conn, path)
+            for chunk in code_chunks(path, text) if text is not None else ():
+                rowid = conn.execute('INSERT INTO chunks (path, name, kind, start, end, body) VALUES (?, ?, ?, ?, ?, ?)', (path, *chunk)).lastrowid
+                conn.execute('INSERT INTO chunks_fts (rowid, name, body) VALUES (?, ?, ?)', (rowid, chunk[0], chunk[4]))
+            conn.execute('INSERT OR REPLACE INTO files (path, mtime, size, digest) VALUES (?, ?, ?, ?)', (path, st.st_mtime_ns, st.st_size, digest))
+            indexed += 1
+        for path in set(known) - seen if not truncated else ():
+            self.drop(conn, path)
+            conn.execute('DELETE FROM files WHERE path = ?', (path,))
+        conn.commit()
+        if truncated:
+            tolog(f'Indexed only the first {max_files} files under {root}', 'search')
+        return indexed
+
+    def drop(self, conn, path):
+        rows = conn.execute('SELECT id, name, body FROM chunks WHERE path = ?', (path,)).fetchall()
+        conn.executemany("INSERT INTO chunks_fts (chunks_fts, rowid, name, body) VALUES ('delete', ?, ?, ?)", rows)
+        conn.execute('DELETE FROM chunks WHERE path = ?', (path,))
+
+    def query(self, root, text, k=SEARCH_TOP_K):
+        terms = list(dict.fromkeys(t.lower() for t in re.findall(r'\w{2,}', text)))
+        if not terms:
+            return []
+        lo, hi = root.rstrip(os.sep) + os.sep, root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+        match = ' OR '.join(f'"{t}"' for t in terms)
+        return self.connect().execute('SELECT c.path, c.name, c.kind, c.start, c.end, c.body FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid '
+                                      'WHERE chunks_fts MATCH ? AND c.path >= ? AND c.path < ? ORDER BY bm25(chunks_fts, 10.0, 1.0) LIMIT ?', (match, lo, hi, k)).fetchall()
+
+CODE_INDEX = CodeIndex(INDEX_PATH)
+
+def search(src, query, k=SEARCH_TOP_K):
+    src = get_path(src)
+    root = src if os.path.isdir(src) else os.path.dirname(src)
+    t0 = time.perf_counter()
+    try:
+        indexed = CODE_INDEX.update(root)
+        rows = CODE_INDEX.query(root, query, k)
+    except sqlite3.Error as e:
+        tolog(f'Search index unavailable ({e}); summarising instead', 'search')
+        return ingest(src)
+    tolog(dict(src=src, indexed=indexed, hits=len(rows), ms=round(1000 * (time.perf_counter() - t0), 1)), 'search')
+    result = ''
+    for path, name, kind, start, end, body in rows:
+        label = f'{os.path.relpath(path, root)}:{start}-{end}' + (f' ({kind} {name})' if name else '')
+        result += f'--- **{label}** ---\n```{os.path.splitext(path)[1][1:]}\n{body}\n```\n\n'
+    return result + '---\n\n' if result else ''
+
+FIM_BUFFERS = {}
+FIM_REVS = 16
+
+def receive_fim(data, diff):
+    revs = FIM_BUFFERS.setdefault(diff['key'], OrderedDict())
+    if diff['base'] < 0:
+        base = []
+    elif diff['base'] in revs:
+        base = revs[diff['base']]
+    else:
+        tolog(f'Stale FIM base {diff}', 'fim')
+        data['status'] = 'stale'
+        return data
+    changed = data['context'].split('\n') if diff['n'] else []
+    lines = base[:diff['start']] + changed + base[diff['end']:]
+    revs[diff['rev']] = lines
+    while len(revs) > FIM_REVS:
+        revs.popitem(last=False)
+    data['fim_lines'] = lines
+    data['cursor'] = (diff['line'], diff['col'])
+    return data
+
+def fim_window(lines, line, col, budget=FIM_TOKENS, counter=len):
+    current = (lines[line - 1] if 0 < line <= len(lines) else '').encode('utf-8')
+    head, tail = current[:col - 1].decode('utf-8', errors='ignore'), current[col - 1:].decode('utf-8', errors='ignore')
+    prefix_budget = budget * 3 // 4 - counter(head)
+    suffix_budget = budget - budget * 3 // 4 - counter(tail)
+    top = line - 1
+    while top > 0 and (n := counter(lines[top - 1]) + 1) <= prefix_budget:
+        prefix_budget -= n
+        top -= 1
+    bottom = line
+    while bottom < len(lines) and (n := counter(lines[bottom]) + 1) <= suffix_budget:
+        suffix_budget -= n
+        bottom += 1
+    return '\n'.join(lines[top:line - 1] + [head]), '\n'.join([tail] + lines[line:bottom])
+
+def read_context(ctx, budget=CONTEXT_TOKENS, counter=len):
+    reach = budget * CONTEXT_BYTES_PER_TOKEN
+    with open(ctx['path'], 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = min(max(0, ctx.get('start', 0)), size)
+        end = size if ctx.get('end', -1) < 0 else min(max(start, ctx['end']), size, start + reach)
+        lo, hi = max(0, start - reach), min(size, end + reach)
+        if ctx.get('snapshot') and size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                region = buf[lo:hi]
+        else:
+            region = os.pread(f.fileno(), hi - lo, lo)
+    head = region[:start - lo].decode('utf-8', errors='ignore').split('\n')[1 if lo else 0:-1]
+    focus = region[start - lo:end - lo].decode('utf-8', errors='ignore').removesuffix('\n').split('\n')
+    tail = region[end - lo:].decode('utf-8', errors='ignore').split('\n')
+    tail = tail[:-1] if hi < size or tail[-1] == '' else tail
+    left = budget - counter('\n'.join(focus))
+    top, bottom, grew = len(head), 0, True
+    while grew:
+        grew = False
+        if top > 0 and (n := counter(head[top - 1]) + 1) <= left:
+            left, top, grew = left - n, top - 1, True
+        if bottom < len(tail) and (n := counter(tail[bottom]) + 1) <= left:
+            left, bottom, grew = left - n, bottom + 1, True
+    lines = head[top:] + focus + tail[:bottom]
+    first = ctx.get('line', 1) - (len(head) - top)
+    whole = lo == 0 and top == 0 and hi == size and bottom == len(tail)
+    return '\n'.join(lines), None if whole else (first, first + len(lines) - 1)
+
+def resume_chat(data, max_new):
+    if OWNERS['chat'] not in (None, data.get('session')) or not CONVERSATION.synced:
+        toout('Cannot continue: the model has answered another Vim session since. Send the prompt again instead.')
+        return
+    TAIL.flush()
+    response = chat.resume(max_new=max_new, verbose=False, stream=OUT_PATH)
+    TAIL.finish()
+    CONVERSATION.extend(response['text'], get_counter(chat))
+    tolog(response)
+
 def process_command(data):
     if 'fim' in data:
-        toout('Autocompleting...')
-        response = fim.fim(prefix=data['context'], suffix=data['yank'], current_path=data['tree'])
-        toout(response['autocomplete'], 'fim')
+        show = not chat_streaming(data.get('session'))
+        if data.get('status') == 'stale':
+            if show:
+                toout('Buffer out of sync with VimLM; it will be resent in full on the next request.')
+            data['user_prompt'] = ''
+            return data
+        if show:
+            toout('Autocompleting...')
+        if 'fim_lines' in data:
+            prefix, suffix = fim_window(data['fim_lines'], *data['cursor'], budget=FIM_TOKENS, counter=get_counter(fim))
+        else:
+            prefix, suffix = data['context'], data['yank']
+        if REPO is not None:
+            imports = find_imports('\n'.join(data['fim_lines'][:200]) if 'fim_lines' in data else prefix)
+            module = os.path.splitext(os.path.basename(data['tree']))[0]
+            with span('repo'):
+                if dict_repo := REPO.context(prefix[-2000:] + suffix[:1000], imports, module, REPO_TOKENS, get_counter(fim)):
+                    fim.set_cache_repo(dict_repo, cache_dir=VIMLM_DIR)
+        with span('generate'):
+            response = fim.fim(prefix=prefix, suffix=suffix, current_path=data['tree'])
+        data['completion'] = response['autocomplete']
+        if show:
+            toout(response['autocomplete'], 'fim')
         tolog(response)
         data['user_prompt'] = ''
         return data
     for i in IN_FILES:
         data[i] = data[i].strip()
     if len(data['user']) == 0:
-        response = chat.resume(max_new=NUM_TOKEN, verbose=False, stream=OUT_PATH)
-        toout(response['text'], mode='a')
-        tolog(response)
+        resume_chat(data, NUM_TOKEN)
         data['user_prompt'] = ''
         return data
     if SEP_CMD in data['user']:
@@ -324,9 +1300,7 @@ def process_command(data):
         if cmd.startswith('continue'):
             arg = cmd.removeprefix('continue').strip('(').strip(')').strip().strip('"').strip("'").strip()
             data['max_new'] = NUM_TOKEN if len(arg) == 0 else int(arg)
-            response = chat.resume(max_new=data['max_new'], verbose=False, stream=OUT_PATH)
-            toout(response['text'])
-            tolog(response)
+            resume_chat(data, data['max_new'])
             do_reset = False
             break
 
@@ -338,11 +1312,19 @@ def process_command(data):
             break
     if do_reset:
         chat.reset()
+        CONVERSATION.reset()
+    data['fresh'] = do_reset
 
     full_path = data['tree']
     data['dir'] = os.path.dirname(full_path)
     data['file'] = os.path.basename(full_path)
     data['ext'] = os.path.splitext(full_path)[1][1:]
+    if data.get('ctx') and not chat.stop and data['tree'] != OUT_PATH:
+        with span('context'):
+            context, lines = read_context(data['ctx'], CONTEXT_TOKENS, get_counter(chat))
+        data['context'] = context.strip()
+        if lines is not None:
+            data['file'] += f' (lines {lines[0]}-{lines[1]})'
     if chat.stop:
         data['file'] = ''
         data['context'] = ''
@@ -356,7 +1338,8 @@ def process_command(data):
         data['ext'] = ''
 
     if len(cmds) == 1 and len(cmds[0]) == 0:
-        data['include'] = ingest(data['dir'])
+        with span('ingest'):
+            data['include'] = ingest(data['dir'])
         return data
 
     data['include'] = ''
@@ -378,13 +1361,19 @@ def process_command(data):
                 except Exception as e:
                     tolog(f'Error executing {shell_cmd}: {e}')
             else:
-                data['include'] += ingest(src)
+                with span('ingest'):
+                    data['include'] += ingest(src)
+        elif cmd.startswith('search'):
+            arg = cmd.removeprefix('search').strip().strip('(').strip(')').strip().strip('"').strip("'").strip()
+            with span('search'):
+                data['include'] += search(arg or (REPO.extra.get('repo_path') if REPO is not None else None) or os.getcwd(), f"{data['user_prompt']} {data['yank']}")
 
     for cmd in cmds:
         if cmd.startswith('deploy'):
             arg = cmd.removeprefix('deploy').strip().strip('(').strip(')').strip().strip('"').strip("'").strip()
             if len(data['user_prompt']) == 0:
-                deploy(dest=arg)
+                with span('deploy'):
+                    deploy(dest=arg)
                 data['user_prompt'] = ''
                 return data
             data['user_prompt'] += "\n\nEnsure that each code block is preceded by a filename in **filename.ext** format. The filename should only contain alphanumeric characters, dots, underscores, or hyphens. Ensure that any extraneous characters are removed from the filenames."
@@ -399,39 +1388,965 @@ def process_command(data):
             data['write_dest'] = re.sub(r"[^a-zA-Z0-9_.-]", "", f'{arg}_{timestamp}.md')
     return data
     
+def read_ids(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [int(i) for i in f.read().split()]
+
+LAST_IDS = {}
+MAX_SKIPPED = 1000
+
+def skip_ids(watch_dir, msg_id):
+    last, LAST_IDS[watch_dir] = LAST_IDS.get(watch_dir), msg_id
+    if last is None or msg_id <= last + 1:
+        return
+    skipped = range(max(last + 1, msg_id - MAX_SKIPPED), msg_id)
+    for i in skipped:
+        write_atomic(os.path.join(watch_dir, f'done_{i}'), 'cancelled')
+    tolog(f'superseded {len(skipped)} overwritten requests before {msg_id}', 'read_request')
+
+def read_request(watch_dir, found_files, session=None):
+    if 'cancel' in found_files and os.path.exists(os.path.join(watch_dir, 'cancel')):
+        SCHEDULER.cancel(read_ids(os.path.join(watch_dir, 'cancel')), session)
+        os.remove(os.path.join(watch_dir, 'cancel'))
+    if IN_FILES[-1] not in found_files or not set(IN_FILES).issubset(set(os.listdir(watch_dir))):
+        return None
+    if TRACE:
+        t0, changed = time.perf_counter(), os.path.getmtime(os.path.join(watch_dir, IN_FILES[-1]))
+        watch = max(0.0, time.time() - changed)
+    data = {}
+    for file in IN_FILES:
+        path = os.path.join(watch_dir, file)
+        with open(path, 'r', encoding='utf-8') as f:
+            data[file] = f.read()
+        os.remove(os.path.join(watch_dir, file))
+    if 'followup' in os.listdir(watch_dir):
+        os.remove(os.path.join(watch_dir, 'followup'))
+        data['followup'] = True
+    if 'fim' in os.listdir(watch_dir):
+        with open(os.path.join(watch_dir, 'fim'), 'r', encoding='utf-8') as f:
+            meta = f.read().strip()
+        os.remove(os.path.join(watch_dir, 'fim'))
+        data['fim'] = True
+        if meta:
+            receive_fim(data, json.loads(meta))
+    if 'ctx' in os.listdir(watch_dir):
+        with open(os.path.join(watch_dir, 'ctx'), 'r', encoding='utf-8') as f:
+            meta = f.read().strip()
+        os.remove(os.path.join(watch_dir, 'ctx'))
+        if meta and (ctx := json.loads(meta)):
+            data['ctx'] = ctx
+    if 'quit' in os.listdir(watch_dir):
+        os.remove(os.path.join(watch_dir, 'quit'))
+        data['quit'] = True
+    if 'id' in os.listdir(watch_dir):
+        data['id'] = read_ids(os.path.join(watch_dir, 'id'))[0]
+        os.remove(os.path.join(watch_dir, 'id'))
+        skip_ids(watch_dir, data['id'])
+    if session is not None:
+        data['session'] = session
+    if TRACE:
+        data['trace'] = dict(watch=watch, read=time.perf_counter() - t0)
+    return data
+
 async def monitor_directory():
     async for changes in awatch(WATCH_DIR):
-        found_files = {os.path.basename(f) for _, f in changes}
-        if IN_FILES[-1] in found_files and set(IN_FILES).issubset(set(os.listdir(WATCH_DIR))):
-            data = {}
-            for file in IN_FILES:
-                path = os.path.join(WATCH_DIR, file)
-                with open(path, 'r', encoding='utf-8') as f:
-                    data[file] = f.read()
-                os.remove(os.path.join(WATCH_DIR, file))
-            if 'followup' in os.listdir(WATCH_DIR):
-                os.remove(os.path.join(WATCH_DIR, 'followup'))
-                data['followup'] = True
-            if 'fim' in os.listdir(WATCH_DIR):
-                os.remove(os.path.join(WATCH_DIR, 'fim'))
-                data['fim'] = True
-            if 'quit' in os.listdir(WATCH_DIR):
-                os.remove(os.path.join(WATCH_DIR, 'quit'))
-                data['quit'] = True
-            await process_files(data)
-
-async def process_files(data):
+        if data := read_request(WATCH_DIR, {os.path.basename(f) for _, f in changes}):
+            SCHEDULER.submit(data)
+
+CLIENTS = {}
+LOOP = None
+
+def notify(msg, session=None):
+    if LOOP is None or not CLIENTS:
+        return
+    LOOP.call_soon_threadsafe(broadcast, json.dumps([0, msg]).encode('utf-8'), session)
+
+class ResponseTail:
+    def __init__(self, interval=0.02, flush_bytes=OUT_FLUSH_BYTES, watch_dir=None, session=None):
+        self.interval = interval
+        self.watch_dir = watch_dir
+        self.session = session
+        self.closed = False
+        self.flush_bytes = flush_bytes
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.offset = 0
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.parser = ResponseParser()
+        self.published = None
+        self.first = None
+        self.thread = None
+        self.file = None
+        self.path = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.replace = False
+        self.since = None
+        self.flushes = 0
+
+    @property
+    def out_path(self):
+        return OUT_PATH if self.watch_dir is None else os.path.join(self.watch_dir, OUT_FILE)
+
+    def handle(self):
+        if self.file is None or self.path != self.out_path:
+            if self.file is not None:
+                self.file.close()
+            self.path = self.out_path
+            self.file = open(self.path, 'ab')
+        return self.file
+
+    def write(self, s, mode):
+        with self.lock:
+            if mode == 'w':
+                self.pending, self.pending_bytes, self.replace = [], 0, True
+            self.pending.append(s)
+            self.pending_bytes += len(s)
+            if self.since is None:
+                self.since = time.monotonic()
+            deferred = self.active.is_set() and self.thread is not None and self.thread.is_alive()
+            if deferred and self.pending_bytes < self.flush_bytes and time.monotonic() - self.since < self.interval:
+                return
+            out = self._flush()
+        self.emit(out)
+
+    def _flush(self):
+        if self.since is None:
+            return None
+        text, replace = ''.join(self.pending), self.replace
+        self.pending, self.pending_bytes, self.replace, self.since = [], 0, False, None
+        f = self.handle()
+        if replace:
+            f.truncate(0)
+        f.write(text.encode('utf-8'))
+        f.flush()
+        self.offset = f.tell()
+        self.flushes += 1
+        self.utf8.reset()
+        if replace:
+            self.parser.reset()
+        self.parser.feed(text)
+        return ('w' if replace else 'a'), text
+
+    def emit(self, out):
+        if out is not None:
+            notify(dict(type='out', mode=out[0], text=out[1]), self.session)
+            self.publish()
+
+    def flush(self):
+        with self.lock:
+            out = self._flush()
+        self.emit(out)
+
+    def finish(self, text=None):
+        self.poll()
+        if text is None:
+            return
+        data = text.encode('utf-8')
+        with self.lock:
+            try:
+                with open(self.out_path, 'rb') as f:
+                    if f.read() == data:
+                        return
+            except FileNotFoundError:
+                pass
+            write_atomic(self.out_path, text)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.offset = len(data)
+            self.utf8.reset()
+            self.parser.reset()
+            self.parser.feed(text)
+        self.emit(('w', text))
+
+    def poll(self):
+        self.flush()
+        with self.lock:
+            try:
+                with open(self.out_path, 'rb') as f:
+                    size = f.seek(0, os.SEEK_END)
+                    if size == self.offset:
+                        return
+                    mode = 'w' if size < self.offset else 'a'
+                    f.seek(0 if mode == 'w' else self.offset)
+                    delta = f.read()
+            except FileNotFoundError:
+                return
+            self.offset = size
+            if self.first is None:
+                self.first = time.perf_counter()
+            if mode == 'w':
+                self.utf8.reset()
+                self.parser.reset()
+            text = self.utf8.decode(delta)
+            self.parser.feed(text)
+        notify(dict(type='out', mode=mode, text=text), self.session)
+        self.publish()
+
+    def model(self, final=False):
+        self.poll()
+        with self.lock:
+            return self.parser.model(final)
+
+    def publish(self, final=False):
+        with self.lock:
+            key = (self.parser.version, len(self.parser.blocks), final)
+            if key == self.published:
+                return
+            self.published = key
+            model = self.parser.model(final)
+            try:
+                write_atomic(os.path.join(self.watch_dir or WATCH_DIR, MODEL_FILE), json.dumps(model))
+            except OSError as e:
+                tolog(f'Failed to publish response model due to {e}', 'tail')
+        notify(dict(type='blocks', **model), self.session)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.closed = True
+        self.active.set()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _worker(self):
+        while not self.closed:
+            self.active.wait()
+            try:
+                self.poll()
+            except OSError as e:
+                tolog(f'Failed to poll {self.out_path} due to {e}', 'tail')
+            time.sleep(self.interval)
+
+TAIL = ResponseTail()
+
+def broadcast(payload, session=None):
+    for writer, sid in list(CLIENTS.items()):
+        if writer.is_closing():
+            CLIENTS.pop(writer, None)
+        elif session is None or sid == session:
+            writer.write(payload)
+
+def handle_message(msg, writer):
+    msg_id, payload = msg if isinstance(msg, list) and len(msg) == 2 else (0, msg)
+    if not isinstance(payload, dict):
+        tolog(f'Ignored malformed message {msg}', 'socket')
+        return
+    session = payload.get('session') or None
+    if session is not None and session not in SESSIONS and open_session(session) is None:
+        tolog(f'Ignored message for unknown session {session}', 'socket')
+        return
+    if session is None and DAEMON_MODE and not set(payload) <= {'session'}:
+        tolog(f'Rejected message without a session {msg_id}', 'socket')
+        if 'cancel' not in payload:
+            writer.write(json.dumps([msg_id, dict(type='done', id=payload.get('id', msg_id), status='rejected')]).encode('utf-8'))
+        return
+    CLIENTS[writer] = session
+    if 'cancel' in payload:
+        SCHEDULER.cancel(payload['cancel'], session)
+        return
+    if set(payload) <= {'session'}:
+        return
+    data = {file: payload.get(file, '') for file in IN_FILES}
+    for flag in ('followup', 'fim'):
+        if payload.get(flag):
+            data[flag] = True
+    if isinstance(payload.get('fim'), dict):
+        receive_fim(data, payload['fim'])
+    if isinstance(payload.get('ctx'), dict) and payload['ctx']:
+        data['ctx'] = payload['ctx']
+    data['id'] = payload.get('id', msg_id)
+    data['transport'] = 'socket'
+    if session is not None:
+        data['session'] = session
+    req = SCHEDULER.submit(data)
+    writer.write(json.dumps([msg_id, dict(type='queued', seq=req.seq)]).encode('utf-8'))
+
+async def handle_client(reader, writer):
+    CLIENTS[writer] = None
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buf = ''
+    try:
+        while chunk := await reader.read(65536):
+            buf += utf8.decode(chunk)
+            while buf := buf.lstrip():
+                try:
+                    msg, end = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    break
+                buf = buf[end:]
+                handle_message(msg, writer)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        CLIENTS.pop(writer, None)
+        writer.close()
+
+async def serve_socket(sock_path=None):
+    global LOOP
+    sock_path = SOCK_PATH if sock_path is None else sock_path
+    LOOP = asyncio.get_running_loop()
+    TAIL.start()
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = await asyncio.start_unix_server(handle_client, path=sock_path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+
+class PrefixCache:
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.saved_tokens = self.prompt_tokens = 0
+
+    @staticmethod
+    def supported(model):
+        return callable(getattr(model, 'snapshot', None)) and callable(getattr(model, 'restore', None))
+
+    def key(self, prefix):
+        return content_digest(LLM_MODEL, prefix)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        path = self.spill_path(key)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                os.remove(path)
+                self.put(key, entry)
+                return entry
+            except Exception as e:
+                tolog(f'Failed to load {path} due to {e}', 'prefix_cache')
+        return None
+
+    def put(self, key, entry):
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.used -= self.entries.pop(key)[1]
+            self.entries[key] = entry
+            self.used += entry[1]
+            while self.used > self.max_bytes and len(self.entries) > 1:
+                old_key, old = self.entries.popitem(last=False)
+                self.used -= old[1]
+                evicted.append((old_key, old))
+        for old_key, old in evicted:
+            self.spill(old_key, old)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key) if self.spill_dir else None
+
+    def spill(self, key, entry):
+        if not self.spill_dir:
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(self.spill_path(key), 'wb') as f:
+                pickle.dump(entry, f)
+            files = sorted((e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.spill_dir))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+        except Exception as e:
+            tolog(f'Failed to spill {key} due to {e}', 'prefix_cache')
+
+    def restore(self, model, prefixes, ntok):
+        if not self.supported(model) or not prefixes:
+            return 0
+        self.prompt_tokens += ntok
+        for prefix in reversed(prefixes):
+            entry = self.get(self.key(prefix))
+            if entry is not None and model.restore(entry[0]) is not False:
+                self.hits += 1
+                self.saved_tokens += entry[2]
+                return entry[2]
+        self.misses += 1
+        return 0
+
+    def update(self, model, prefixes):
+        if not self.supported(model):
+            return
+        for prefix in prefixes:
+            key = self.key(prefix)
+            with self.lock:
+                if key in self.entries:
+                    continue
+            snap = model.snapshot(prefix)
+            if snap is not None:
+                self.put(key, snap)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(entries=len(self.entries), mb=round(self.used / 2**20, 1), hits=self.hits, misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 3) if lookups else 0.0, saved_prefill_tokens=self.saved_tokens, prompt_tokens=self.prompt_tokens)
+
+PREFIX_CACHE = PrefixCache(KV_CACHE_MB * 2**20, os.path.join(VIMLM_DIR, KV_DIR) if KV_SPILL else None)
+
+FORMAT_HISTORY = 'Here is our conversation so far:\n\n---\n\n{history}\n\n---\n\n'
+FORMAT_COMPACT = '{history}\n\n---\n\nPlease provide a succint bullet point summary of the conversation above, keeping any decisions, file names and identifiers:'
+
+class Conversation:
+    def __init__(self, budget=HISTORY_TOKENS, mode=HISTORY_COMPACT):
+        self.budget = budget
+        self.mode = mode
+        self.compactions = self.summarized = self.dropped = self.summary_tokens = 0
+        self.reset()
+
+    def reset(self):
+        self.turns = deque()
+        self.summary = ''
+        self.summary_ntok = 0
+        self.preamble = ''
+        self.ntok = 0
+        self.synced = True
+
+    def invalidate(self):
+        self.synced = False
+
+    def render(self, turns):
+        parts = [f'**Summary of earlier turns**\n\n{self.summary}'] if self.summary else []
+        parts += [f'**User**\n\n{prompt}\n\n**Assistant**\n\n{text}' for prompt, text, _ in turns]
+        return '\n\n'.join(parts)
+
+    def prepare(self, prompt, ntok, max_new, counter):
+        if self.ntok + ntok + max_new > self.budget:
+            self.compact(ntok + max_new, counter)
+        elif not self.synced and self.turns:
+            self.compact(ntok + max_new, counter, force=False)
+        return self.preamble + prompt
+
+    def compact(self, need, counter, force=True):
+        keep, total = deque(), 0
+        target = max(0, self.budget // 2 - need) if force else self.budget - need
+        for turn in reversed(self.turns):
+            if total + turn[2] > target:
+                break
+            keep.appendleft(turn)
+            total += turn[2]
+        old = list(self.turns)[:len(self.turns) - len(keep)]
+        if old and self.mode == 'summary' and ENGINE is not None:
+            prompt = FORMAT_COMPACT.format(history=self.render(old))
+            self.summary = ENGINE.submit(prompt, max(64, self.budget // 16)).result().strip()
+            self.summary_ntok = counter(self.summary)
+            self.summary_tokens += counter(prompt) + self.summary_ntok
+            self.summarized += len(old)
+        elif old:
+            self.dropped += len(old)
+        self.compactions += bool(old)
+        self.turns = keep
+        chat.reset()
+        history = self.render(keep)
+        self.preamble = FORMAT_HISTORY.format(history=history) if history else ''
+        self.ntok = counter(self.preamble) if self.preamble else 0
+        self.synced = True
+
+    def record(self, prompt, text, ntok, counter):
+        n = counter(text) + ntok - (counter(self.preamble) if self.preamble else 0)
+        self.turns.append([prompt[len(self.preamble):], text, n])
+        self.ntok += n
+        self.preamble = ''
+        self.synced = True
+
+    def extend(self, text, counter):
+        if self.turns:
+            n = counter(text)
+            self.turns[-1][1] += text
+            self.turns[-1][2] += n
+            self.ntok += n
+
+    def stats(self):
+        return dict(turns=len(self.turns), ntok=self.ntok, budget=self.budget, summary_ntok=self.summary_ntok,
+                    compactions=self.compactions, summarized=self.summarized, dropped=self.dropped, summary_tokens=self.summary_tokens, synced=self.synced)
+
+CONVERSATION = Conversation()
+
+class ChatBackend:
+    def __init__(self, model, factory=None):
+        self.model = model
+        self.factory = factory
+        self.worker = None
+
+    def generate(self, prompts, max_new):
+        if callable(getattr(self.model, 'batch_generate', None)):
+            return self.model.batch_generate(prompts, max_new)
+        if self.worker is None:
+            if self.factory is None:
+                raise RuntimeError('Engine needs a model with batch_generate or a separate worker model')
+            self.worker = self.factory()
+        texts = []
+        for prompt, n in zip(prompts, max_new):
+            self.worker.reset()
+            texts.append(self.worker(prompt, max_new=n, verbose=False, stream=False)['text'])
+        return texts
+
+class OpenAIBackend:
+    def __init__(self, base_url, model=None, timeout=600):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.model = model
+        self.timeout = timeout
+
+    def complete(self, prompt, max_new):
+        body = json.dumps(dict(model=self.model, messages=[dict(role='user', content=prompt)], max_tokens=max_new)).encode('utf-8')
+        req = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.load(resp)['choices'][0]['message']['content']
+
+    def generate(self, prompts, max_new):
+        with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+            return list(pool.map(self.complete, prompts, max_new))
+
+class Engine:
+    def __init__(self, backend, max_batch=BATCH_SIZE):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.batches = self.sequences = 0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, max_new=NUM_TOKEN):
+        future = Future()
+        self.queue.put((prompt, max_new, future))
+        return future
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                texts = self.backend.generate([p for p, _, _ in batch], [n for _, n, _ in batch])
+                for (_, _, future), text in zip(batch, texts):
+                    future.set_result(text)
+            except Exception as e:
+                tolog(repr(e), 'engine')
+                for _, _, future in batch:
+                    future.set_exception(e)
+            self.batches += 1
+            self.sequences += len(batch)
+
+SPEC_STATS = dict(calls=0, proposed=0, accepted=0, generated=0, target_calls=0)
+
+def speculate(target, draft, ids, max_new, k=DRAFT_TOKENS, k_max=16, on_tokens=None):
+    ids, out = list(ids), []
+    proposed = accepted = target_calls = 0
+    while len(out) < max_new:
+        guess = draft.propose(ids, min(k, max_new - len(out)))
+        preds = target.verify(ids, guess)
+        target_calls += 1
+        n = 0
+        while n < len(guess) and guess[n] == preds[n]:
+            n += 1
+        new = guess[:n] + [preds[n]]
+        proposed += len(guess)
+        accepted += n
+        if target.eos in new:
+            new = new[:new.index(target.eos)]
+            out += new
+            if on_tokens and new:
+                on_tokens(new)
+            break
+        new = new[:max_new - len(out)]
+        ids += new
+        out += new
+        if on_tokens:
+            on_tokens(new)
+        if is_cancelled():
+            break
+        yield_to_fim()
+        k = min(k + 1, k_max) if n == len(guess) else max(1, k - 1) if n < len(guess) // 2 else k
+    stats = dict(proposed=proposed, accepted=accepted, generated=len(out), target_calls=target_calls)
+    for key, value in stats.items():
+        SPEC_STATS[key] += value
+    SPEC_STATS['calls'] += 1
+    tolog(dict(stats, acceptance=round(accepted / proposed, 3) if proposed else 0.0, last_k=k), 'speculative')
+    return out
+
+class SpeculativeChat:
+    def __init__(self, target, draft, k=DRAFT_TOKENS):
+        self.target = target
+        self.draft = draft
+        self.k = k
+        self.stop = None
+
+    @staticmethod
+    def supported(target, draft):
+        return all(callable(getattr(target, a, None)) for a in ('encode', 'decode', 'verify', 'commit')) and callable(getattr(draft, 'propose', None))
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def reset(self):
+        self.target.reset()
+        self.stop = None
+
+    def __call__(self, prompt, max_new=NUM_TOKEN, verbose=False, stream=None):
+        return self.generate(prompt, max_new, stream)
+
+    def resume(self, max_new=NUM_TOKEN, verbose=False, stream=None):
+        if self.stop != 'length':
+            return dict(text='', stop=self.stop)
+        return self.generate('', max_new, stream)
+
+    def generate(self, prompt, max_new, stream):
+        f = open(stream, 'a', encoding='utf-8') if stream else None
+        def write(tokens):
+            f.write(self.target.decode(tokens))
+            f.flush()
+        try:
+            ids = speculate(self.target, self.draft, self.target.encode(prompt), max_new, self.k, on_tokens=write if f else None)
+        finally:
+            if f:
+                f.close()
+        text = self.target.decode(ids)
+        self.target.commit(prompt, text)
+        self.stop = 'length' if len(ids) == max_new else 'stop'
+        return dict(text=text, stop=self.stop)
+
+MLX_CHAT_ATTRS = ('model', 'tokenizer', 'prompt_cache', 'repo_cache', 'dict_repo', 'hx_toks', 'ongoing', 'output_toks', 'toks', 'stop', 'think_end')
+
+class MLXChat:
+    def __init__(self, chat, k=DRAFT_TOKENS):
+        self.chat = chat
+        self.k = k
+        self.draft = None
+        self.first = None
+        self.restored = None
+        self.repo_head = None
+        self.repo_digests = []
+        self.repo_offsets = []
+
+    @staticmethod
+    def supported(chat):
+        import inspect
+        try:
+            params = inspect.signature(chat.generate).parameters
+        except (AttributeError, TypeError, ValueError):
+            return False
+        return {'inputs', 'toks', 'max_new', 'verbose', 'stream'} <= set(params) and all(hasattr(chat, a) for a in MLX_CHAT_ATTRS)
+
+    def __getattr__(self, name):
+        return getattr(self.chat, name)
+
+    def encode(self, prompt):
+        tokenizer = self.chat.tokenizer
+        if tokenizer.chat_template is None:
+            return tokenizer.encode(prompt)
+        return tokenizer.apply_chat_template([dict(role='user', content=prompt)], add_generation_prompt=True)
+
+    def caches(self, cache=None):
+        cache = self.chat.prompt_cache if cache is None else cache
+        if self.draft is None:
+            return [cache]
+        n = len(self.chat.model.layers)
+        return [cache[:n], cache[n:]]
+
+    def set_draft(self, draft):
+        model = getattr(getattr(draft, 'chat', None), 'model', None)
+        if model is None or getattr(draft.tokenizer, 'vocab_size', None) != getattr(self.chat.tokenizer, 'vocab_size', None):
+            return False
+        self.draft = model
+        self.reset()
+        if not self.trimmable():
+            self.draft = None
+            self.reset()
+            return False
+        return True
+
+    def trimmable(self):
+        from mlx_lm.models.cache import can_trim_prompt_cache
+        return can_trim_prompt_cache(self.chat.prompt_cache)
+
+    def align(self):
+        if not self.trimmable():
+            return
+        from mlx_lm.models.cache import trim_prompt_cache
+        n = len(self.chat.hx_toks)
+        for cache in self.caches():
+            if cache and cache[0].offset > n:
+                trim_prompt_cache(cache, cache[0].offset - n)
+
+    def reset(self):
+        self.chat.reset()
+        if self.draft is not None:
+            from mlx_lm.models.cache import make_prompt_cache
+            self.chat.prompt_cache += make_prompt_cache(self.draft)
+        self.first = None
+        self.restored = None
+
+    def snapshot(self, prefix):
+        c = self.chat
+        if self.first is None or not self.first.startswith(prefix) or not self.trimmable():
+            return None
+        from mlx_lm.models.cache import trim_prompt_cache, KVCache
+        import mlx.core as mx
+        if c.tokenizer.chat_template is None:
+            toks = c.tokenizer.encode(prefix)
+        else:
+            text = c.tokenizer.apply_chat_template([dict(role='user', content=self.first)], add_generation_prompt=True, tokenize=False)
+            toks = c.tokenizer.encode(text[:text.index(self.first) + len(prefix)], add_special_tokens=False)
+        n = 0
+        while n < min(len(toks), len(c.hx_toks)) and toks[n] == c.hx_toks[n]:
+            n += 1
+        n -= 1
+        if n <= 0 or any(cache[0].offset < n for cache in self.caches()):
+            return None
+        state = copy.deepcopy(c.prompt_cache)
+        for cache in self.caches(state):
+            trim_prompt_cache(cache, cache[0].offset - n)
+        for entry in state:
+            if isinstance(entry, KVCache) and entry.keys is not None:
+                entry.state = entry.state
+        mx.eval([entry.state for entry in state])
+        return (state, c.hx_toks[:n]), sum(entry.nbytes for entry in state), n
+
+    def restore(self, state):
+        if self.chat.hx_toks:
+            return False
+        self.chat.prompt_cache = copy.deepcopy(state[0])
+        self.restored = list(state[1])
+
+    def prefill(self, cache, text, first=False, step=2048):
+        import mlx.core as mx
+        c = self.chat
+        toks = c.tokenizer.encode(text) if first else c.tokenizer.encode(text, add_special_tokens=False)
+        for i in range(0, len(toks), step):
+            c.model(mx.array(toks[i:i + step])[None], cache=cache)
+            mx.eval([entry.state for entry in cache])
+        return len(toks)
+
+    def set_cache_repo(self, dict_repo, cache_dir='', max_kv_size=None):
+        c = self.chat
+        if not dict_repo or 'list_digest' not in dict_repo or max_kv_size is not None:
+            self.repo_head, self.repo_digests, self.repo_offsets = None, [], []
+            return c.set_cache_repo(dict_repo, cache_dir=cache_dir, max_kv_size=max_kv_size)
+        from mlx_lm.models.cache import make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache
+        head, digests, content = dict_repo['list_content'][0], dict_repo['list_digest'], dict_repo['list_content'][1:]
+        rebuild = c.repo_cache is None or head != self.repo_head or not self.repo_offsets
+        keep = 0 if rebuild else shared_prefix(self.repo_digests, digests)
+        if not rebuild and keep < len(self.repo_digests) and not can_trim_prompt_cache(c.repo_cache):
+            rebuild, keep = True, 0
+        if rebuild:
+            c.repo_cache = make_prompt_cache(c.model)
+            self.repo_head, self.repo_offsets = head, [self.prefill(c.repo_cache, head, first=True)]
+        offsets = self.repo_offsets[:keep + 1]
+        if c.repo_cache[0].offset > offsets[-1]:
+            trim_prompt_cache(c.repo_cache, c.repo_cache[0].offset - offsets[-1])
+        for text in content[keep:]:
+            offsets.append(offsets[-1] + self.prefill(c.repo_cache, text))
+        self.repo_digests, self.repo_offsets = list(digests), offsets
+        c.dict_repo = dict_repo
+        tolog(dict(kept=keep, prefilled=len(content) - keep, tokens=offsets[-1] - offsets[keep]), 'repo_cache')
+
+    def batch_generate(self, prompts, max_new):
+        c = self.chat
+        toks = [self.encode(prompt) for prompt in prompts]
+        try:
+            from mlx_lm import batch_generate
+        except ImportError:
+            from mlx_lm import generate
+            from mlx_lm.models.cache import make_prompt_cache
+            texts = [generate(c.model, c.tokenizer, prompt=t, max_tokens=n, prompt_cache=make_prompt_cache(c.model)) for t, n in zip(toks, max_new)]
+        else:
+            texts = batch_generate(c.model, c.tokenizer, toks, max_tokens=list(max_new)).texts
+        return [text.split(c.think_end)[-1].strip() for text in texts]
+
+    def stream(self, toks, max_new):
+        from mlx_lm import stream_generate
+        c = self.chat
+        if self.draft is None:
+            return self.tokens(stream_generate(c.model, c.tokenizer, prompt=toks, max_tokens=max_new, prompt_cache=c.prompt_cache))
+        return self.tokens(self.count(stream_generate(c.model, c.tokenizer, prompt=toks, max_tokens=max_new, prompt_cache=c.prompt_cache, draft_model=self.draft, num_draft_tokens=self.k)))
+
+    def tokens(self, responses):
+        for response in responses:
+            yield response
+            yield_to_fim()
+
+    def count(self, responses, k_max=16):
+        k, run = self.k, 0
+        stats = dict(proposed=0, accepted=0, generated=0, target_calls=0)
+        try:
+            for response in responses:
+                stats['generated'] += 1
+                if response.from_draft:
+                    stats['accepted'] += 1
+                    run += 1
+                else:
+                    stats['target_calls'] += 1
+                    run = 0
+                yield response
+        finally:
+            stats['target_calls'] += bool(run)
+            stats['proposed'] = stats['target_calls'] * k
+            for key, value in stats.items():
+                SPEC_STATS[key] += value
+            SPEC_STATS['calls'] += 1
+            acceptance = stats['accepted'] / stats['proposed'] if stats['proposed'] else 0.0
+            if stats['proposed']:
+                self.k = min(k + 1, k_max) if acceptance >= 0.9 else max(1, k - 1) if acceptance < 0.5 else k
+            tolog(dict(stats, acceptance=round(acceptance, 3), k=k, next_k=self.k), 'speculative')
+
+    def __call__(self, inputs, max_new=NUM_TOKEN, verbose=False, stream=None):
+        c = self.chat
+        prompt = inputs if isinstance(inputs, str) else inputs[0]
+        toks, feed = self.encode(prompt), None
+        restored, self.restored = self.restored, None
+        if restored is not None and len(restored) < len(toks) and toks[:len(restored)] == restored:
+            feed = toks[len(restored):]
+        else:
+            if restored is not None:
+                self.reset()
+            self.align()
+        if not c.hx_toks:
+            self.first = prompt
+        c.output_toks = []
+        c.hx_toks += toks
+        c.ongoing = self.stream(toks if feed is None else feed, max_new)
+        return c.generate(inputs=prompt, toks=toks, max_new=max_new, verbose=verbose, stream=stream)
+
+    def resume(self, max_new=NUM_TOKEN, verbose=False, stream=None):
+        c = self.chat
+        if c.stop != 'length' or c.ongoing is None:
+            return dict(text='', output='', hx='', benchmark='n/a', stop=c.stop)
+        self.align()
+        c.hx_toks += c.toks.tolist()
+        c.ongoing = self.stream(c.toks, max_new)
+        return c.generate(inputs='', toks=c.toks, max_new=max_new, verbose=verbose, stream=stream)
+
+def make_engine(model, make_chat=None):
+    if ENGINE_BACKEND == 'openai':
+        return Engine(OpenAIBackend(OPENAI_BASE_URL, LLM_MODEL))
+    make_chat = make_model if make_chat is None else make_chat
+    return Engine(ChatBackend(model, lambda: make_chat(LLM_MODEL, think=THINK)))
+
+ENGINE = None
+
+READY = threading.Event()
+LOAD_ERROR = None
+
+def make_model(model_path, backend=None, **kwargs):
+    backend = MODEL_BACKEND if backend is None else backend
+    if backend == 'stub':
+        return StubChat(**dict(STUB_MODEL, **kwargs))
+    if backend == 'mlx':
+        if model_path is None:
+            import nanollama
+            return nanollama.Chat(model_path='uncn_llama_32_3b_it')
+        import mlx_lm_utils
+        model = mlx_lm_utils.Chat(model_path=model_path, **kwargs)
+        if MLXChat.supported(model):
+            return MLXChat(model)
+        tolog(f'mlx_lm_utils.Chat lacks {[a for a in MLX_CHAT_ATTRS if not hasattr(model, a)]} or generate(inputs, toks, ...); prefix cache, draft model and incremental repo cache are off', 'load_models')
+        return model
+    module, _, name = backend.partition(':')
+    import importlib
+    return getattr(importlib.import_module(module), name or 'Chat')(model_path=model_path, **kwargs)
+
+def load_models(dict_repo, make_chat=None, tail=None, watch_dir=None):
+    make_chat = make_model if make_chat is None else make_chat
+    tail, watch_dir = TAIL if tail is None else tail, WATCH_DIR if watch_dir is None else watch_dir
+    try:
+        toout('Loading LLM...', tail=tail)
+        globals()['chat'] = make_chat(LLM_MODEL, think=THINK)
+        toout(f'{LLM_MODEL.split("/")[-1] if LLM_MODEL else "LLM"} is ready', tail=tail)
+        if FIM_MODEL and FIM_MODEL != LLM_MODEL:
+            globals()['fim'] = make_chat(FIM_MODEL, cache_dir=VIMLM_DIR, dict_repo=dict_repo)
+            toout(f'\n\n{FIM_MODEL.split("/")[-1]} is ready', mode='a', tail=tail)
+        else:
+            globals()['fim'] = chat
+            chat.set_cache_repo(dict_repo, cache_dir=VIMLM_DIR)
+        if SPECULATIVE and fim is not chat:
+            if SpeculativeChat.supported(chat, fim):
+                globals()['chat'] = SpeculativeChat(chat, fim)
+            elif not (callable(getattr(chat, 'set_draft', None)) and chat.set_draft(fim)):
+                tolog('Speculative decoding needs two MLX models with the same tokenizer and a trimmable cache', 'load_models')
+        globals()['ENGINE'] = make_engine(chat, make_chat)
+    except Exception as e:
+        globals()['LOAD_ERROR'] = e
+        toout(f'Failed to load models: {e}', tail=tail)
+        tolog(repr(e), 'load_models')
+    finally:
+        if os.path.isdir(watch_dir):
+            write_ready(watch_dir)
+        sessions = list(SESSIONS.values())
+        for session in sessions:
+            session.ready()
+        READY.set()
+        for session in list(SESSIONS.values()):
+            if session not in sessions:
+                session.ready()
+
+def write_ready(watch_dir):
+    with open(os.path.join(watch_dir, 'ready'), 'w') as f:
+        f.write('ready' if LOAD_ERROR is None else 'failed')
+
+def load_status():
+    if LOAD_ERROR is not None:
+        return f'Failed to load models: {LOAD_ERROR}'
+    return '\n\n'.join(f'{name.split("/")[-1] if name else "LLM"} is ready' for name in dict.fromkeys([LLM_MODEL, FIM_MODEL or LLM_MODEL]))
+
+def start_models(dict_repo, make_chat=None):
+    thread = threading.Thread(target=load_models, args=(dict_repo, make_chat, TAIL, WATCH_DIR), daemon=True)
+    thread.start()
+    return thread
+
+def wait_ready(tail=None):
+    while not READY.wait(0.1):
+        if is_cancelled():
+            return False
+    if LOAD_ERROR is not None:
+        toout(f'Failed to load models: {LOAD_ERROR}', tail=tail)
+        return False
+    return True
+
+def process_files(data):
     tolog(f'process_files i {data=}')
+    session = SESSIONS.get(data.get('session'))
+    if not wait_ready(None if session is None else session.tail):
+        return
+    if session is not None:
+        activate(session, SCHEDULER.classify(data))
+    TAIL.active.set()
     str_template = '{include}'
-    data = process_command(data)
-    if len(data['user_prompt']) == 0:
-        if 'wip' in os.listdir(WATCH_DIR):
-            os.remove(os.path.join(WATCH_DIR, 'wip'))
+    with span('command'):
+        data = process_command(data)
+    if len(data['user_prompt']) == 0 or is_cancelled():
         return    
+    cuts = [len(data['include'])]
     if len(data['file']) > 0:
         str_template += '**{file}**\n'
     if len(data['context']) > 0 and data['yank'] != data['context']:
         str_template += '```{ext}\n{context}\n```\n\n'
+        cuts.append(len(str_template.format(**data)))
     if len(data['yank']) > 0:
         if '\n' in data['yank']:
             str_template += "```{ext}\n{yank}\n```\n\n"
@@ -444,29 +2359,460 @@ async def process_files(data):
     prompt = str_template.format(**data)
     tolog(prompt, 'tollm')
     toout('')
-    max_new = data['max_new'] if 'max_new' in data else max(10, NUM_TOKEN - chat.get_ntok(prompt))
-    response = chat(prompt, max_new=max_new, verbose=False, stream=OUT_PATH)
-    if SHOW_USER:
-        toout(response['text'])
+    TAIL.flush()
+    counter = get_counter(chat)
+    ntok = counter(prompt)
+    max_new = data['max_new'] if 'max_new' in data else max(10, NUM_TOKEN - ntok)
+    if data['fresh']:
+        prefixes = [prompt[:i] for i in dict.fromkeys(cuts) if 0 < i < len(prompt)]
     else:
-        toout(response['text'])
+        prompt = CONVERSATION.prepare(prompt, ntok, max_new, counter)
+        prefixes = [CONVERSATION.preamble] if CONVERSATION.preamble else []
+        ntok = counter(prompt)
+    with span('prefix_cache'):
+        restored = PREFIX_CACHE.restore(chat, prefixes, ntok)
+    TAIL.first = None
+    t0 = time.perf_counter()
+    with span('generate'):
+        response = chat(prompt, max_new=max_new, verbose=False, stream=OUT_PATH)
+    if TRACE:
+        t1, first = time.perf_counter(), TAIL.first
+        if first is not None and t0 < first <= t1:
+            TRACE_LOCAL.spans.update(prefill=first - t0, decode=t1 - first)
+        trace_count(prefill_tokens=ntok - restored, decode_tokens=counter(response['text']))
+    with span('prefix_cache'):
+        PREFIX_CACHE.update(chat, prefixes)
+    CONVERSATION.record(prompt, response['text'], ntok, counter)
+    tolog(PREFIX_CACHE.stats(), 'prefix_cache')
+    tolog(CONVERSATION.stats(), 'conversation')
+    if not is_cancelled():
+        TAIL.finish(response['text'])
     tolog(response)
     if 'write_dest' in data:
         with open(data['write_dest'], 'w') as f:
             f.write(response['text'])
     if 'deploy_dest' in data:
-        deploy(dest=data['deploy_dest'], reformat=False)
-    if 'wip' in os.listdir(WATCH_DIR):
-        os.remove(os.path.join(WATCH_DIR, 'wip'))
+        with span('deploy'):
+            deploy(dest=data['deploy_dest'], reformat=False)
+
+PRIORITY = dict(fim=0, chat=1, ingest=2)
+
+class Request:
+    def __init__(self, data, kind, seq, vtime=0):
+        self.data = data
+        self.kind = kind
+        self.seq = seq
+        self.vtime = vtime
+        self.key = None if 'followup' in data or kind == 'ingest' else (kind, data.get('session'), data.get('tree', '').strip())
+        self.submitted = time.monotonic()
+        self.started = None
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (PRIORITY[self.kind], self.vtime, self.seq) < (PRIORITY[other.kind], other.vtime, other.seq)
+
+class Scheduler:
+    def __init__(self, handler, on_start=None, on_done=None, on_idle=None):
+        self.handler = handler
+        self.on_start = on_start
+        self.on_done = on_done
+        self.on_idle = on_idle
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.queued = {}
+        self.current = None
+        self.preempted = None
+        self.seq = 0
+        self.clock = 0
+        self.vtime = {}
+        self.waits = {kind: deque(maxlen=100) for kind in PRIORITY}
+        self.thread = None
+
+    def classify(self, data):
+        if 'fim' in data:
+            return 'fim'
+        cmds = [cmd.strip() for cmd in data.get('user', '').split(SEP_CMD)[1:]]
+        if cmds == [''] or any(cmd.startswith('include') for cmd in cmds):
+            return 'ingest'
+        return 'chat'
+
+    def submit(self, data):
+        with self.lock:
+            self.seq += 1
+            session = data.get('session')
+            self.vtime[session] = max(self.clock, self.vtime.get(session, 0)) + 1
+            req = Request(data, self.classify(data), self.seq, self.vtime[session])
+            if req.key is not None:
+                if req.key in self.pending:
+                    self.pending[req.key].cancelled = True
+                if self.current is not None and self.current.key == req.key:
+                    self.current.cancelled = True
+                self.pending[req.key] = req
+            self.queued[req.seq] = req
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+        self.queue.put(req)
+        return req
+
+    def cancel(self, ids=None, session=None):
+        with self.lock:
+            for req in [*self.queued.values(), self.current]:
+                if req is not None and (ids is None or req.data.get('id') in ids) and (session is None or req.data.get('session') == session):
+                    req.cancelled = True
+
+    def stats(self):
+        waits = {kind: dict(n=len(w), last=round(w[-1], 4), mean=round(sum(w)/len(w), 4), max=round(max(w), 4)) for kind, w in self.waits.items() if w}
+        current = None if self.current is None else self.current.kind
+        return dict(depth=self.queue.qsize(), current=current, wait=waits)
+
+    def preempt(self):
+        outer, ran = self.current, 0
+        if outer is None or outer.kind == 'fim' or threading.current_thread() is not self.thread:
+            return ran
+        while True:
+            with self.queue.mutex:
+                if not self.queue.queue or self.queue.queue[0].kind != 'fim':
+                    return ran
+            req = self.queue.get_nowait()
+            self.preempted = outer
+            try:
+                self.run(req)
+            finally:
+                with self.lock:
+                    self.current, self.preempted = outer, None
+            ran += 1
+
+    def run(self, req):
+        with self.lock:
+            if self.pending.get(req.key) is req:
+                del self.pending[req.key]
+            del self.queued[req.seq]
+            self.clock = max(self.clock, req.vtime - 1)
+            if not req.cancelled:
+                self.current = req
+        if req.cancelled:
+            tolog(f'superseded {req.kind} request {req.seq}', 'scheduler')
+        else:
+            req.started = time.monotonic()
+            self.waits[req.kind].append(req.started - req.submitted)
+            tolog(self.stats(), 'scheduler')
+            if self.on_start is not None:
+                self.on_start(req)
+            try:
+                self.handler(req.data)
+            except Exception as e:
+                tolog(f'{req.kind} request {req.seq} failed due to {e}', 'scheduler')
+            with self.lock:
+                self.current = None
+        if self.on_done is not None:
+            self.on_done(req)
+
+    def _worker(self):
+        while True:
+            self.run(self.queue.get())
+            if self.queue.empty() and self.on_idle is not None:
+                try:
+                    self.on_idle()
+                except Exception as e:
+                    tolog(f'on_idle failed due to {e}', 'scheduler')
+
+def on_start(req):
+    if TRACE:
+        trace_begin(req)
+
+def on_done(req):
+    sid = req.data.get('session')
+    session = SESSIONS.get(sid)
+    status = 'cancelled' if req.cancelled else req.data.get('status', 'done')
+    if TRACE and req.started is not None:
+        trace_end(req, status)
+    if session is None and (sid is not None or DAEMON_MODE):
+        return
+    tail, watch_dir = (TAIL, WATCH_DIR) if session is None else (session.tail, session.watch_dir)
+    ctx = req.data.get('ctx')
+    if ctx and ctx.get('snapshot') and os.path.dirname(ctx['path']) == watch_dir and os.path.exists(ctx['path']):
+        os.remove(ctx['path'])
+    if not chat_streaming(sid):
+        tail.poll()
+        tail.publish(final=True)
+    completion = req.data.get('completion') if status == 'done' else None
+    if req.data.get('transport') == 'socket':
+        notify(dict(type='done', id=req.data['id'], seq=req.seq, status=status, **({} if completion is None else dict(text=completion))), sid)
+    elif 'id' in req.data:
+        if completion is not None:
+            write_atomic(os.path.join(watch_dir, f'fim_{req.data["id"]}'), completion)
+        write_atomic(os.path.join(watch_dir, f'done_{req.data["id"]}'), status)
+
+def on_idle():
+    TAIL.active.clear()
+    for session in list(SESSIONS.values()):
+        session.tail.active.clear()
+
+SCHEDULER = Scheduler(process_files, on_start=on_start, on_done=on_done, on_idle=on_idle)
+
+def is_cancelled():
+    req = SCHEDULER.current
+    return req is not None and req.cancelled and threading.current_thread() is SCHEDULER.thread
+
+def chat_streaming(sid):
+    outer = SCHEDULER.preempted
+    return outer is not None and outer.data.get('session') == sid
+
+def yield_to_fim():
+    if not READY.is_set() or LOAD_ERROR is not None or fim is chat:
+        return
+    outer, trace = SCHEDULER.current, dict(vars(TRACE_LOCAL))
+    if SCHEDULER.preempt():
+        vars(TRACE_LOCAL).update(trace)
+        if session := SESSIONS.get(outer.data.get('session')):
+            activate(session, outer.kind)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Session:
+    def __init__(self, sid, watch_dir, spec):
+        self.sid = sid
+        self.watch_dir = watch_dir
+        self.pid = spec.get('pid')
+        self.cwd = spec.get('cwd') or os.getcwd()
+        self.tail = ResponseTail(watch_dir=watch_dir, session=sid)
+        self.conversation = Conversation()
+        self.repo, self.dict_repo = make_repo(spec.get('repo'))
+        self.repo_task = None
+
+    def open(self):
+        self.tail.start()
+        if self.repo is not None:
+            try:
+                self.repo_task = asyncio.get_running_loop().create_task(monitor_repo(self.repo))
+            except RuntimeError:
+                pass
+        if READY.is_set():
+            self.ready()
+        else:
+            self.tail.write('Loading models...', 'w')
+
+    def ready(self):
+        self.tail.write(load_status(), 'w')
+        write_ready(self.watch_dir)
+
+    def alive(self):
+        return self.pid is None or pid_alive(self.pid)
+
+    def close(self):
+        self.tail.stop()
+        if self.repo_task is not None:
+            self.repo_task.cancel()
+
+SESSIONS = {}
+OWNERS = dict(chat=None, fim=None)
+DAEMON_MODE = False
+
+def open_session(sid):
+    watch_dir = os.path.join(SESSIONS_DIR, sid)
+    try:
+        with open(os.path.join(watch_dir, SESSION_FILE), 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    session = SESSIONS[sid] = Session(sid, watch_dir, spec)
+    session.open()
+    tolog(dict(session=sid, pid=session.pid, sessions=len(SESSIONS)), 'session')
+    return session
+
+def close_session(sid):
+    session = SESSIONS.pop(sid, None)
+    if session is None:
+        return
+    SCHEDULER.cancel(session=sid)
+    SCHEDULER.vtime.pop(sid, None)
+    LAST_IDS.pop(session.watch_dir, None)
+    session.close()
+    shutil.rmtree(session.watch_dir, ignore_errors=True)
+    tolog(dict(session=sid, closed=True, sessions=len(SESSIONS)), 'session')
+
+def activate(session, kind):
+    globals().update(WATCH_DIR=session.watch_dir, OUT_PATH=session.tail.out_path, TAIL=session.tail, CONVERSATION=session.conversation, REPO=session.repo)
+    try:
+        os.chdir(session.cwd)
+    except OSError:
+        pass
+    model = 'fim' if kind == 'fim' else 'chat'
+    if OWNERS[model] not in (None, session.sid):
+        if model == 'chat':
+            session.conversation.invalidate()
+        elif session.repo is not None:
+            session.repo.selected, session.repo.handed = None, []
+        elif READY.is_set() and LOAD_ERROR is None:
+            fim.set_cache_repo(session.dict_repo, cache_dir=VIMLM_DIR)
+    OWNERS[model] = session.sid
+
+def new_session(spec):
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    watch_dir = os.path.join(SESSIONS_DIR, str(os.getpid()))
+    reset_dir(watch_dir)
+    write_atomic(os.path.join(watch_dir, SESSION_FILE), json.dumps(dict(pid=os.getpid(), cwd=os.getcwd(), repo=spec)))
+    return watch_dir
+
+def prune_dirs(parent):
+    for name in os.listdir(parent) if os.path.isdir(parent) else []:
+        if name.isdigit() and not pid_alive(int(name)):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+def poll_session(sid, found_files):
+    if not os.path.isdir(os.path.join(SESSIONS_DIR, sid)):
+        close_session(sid)
+        return
+    if (session := SESSIONS.get(sid)) is None:
+        if (session := open_session(sid)) is None:
+            return
+        found_files = {*found_files, 'cancel', IN_FILES[-1]}
+    if data := read_request(session.watch_dir, found_files, sid):
+        SCHEDULER.submit(data)
+
+async def monitor_sessions():
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    for sid in os.listdir(SESSIONS_DIR):
+        poll_session(sid, ())
+    async for changes in awatch(SESSIONS_DIR):
+        found = {}
+        for _, path in changes:
+            sid, _, name = os.path.relpath(path, SESSIONS_DIR).partition(os.sep)
+            found.setdefault(sid, set()).add(name)
+        for sid, found_files in found.items():
+            poll_session(sid, found_files)
+
+def daemon_running():
+    try:
+        f = open(DAEMON_PATH, 'r')
+    except FileNotFoundError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+    return False
+
+CLIENT_KEYS = ('USE_LEADER', 'KEY_MAP', 'SHOW_USER', 'TRANSPORT', 'DAEMON', 'TIMEOUT', 'FIM_TIMEOUT')
+
+def daemon_config():
+    return json.loads(json.dumps({k: globals()[k] for k in DEFAULTS if k not in CLIENT_KEYS}))
+
+def read_daemon(wait=1.0):
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            with open(DAEMON_PATH, 'r') as f:
+                pid, _, config = f.read().partition('\n')
+        except FileNotFoundError:
+            return None, None
+        if pid or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    try:
+        return int(pid), json.loads(config)
+    except ValueError:
+        return (int(pid) if pid.isdigit() else None), None
+
+def stop_daemon(pid, wait=10.0):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return True
+    deadline = time.monotonic() + wait
+    while daemon_running():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def ensure_daemon():
+    if daemon_running():
+        (pid, config), current = read_daemon(), daemon_config()
+        if config == current:
+            return False
+        tolog(dict(pid=pid, restart=sorted(k for k in current if (config or {}).get(k) != current[k])), 'daemon')
+        if pid is None or not stop_daemon(pid):
+            tolog(f'Could not stop daemon {pid}; reusing it', 'daemon')
+            return False
+    cmd = [sys.executable, os.path.abspath(__file__), '--daemon', '--backend', MODEL_BACKEND]
+    with open(os.path.join(VIMLM_DIR, 'daemon.log'), 'ab') as log:
+        subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    return True
+
+async def serve_daemon(idle=DAEMON_IDLE, interval=1.0):
+    tasks = [asyncio.create_task(monitor_sessions()), asyncio.create_task(serve_socket())]
+    last = time.monotonic()
+    try:
+        while not any(task.done() for task in tasks):
+            await asyncio.sleep(interval)
+            for sid, session in list(SESSIONS.items()):
+                if not session.alive():
+                    close_session(sid)
+            for key in [k for k in FIM_BUFFERS if not pid_alive(int(k.split(':')[0]))]:
+                FIM_BUFFERS.pop(key, None)
+            prune_dirs(SESSIONS_DIR)
+            if SESSIONS or os.listdir(SESSIONS_DIR) or SCHEDULER.current is not None:
+                last = time.monotonic()
+            elif time.monotonic() - last > idle:
+                tolog(f'No sessions for {idle}s, exiting', 'daemon')
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for sid in list(SESSIONS):
+            SESSIONS.pop(sid).close()
+
+def run_daemon():
+    os.makedirs(WATCH_DIR, exist_ok=True)
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    lock = open(DAEMON_PATH, 'a+')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return
+    lock.seek(0)
+    lock.truncate()
+    lock.write(f'{os.getpid()}\n{json.dumps(daemon_config())}')
+    lock.flush()
+    prune_dirs(SESSIONS_DIR)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    globals()['DAEMON_MODE'] = True
+    tolog(dict(pid=os.getpid(), backend=MODEL_BACKEND), 'daemon')
+    try:
+        start_models(None)
+        asyncio.run(serve_daemon())
+    finally:
+        lock.close()
 
 KEYL = KEY_MAP.get('l', 'l')
 KEYJ = KEY_MAP.get('j', 'j')
 KEYP = KEY_MAP.get('p', 'p')
-mapl, mapj, mapp = (f'<Leader>{KEYL}', f'<Leader>{KEYJ}', f'<Leader>{KEYP}') if USE_LEADER else (f'<C-{KEYL}>', f'<C-{KEYJ}>', f'<C-{KEYP}>')
+KEYC = KEY_MAP.get('c', 'c')
+mapl, mapj, mapp, mapc = (f'<Leader>{KEYL}', f'<Leader>{KEYJ}', f'<Leader>{KEYP}', f'<Leader>{KEYC}') if USE_LEADER else (f'<C-{KEYL}>', f'<C-{KEYJ}>', f'<C-{KEYP}>', f'<C-{KEYC}>')
 VIMLMSCRIPT = Template(r"""
 let s:register_names = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u'] 
 let s:watched_dir = expand('$WATCH_DIR')
+let s:sock_path = expand('$SOCK_PATH')
+let s:session = '$SESSION'
+let s:transport = '$TRANSPORT'
 let s:vimlm_enabled = 1
+let s:request_id = 0
+let s:pending = {}
+let s:completions = {}
+let s:loading = 1
 
 function! ToggleVimLM()
     if s:vimlm_enabled
@@ -477,10 +2823,7 @@ function! ToggleVimLM()
         if winid != -1
             execute winid . 'wincmd c'
         endif
-        if exists('s:monitor_timer')
-            call timer_stop(s:monitor_timer)
-            unlet s:monitor_timer
-        endif
+        call s:StopTimer()
         echohl WarningMsg | echom "VimLM disabled" | echohl None
     else
         let s:vimlm_enabled = 1
@@ -489,40 +2832,141 @@ function! ToggleVimLM()
     endif
 endfunction
 
+function! s:StartTimer()
+    if !exists('s:monitor_timer')
+        let s:monitor_timer = timer_start(100, 'CheckForUpdates', {'repeat': -1})
+    endif
+endfunction
+
+function! s:StopTimer()
+    if exists('s:monitor_timer')
+        call timer_stop(s:monitor_timer)
+        unlet s:monitor_timer
+    endif
+endfunction
+
 function! CheckForUpdates(timer)
     if !s:vimlm_enabled
+        call s:StopTimer()
         return
     endif
     let bufnum = bufnr(s:watched_dir . '/response.md')
     let winid = bufwinnr(bufnum)
     if winid == -1
-        call timer_stop(s:monitor_timer)
-        unlet s:monitor_timer
         call Monitor()
-    else
+        return
+    endif
+    call s:ReadDelta()
+    for done_file in glob(s:watched_dir . '/done_*', 1, 1)
+        let status = get(readfile(done_file), 0, '')
+        if empty(status)
+            continue
+        endif
+        call delete(done_file)
+        let id = matchstr(done_file, '\d\+$')
+        let fim_file = s:watched_dir . '/fim_' . id
+        let text = filereadable(fim_file) ? join(readfile(fim_file, 'b'), "\n") : v:null
+        call delete(fim_file)
+        call s:Finish(id, status, text)
+    endfor
+    if empty(s:pending) && !s:Loading()
+        call s:ReloadResponse()
+        call s:StopTimer()
         silent! checktime
     endif
 endfunction
 
-function! Monitor()
-    if exists('s:monitor_timer')
-        call timer_stop(s:monitor_timer)
-        unlet s:monitor_timer
+function! s:Loading()
+    if s:loading && filereadable(s:watched_dir . '/ready')
+        let s:loading = 0
+    endif
+    return s:loading
+endfunction
+
+function! s:ShowResponse()
+    if s:vimlm_enabled && bufwinnr(bufnr(s:watched_dir . '/response.md')) == -1
+        call Monitor()
+    endif
+endfunction
+
+function! s:SetResponse(lines)
+    let bufnum = bufnr(s:watched_dir . '/response.md')
+    if bufnum == -1
+        return
+    endif
+    call setbufvar(bufnum, '&modifiable', 1)
+    call setbufline(bufnum, 1, empty(a:lines) ? [''] : a:lines)
+    silent! call deletebufline(bufnum, max([len(a:lines), 1]) + 1, '$')
+    call setbufvar(bufnum, '&modifiable', 0)
+endfunction
+
+function! s:AppendResponse(text)
+    let bufnum = bufnr(s:watched_dir . '/response.md')
+    if bufnum == -1
+        return
+    endif
+    let lines = split(a:text, "\n", 1)
+    call setbufvar(bufnum, '&modifiable', 1)
+    call setbufline(bufnum, '$', getbufline(bufnum, '$')[0] . lines[0])
+    if len(lines) > 1
+        call appendbufline(bufnum, '$', lines[1:])
+    endif
+    call setbufvar(bufnum, '&modifiable', 0)
+endfunction
+
+function! s:ReloadResponse()
+    let response_path = s:watched_dir . '/response.md'
+    let s:response_offset = max([getfsize(response_path), 0])
+    call s:SetResponse(filereadable(response_path) ? readfile(response_path, 'b') : [])
+endfunction
+
+function! s:Utf8Boundary(blob)
+    let n = len(a:blob)
+    let i = n - 1
+    while i > 0 && i > n - 4 && and(a:blob[i], 0xC0) == 0x80
+        let i -= 1
+    endwhile
+    if a:blob[i] < 0xC0
+        return n
+    endif
+    let need = a:blob[i] >= 0xF0 ? 4 : a:blob[i] >= 0xE0 ? 3 : 2
+    return n - i >= need ? n : i
+endfunction
+
+function! s:ReadDelta()
+    let response_path = s:watched_dir . '/response.md'
+    let size = getfsize(response_path)
+    if size < 0 || size == s:response_offset
+        return
+    elseif size < s:response_offset
+        call s:ReloadResponse()
+        return
+    endif
+    let blob = readblob(response_path, s:response_offset, size - s:response_offset)
+    let cut = empty(blob) ? 0 : s:Utf8Boundary(blob)
+    if cut == 0
+        return
     endif
+    let s:response_offset += cut
+    let text = list2str(blob2list(blob[0 : cut - 1]))
+    call s:AppendResponse(&encoding ==# 'utf-8' ? iconv(text, 'utf-8', 'latin1') : text)
+endfunction
+
+function! Monitor()
     let response_path = s:watched_dir . '/response.md'
     let bufnum = bufnr(response_path)
     if bufnum != -1
         execute 'bwipeout ' . bufnum
     endif
-    let response_path = s:watched_dir . '/response.md'
     rightbelow vsplit | execute 'view ' . response_path
-    setlocal autoread
-    setlocal readonly
+    setlocal buftype=nofile
+    setlocal noreadonly
+    setlocal nomodifiable
     setlocal nobuflisted
     filetype detect
     syntax on
+    call s:ReloadResponse()
     wincmd h
-    let s:monitor_timer = timer_start(100, 'CheckForUpdates', {'repeat': -1})
 endfunction
 
 function! ScrollToTop()
@@ -547,76 +2991,173 @@ function! s:CustomInput(prompt) abort
     return input
 endfunction
 
-function! SaveUserInput(prompt)
+function! s:Connect()
+    if s:transport !=# 'socket' || !exists('*ch_open')
+        return 0
+    endif
+    if exists('s:channel') && ch_status(s:channel) ==# 'open'
+        return 1
+    endif
+    try
+        let s:channel = ch_open('unix:' . s:sock_path, {'mode': 'json', 'callback': 'VimLMReceive', 'waittime': 200})
+    catch
+        let s:transport = 'file'
+        return 0
+    endtry
+    if ch_status(s:channel) !=# 'open'
+        return 0
+    endif
+    call ch_sendexpr(s:channel, {'session': s:session})
+    return 1
+endfunction
+
+function! VimLMReceive(channel, msg)
+    if type(a:msg) != v:t_dict
+        return
+    endif
+    let msg_type = get(a:msg, 'type', '')
+    if msg_type ==# 'out'
+        if a:msg.mode ==# 'a'
+            call s:AppendResponse(a:msg.text)
+        else
+            call s:SetResponse(split(a:msg.text, "\n", 1))
+        endif
+    elseif msg_type ==# 'blocks'
+        let s:response_model = a:msg
+    elseif msg_type ==# 'done'
+        call s:Finish(a:msg.id, a:msg.status, get(a:msg, 'text', v:null))
+        silent! checktime
+    endif
+endfunction
+
+function! s:Finish(id, status, ...)
+    let id = str2nr(a:id)
+    if !has_key(s:pending, id)
+        return
+    endif
+    let request = remove(s:pending, id)
+    call timer_stop(request.timer)
+    if a:0 && a:1 isnot v:null
+        let s:completions[id] = a:1
+    endif
+    if request.callback isnot v:null
+        call call(request.callback, [id, a:status])
+    endif
+    silent! call remove(s:completions, id)
+endfunction
+
+function! CancelVimLM(...)
+    let ids = a:0 && a:1 ? [a:1] : map(keys(s:pending), 'str2nr(v:val)')
+    let status = a:0 > 1 ? a:2 : 'cancelled'
+    call filter(ids, 'has_key(s:pending, v:val)')
+    if empty(ids)
+        return
+    endif
+    if exists('s:channel') && ch_status(s:channel) ==# 'open'
+        call ch_sendexpr(s:channel, {'cancel': ids, 'session': s:session})
+    else
+        call writefile(ids, s:watched_dir . '/cancel')
+    endif
+    for id in ids
+        call s:Finish(id, status)
+    endfor
+    if status ==# 'timeout'
+        echohl WarningMsg | echom "VimLM request timed out" | echohl None
+    endif
+endfunction
+
+function! s:ContextRef(id)
+    let start = line2byte(line("'<"))
+    if start < 0
+        return {}
+    endif
+    let ref = {'line': line("'<"), 'start': start - 1, 'end': line2byte(line("'>") + 1) - 1, 'path': expand('%:p')}
+    if &modified || !filereadable(ref.path) || &fileformat !=# 'unix' || &bomb || (!empty(&fileencoding) && &fileencoding !=# &encoding)
+        let ref.path = s:watched_dir . '/snapshot_' . a:id
+        let ref.snapshot = 1
+        call writefile(getline(1, '$'), ref.path, 'b')
+    endif
+    return ref
+endfunction
+
+function! s:SendRequest(context, yank, user, flags, ...)
+    let s:request_id += 1
+    let id = s:request_id
+    let timeout = index(a:flags, 'fim') >= 0 ? get(g:, 'vimlm_fim_timeout', $FIM_TIMEOUT) : get(g:, 'vimlm_timeout', $TIMEOUT)
+    let extra = a:0 > 1 ? a:2 : {}
+    let s:pending[id] = {'callback': a:0 ? a:1 : v:null, 'timer': timer_start(timeout * 1000, function('CancelVimLM', [id, 'timeout']))}
+    let current_file = expand('%:p')
+    if index(a:flags, 'ctx') >= 0
+        let extra = extend(copy(extra), {'ctx': s:ContextRef(id)})
+    endif
+    call s:ShowResponse()
+    if s:Connect()
+        let msg = {'id': id, 'context': join(a:context, "\n"), 'yank': join(a:yank, "\n"), 'user': a:user, 'tree': current_file, 'session': s:session}
+        for flag in a:flags
+            let msg[flag] = get(extra, flag, 1)
+        endfor
+        call ch_sendexpr(s:channel, msg)
+        return id
+    endif
+    call writefile(a:yank, s:watched_dir . '/yank', 'b')
+    call writefile(a:context, s:watched_dir . '/context', 'b')
+    for flag in a:flags
+        call writefile(has_key(extra, flag) ? [json_encode(extra[flag])] : [], s:watched_dir . '/' . flag)
+    endfor
+    call writefile([id], s:watched_dir . '/id')
+    call writefile(empty(a:user) ? [] : [a:user], s:watched_dir . '/user')
+    call writefile([current_file], s:watched_dir . '/tree')
+    call s:StartTimer()
+    return id
+endfunction
+
+function! SaveUserInput(prompt, context, yank, flags)
     let user_input = s:CustomInput(a:prompt)
     if user_input is v:null
         echo "Input aborted"
         return
     endif
-    let user_file = s:watched_dir . '/user'
-    call writefile([user_input], user_file)
-    let current_file = expand('%:p')
-    let tree_file = s:watched_dir . '/tree'
-    call writefile([current_file], tree_file)
+    call s:SendRequest(a:context, a:yank, user_input, a:flags)
     call ScrollToTop()
 endfunction
 
 function! VisualPrompt()
     silent! execute "normal! \<ESC>"
-    silent execute "'<,'>w! " . s:watched_dir . "/yank"
-    silent execute "w! " . s:watched_dir . "/context"
-    call SaveUserInput('VimLM: ')
+    call SaveUserInput('VimLM: ', [], getline("'<", "'>"), ['ctx'])
 endfunction
 
 function! NormalPrompt()
     silent! execute "normal! V\<ESC>"
-    silent execute "'<,'>w! " . s:watched_dir . "/yank"
-    silent execute "w! " . s:watched_dir . "/context"
-    call SaveUserInput('VimLM: ')
+    call SaveUserInput('VimLM: ', [], getline("'<", "'>"), ['ctx'])
 endfunction
 
 function! FollowUpPrompt()
-    call writefile([], s:watched_dir . '/yank')
-    call writefile([], s:watched_dir . '/context')
-    call writefile([], s:watched_dir . '/followup')
-    call SaveUserInput('... ')
+    call SaveUserInput('... ', [], [], ['followup'])
 endfunction
 
-function! ExtractAllCodeBlocks()
-    let filepath = s:watched_dir . '/response.md'
-    if !filereadable(filepath)
-        echoerr "File not found: " . filepath
-        return
-    endif
-    let lines = readfile(filepath)
-    let in_code_block = 0
-    let code_blocks = []
-    let current_block = []
-    for line in lines
-        if line =~ '^```'
-            if in_code_block
-                call add(code_blocks, current_block)
-                let current_block = []
-                let in_code_block = 0
-            else
-                let in_code_block = 1
-            endif
-        elseif in_code_block
-            call add(current_block, line)
-        endif
-    endfor
-    if in_code_block
-        call add(code_blocks, current_block)
+function! s:ResponseModel()
+    if exists('s:response_model') && exists('s:channel') && ch_status(s:channel) ==# 'open'
+        return s:response_model
     endif
-    for idx in range(len(code_blocks))
-        if idx >= len(s:register_names)
-            break
-        endif
-        let code_block_text = join(code_blocks[idx], "\n")
-        let register_name = s:register_names[idx]
-        call setreg(register_name, code_block_text, 'v') 
+    let model_path = s:watched_dir . '/response.json'
+    return filereadable(model_path) ? json_decode(join(readfile(model_path), "\n")) : {'blocks': []}
+endfunction
+
+function! s:ResponseText()
+    let response_path = s:watched_dir . '/response.md'
+    let bufnum = bufnr(response_path)
+    if bufloaded(bufnum)
+        return join(getbufline(bufnum, 1, '$'), "\n")
+    endif
+    return filereadable(response_path) ? join(readfile(response_path, 'b'), "\n") : ''
+endfunction
+
+function! ExtractAllCodeBlocks()
+    let blocks = s:ResponseModel().blocks
+    for idx in range(min([len(blocks), len(s:register_names)]))
+        call setreg(s:register_names[idx], blocks[idx].text, 'v')
     endfor
-    return len(code_blocks)
+    return len(blocks)
 endfunction
 
 function! PasteIntoLastVisualSelection(...)
@@ -646,11 +3187,6 @@ function! PasteIntoLastVisualSelection(...)
 endfunction
 
 function! VimLM(...) range
-    let wip_file = s:watched_dir . '/wip'
-    while filereadable(wip_file)
-        sleep 100m
-    endwhile
-    call writefile([], wip_file)
     let user_input = join(a:000, ' ')
     if empty(user_input)
         echo "Usage: :VimLM <prompt> [!command1] [!command2] ..."
@@ -659,55 +3195,59 @@ function! VimLM(...) range
     if line("'<") == line("'>")
         silent! execute "normal! V\<ESC>"
     endif
-    silent execute "'<,'>w! " . s:watched_dir . "/yank"
-    silent execute "w! " . s:watched_dir . "/context"
-    let user_file = s:watched_dir . '/user'
-    call writefile([user_input], user_file)
-    let current_file = expand('%:p')
-    let tree_file = s:watched_dir . '/tree'
-    call writefile([current_file], tree_file)
+    call s:SendRequest([], getline("'<", "'>"), user_input, ['ctx'])
     call ScrollToTop()
 endfunction
 
-function! SplitAtCursorInInsert()
-    let pos = getcurpos()
-    let line_num = pos[1]
-    let col = pos[2]
-    let lines = getline(1, '$')
-    let current_line = lines[line_num - 1]
-    let prefix_lines = lines[0:line_num - 2]
-    let prefix_part = strpart(current_line, 0, col - 1)
-    if !empty(prefix_part) || col > 1
-        call add(prefix_lines, prefix_part)
-    endif
-    let suffix_lines = []
-    let suffix_part = strpart(current_line, col - 1)
-    if empty(suffix_part)
-        call add(suffix_lines, "")
-    else
-        call add(suffix_lines, suffix_part)
+function! s:LineDiff(old, new)
+    let [lo, hi] = [0, min([len(a:old), len(a:new)])]
+    while lo < hi
+        let mid = (lo + hi + 1) / 2
+        if a:old[: mid - 1] == a:new[: mid - 1]
+            let lo = mid
+        else
+            let hi = mid - 1
+        endif
+    endwhile
+    let start = lo
+    let [lo, hi] = [0, min([len(a:old), len(a:new)]) - start]
+    while lo < hi
+        let mid = (lo + hi + 1) / 2
+        if a:old[len(a:old) - mid :] == a:new[len(a:new) - mid :]
+            let lo = mid
+        else
+            let hi = mid - 1
+        endif
+    endwhile
+    let stop = len(a:new) - lo
+    return [start, len(a:old) - lo, stop > start ? a:new[start : stop - 1] : []]
+endfunction
+
+function! s:FimDone(bufnr, rev, lines, callback, id, status)
+    if a:status ==# 'done' && a:rev > get(getbufvar(a:bufnr, 'vimlm_fim_base', {}), 'rev', 0)
+        call setbufvar(a:bufnr, 'vimlm_fim_base', {'rev': a:rev, 'lines': a:lines})
+    elseif a:status ==# 'stale'
+        call setbufvar(a:bufnr, 'vimlm_fim_base', {})
     endif
-    if line_num < len(lines)
-        call extend(suffix_lines, lines[line_num:])
+    if a:callback isnot v:null
+        call call(a:callback, [a:id, a:status])
     endif
-    call writefile(prefix_lines, s:watched_dir . '/context', 'b')
-    call writefile(suffix_lines, s:watched_dir . '/yank', 'b')
-    call writefile([], s:watched_dir . '/fim')
-    call writefile([], s:watched_dir . '/user')
-    let current_file = expand('%:p')
-    let tree_file = s:watched_dir . '/tree'
-    call writefile([current_file], tree_file)
+endfunction
+
+function! SplitAtCursorInInsert(...)
+    let lines = getline(1, '$')
+    let base = get(b:, 'vimlm_fim_base', {})
+    let b:vimlm_fim_rev = get(b:, 'vimlm_fim_rev', 0) + 1
+    let [start, end, changed] = empty(base) ? [0, 0, lines] : s:LineDiff(base.lines, lines)
+    let diff = {'key': getpid() . ':' . bufnr(), 'base': get(base, 'rev', -1), 'rev': b:vimlm_fim_rev, 'start': start, 'end': end, 'n': len(changed), 'line': line('.'), 'col': col('.')}
+    let Done = function('s:FimDone', [bufnr(), b:vimlm_fim_rev, lines, a:0 ? a:1 : v:null])
+    let id = s:SendRequest(changed, [], '', ['fim'], Done, {'fim': diff})
     call ScrollToTop()
+    return id
 endfunction
 
 function! InsertResponse()
-    let response_path = s:watched_dir . '/response.md'
-    if !filereadable(response_path)
-        echoerr "Response file not found: " . response_path
-        return
-    endif
-    let content = readfile(response_path, 'b')
-    let text = join(content, "\n")
+    let text = s:ResponseText()
     let saved_z = getreg('z')
     let saved_ztype = getregtype('z')
     call setreg('z', text)
@@ -721,48 +3261,86 @@ function! InsertResponse()
     call setreg('z', saved_z, saved_ztype)
 endfunction
 
+function! s:InsertText(text)
+    let lines = split(a:text, "\n", 1)
+    let lnum = line('.')
+    let col = col('.')
+    let line = getline(lnum)
+    let last = len(lines) - 1
+    let end_col = len(lines[last]) + (last == 0 ? col : 1)
+    let lines[0] = strpart(line, 0, col - 1) . lines[0]
+    let lines[last] .= strpart(line, col - 1)
+    call setline(lnum, lines[0])
+    call append(lnum, lines[1:])
+    call cursor(lnum + last, end_col)
+endfunction
+
+function! s:InsertCompletion(anchor, id, status)
+    autocmd! VimLMFim
+    if a:status !=# 'done' || mode() !=# 'i' || [bufnr(), line('.'), col('.'), b:changedtick] != a:anchor
+        return
+    endif
+    call s:InsertText(get(s:completions, a:id, s:ResponseText()))
+endfunction
+
+function! s:AbortCompletion()
+    autocmd! VimLMFim
+    call CancelVimLM(s:fim_request)
+endfunction
+
 function! TabInInsert()
-    let wip_file = s:watched_dir . '/wip'
-    call writefile([], wip_file)
-    call SplitAtCursorInInsert()
-    while filereadable(wip_file)
-        sleep 10m
-    endwhile
-    call InsertResponse()
+    let anchor = [bufnr(), line('.'), col('.'), b:changedtick]
+    let s:fim_request = SplitAtCursorInInsert(function('s:InsertCompletion', [anchor]))
+    augroup VimLMFim
+        autocmd!
+        autocmd InsertCharPre,InsertLeave * call s:AbortCompletion()
+    augroup END
 endfunction
 
 command! ToggleVimLM call ToggleVimLM()
+command! VimLMCancel call CancelVimLM()
 command! -range -nargs=+ VimLM call VimLM(<f-args>)
-inoremap <silent> $mapl <C-\><C-o>:call SplitAtCursorInInsert()<CR>
+inoremap <silent> $mapl <Cmd>call SplitAtCursorInInsert()<CR>
 inoremap <silent> $mapp <C-\><C-o>:call InsertResponse()<CR><Right>
-inoremap <silent> $mapj <C-\><C-o>:call TabInInsert()<CR><Right>
+inoremap <silent> $mapj <Cmd>call TabInInsert()<CR>
 nnoremap $mapp :call PasteIntoLastVisualSelection()<CR>
 vnoremap $mapp <Cmd>:call PasteIntoLastVisualSelection()<CR>
 vnoremap $mapl <Cmd>:call VisualPrompt()<CR>
 nnoremap $mapl :call NormalPrompt()<CR>
 nnoremap $mapj :call FollowUpPrompt()<CR>
+nnoremap <silent> $mapc :call CancelVimLM()<CR>
 call Monitor()
-""").safe_substitute(dict(WATCH_DIR=WATCH_DIR, mapl=mapl, mapj=mapj, mapp=mapp))
+if !s:Connect()
+    call s:StartTimer()
+endif
+""").safe_substitute(dict(TIMEOUT=TIMEOUT, FIM_TIMEOUT=FIM_TIMEOUT, mapl=mapl, mapj=mapj, mapp=mapp, mapc=mapc))
 
-async def main(args):
+async def main(args, vim='vim', session=None):
+    watch_dir = WATCH_DIR if session is None else os.path.join(SESSIONS_DIR, session)
     with tempfile.NamedTemporaryFile(mode='w', suffix='.vim', delete=False) as f:
-        f.write(VIMLMSCRIPT)
+        f.write(Template(VIMLMSCRIPT).safe_substitute(WATCH_DIR=watch_dir, SOCK_PATH=SOCK_PATH, SESSION=session or '', TRANSPORT=TRANSPORT))
         vim_script = f.name
-    vim_command = ["vim", "-c", f"source {vim_script}"]
+    vim_command = [vim, "-c", f"source {vim_script}"]
     if args.args_vim:
         vim_command.extend(args.args_vim)
     else:
         vim_command.append('.tmp')
+    tasks = []
+    if session is None:
+        TAIL.start()
+        tasks = [asyncio.create_task(monitor_directory()), asyncio.create_task(monitor_repo())]
+        if TRANSPORT == 'socket':
+            tasks.append(asyncio.create_task(serve_socket()))
     try:
-        monitor_task = asyncio.create_task(monitor_directory())
         vim_process = await asyncio.create_subprocess_exec(*vim_command)
         await vim_process.wait()
     finally:
-        monitor_task.cancel()
-        try:
-            await monitor_task
-        except asyncio.CancelledError:
-            pass
+        for task in tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
         os.remove(vim_script)
 
 def get_common_dir_and_children(file_paths):
@@ -853,7 +3431,7 @@ def select_files_interactive(file_paths):
             return None
     return [file_paths[i] for i in range(len(file_paths)) if selected[i]]
 
-def get_repo(args_repo, args_vim):
+def select_repo(args_repo, args_vim):
     if not args_repo:
         return None
     vim_files = []
@@ -887,44 +3465,1062 @@ def get_repo(args_repo, args_vim):
             rest_files.append(os.path.abspath(path))
         else:
             repo_files.append(os.path.abspath(path))
+    return dict(repo_files=repo_files, rest_files=rest_files, vim_files=vim_files)
+
+def make_repo(spec):
+    if not spec:
+        return None, None
+    repo_files, rest_files = spec['repo_files'], spec['rest_files']
     repo_name, repo_path, child_paths = get_common_dir_and_children(repo_files+rest_files)
     repo_names, rest_names = child_paths[:len(repo_files)], child_paths[len(repo_files):]
-    list_content = [f'<|repo_name|>{repo_name}\n']
-    list_mtime = []
-    for p, n in zip(repo_files, repo_names):
+    repo = RepoContext(repo_name, repo_files, repo_names)
+    return repo, repo.dict_repo(rest_files=rest_files, rest_names=rest_names, vim_files=spec['vim_files'], repo_path=repo_path)
+
+IDENT_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}')
+IMPORT_PATTERN = re.compile(r'^\s*(?:from\s+([\w.]+)\s+import\s+([\w, ]+)|import\s+([\w., ]+))|(?:from|require\(|import)\s*[\'"]([^\'"]+)[\'"]', re.M)
+
+def find_imports(text):
+    modules = set()
+    for groups in IMPORT_PATTERN.findall(text):
+        for group in groups:
+            for name in re.split(r'[\s,]+', group):
+                if name:
+                    modules.update(part for part in re.split(r'[./]', name) if part)
+    return modules
+
+class RepoContext:
+    def __init__(self, repo_name, paths, names):
+        self.head = f'<|repo_name|>{repo_name}\n'
+        self.names = dict(zip(paths, names))
+        self.segments = {}
+        self.postings = {}
+        self.modules = {}
+        self.importers = {}
+        self.prior = {}
+        self.order = list(paths)
+        self.selected = None
+        self.handed = []
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.extra = {}
+        self.encoded = 0
+        self.reused = 0
+        self.refresh(paths)
+        self.order.sort(key=lambda p: self.segments[p]['mtime'] if p in self.segments else 0)
+
+    def read(self, path):
         try:
-            with open(p, 'r') as f:
-                list_content.append(f'<|file_sep|>{n}\n{f.read()}\n')
-            list_mtime.append(int(os.path.getmtime(p)))
+            st = os.stat(path)
+            seg = self.segments.get(path)
+            if seg and (seg['mtime'], seg['size']) == (st.st_mtime_ns, st.st_size):
+                return False
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                body = f.read()
         except Exception as e:
-            tolog(f'Skipped {p} d/t {e}', 'debug:get_repo()')
-    return dict(repo_files=repo_files, rest_files=rest_files, rest_names=rest_names, vim_files=vim_files, list_mtime=list_mtime, list_content=list_content, repo_path=repo_path)
+            tolog(f'Skipped {path} d/t {e}', 'debug:get_repo()')
+            self.index(path, None)
+            return self.segments.pop(path, None) is not None
+        text = f'<|file_sep|>{self.names[path]}\n{body}\n'
+        digest = content_digest(text)
+        if seg and seg['digest'] == digest:
+            seg.update(mtime=st.st_mtime_ns, size=st.st_size)
+            return False
+        idents, imports = self.index(path, body, st)
+        self.segments[path] = dict(text=text, digest=digest, mtime=st.st_mtime_ns, size=st.st_size, ntok=None, edits=seg['edits'] + 1 if seg else 0, idents=idents, imports=imports)
+        if seg:
+            self.order.remove(path)
+            self.order.append(path)
+        return True
+
+    def index(self, path, body, st=None):
+        seg = self.segments.get(path)
+        for ident in seg['idents'] if seg else ():
+            self.postings[ident].discard(path)
+        for name in seg['imports'] if seg else ():
+            self.importers[name].discard(path)
+        self.modules.setdefault(os.path.splitext(os.path.basename(path))[0], set()).discard(path)
+        self.prior.pop(path, None)
+        if body is None:
+            return None, None
+        idents, imports = frozenset(IDENT_PATTERN.findall(body)), find_imports(body)
+        for ident in idents:
+            self.postings.setdefault(ident, set()).add(path)
+        for name in imports:
+            self.importers.setdefault(name, set()).add(path)
+        self.modules[os.path.splitext(os.path.basename(path))[0]].add(path)
+        edits = seg['edits'] + 1 if seg else 0
+        self.prior[path] = 0.5 * edits + math.exp(-(time.time() - st.st_mtime) / 86400)
+        return idents, imports
+
+    def refresh(self, paths=None):
+        with self.lock:
+            paths = list(self.dirty if paths is None else paths)
+            self.dirty.difference_update(paths)
+            return [p for p in paths if p in self.names and self.read(p)]
+
+    def mark(self, paths):
+        with self.lock:
+            self.dirty.update(p for p in paths if p in self.names)
+        return bool(self.dirty)
+
+    def digests(self, paths):
+        acc, prefix = [], hashlib.sha1(self.head.encode('utf-8'))
+        for path in paths:
+            prefix.update(self.segments[path]['digest'].encode('utf-8'))
+            acc.append(prefix.hexdigest())
+        return acc
+
+    def rank(self, query='', imports=(), module=None, limit=256):
+        n = len(self.segments)
+        scores = dict(self.prior)
+        for ident in set(IDENT_PATTERN.findall(query)):
+            paths = self.postings.get(ident)
+            if paths and len(paths) <= max(1, n // 2):
+                idf = math.log(1 + n / len(paths))
+                for path in paths:
+                    scores[path] += idf
+        for name in imports:
+            for path in self.modules.get(name, ()):
+                scores[path] += 4.0
+        for path in self.importers.get(module, ()):
+            scores[path] += 2.0
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+    def select(self, query='', imports=(), module=None, budget=None, counter=None, limit=256):
+        live = [p for p in self.order if p in self.segments]
+        if budget is None or counter is None:
+            return live
+        chosen, left = set(), budget - counter(self.head)
+        for path in self.rank(query, imports, module, limit):
+            seg = self.segments[path]
+            if seg['ntok'] is None:
+                seg['ntok'] = counter(seg['text'])
+            if seg['ntok'] <= left:
+                chosen.add(path)
+                left -= seg['ntok']
+        return [p for p in live if p in chosen]
+
+    def context(self, query='', imports=(), module=None, budget=None, counter=None):
+        changed = self.refresh() if self.dirty else []
+        selected = self.select(query, imports, module, budget, counter)
+        if selected == self.selected and not set(changed) & set(selected):
+            return None
+        before, after = self.handed, self.digests(selected)
+        keep = shared_prefix(before, after)
+        if counter is not None:
+            for i, path in enumerate(selected):
+                seg = self.segments[path]
+                if seg['ntok'] is None:
+                    seg['ntok'] = counter(seg['text'])
+                if i < keep:
+                    self.reused += seg['ntok']
+                else:
+                    self.encoded += seg['ntok']
+        self.selected, self.handed = selected, after
+        tolog(dict(changed=changed, selected=len(selected), reused_segments=keep, segments=len(self.segments)), 'repo')
+        return self.dict_repo(selected)
+
+    def dict_repo(self, paths=None, **extra):
+        self.extra.update(extra)
+        paths = [p for p in self.order if p in self.segments] if paths is None else paths
+        return dict(self.extra, repo_files=paths, list_mtime=[int(self.segments[p]['mtime'] // 10**9) for p in paths],
+                    list_content=[self.head] + [self.segments[p]['text'] for p in paths], list_digest=self.digests(paths))
+
+    def stats(self):
+        return dict(files=len(self.segments), encoded_tokens=self.encoded, reused_tokens=self.reused)
+
+REPO = None
+
+async def monitor_repo(repo=None):
+    repo = REPO if repo is None else repo
+    if repo is None:
+        return
+    dirs = sorted({os.path.dirname(p) for p in repo.names})
+    async for changes in awatch(*dirs):
+        repo.mark({os.path.abspath(f) for _, f in changes})
+
+class StubTokenizer:
+    pattern = re.compile(r'\w+|[^\w\s]')
+
+    def __init__(self, call_overhead=0.0):
+        self.call_overhead = call_overhead
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False):
+        if self.call_overhead:
+            time.sleep(self.call_overhead)
+        if not return_offsets_mapping:
+            return dict(input_ids=self.pattern.findall(text))
+        offsets = [m.span() for m in self.pattern.finditer(text)]
+        return dict(input_ids=list(range(len(offsets))), offset_mapping=offsets)
+
+class StubChat:
+    def __init__(self, reply='Lorem ipsum dolor sit amet, consectetur adipiscing elit.', **kwargs):
+        self.reply = reply
+        self.stop = False
+        self.history = []
+        self.dict_repo = kwargs.get('dict_repo')
+        self.tokenizer = StubTokenizer(kwargs.get('call_overhead', 0.0))
+        self.prefill_rate = kwargs.get('prefill_rate')
+        self.decode_rate = kwargs.get('decode_rate')
+        self.attn_rate = kwargs.get('attn_rate')
+        self.batch_overhead = kwargs.get('batch_overhead', 0.15)
+        self.kv_bytes_per_token = kwargs.get('kv_bytes_per_token', 36864)
+        self.cached = ''
+        self.prefilled = 0
+        self.context = self.peak = 0
+        time.sleep(kwargs.get('load_delay', 0.0))
+
+    def get_ntok(self, s):
+        return len(self.tokenizer(s)['input_ids'])
+
+    def reset(self):
+        self.history = []
+        self.cached = ''
+        self.context = 0
+
+    def snapshot(self, prefix):
+        if not (self.history and self.history[0].startswith(prefix)):
+            return None
+        ntok = self.get_ntok(prefix)
+        return prefix, ntok * self.kv_bytes_per_token, ntok
+
+    def restore(self, state):
+        self.cached = state
+
+    def __call__(self, prompt, max_new=NUM_TOKEN, verbose=False, stream=None):
+        reused = self.cached if not self.history and prompt.startswith(self.cached) else ''
+        ntok = self.get_ntok(prompt) - self.get_ntok(reused)
+        self.prefilled += ntok
+        if self.prefill_rate:
+            time.sleep(ntok / self.prefill_rate)
+        self.history.append(prompt)
+        self.cached = ''
+        self.context += self.get_ntok(prompt)
+        return self.generate(max_new, stream)
+
+    def resume(self, max_new=NUM_TOKEN, verbose=False, stream=None):
+        return self.generate(max_new, stream)
+
+    def batch_generate(self, prompts, max_new):
+        ntok = sum(self.get_ntok(prompt) for prompt in prompts)
+        self.prefilled += ntok
+        outputs = [re.findall(r'\s*\S+', self.reply)[:n] for n in max_new]
+        if self.prefill_rate:
+            time.sleep(ntok / self.prefill_rate)
+        if self.decode_rate:
+            time.sleep(max(map(len, outputs)) * (1 + self.batch_overhead * (len(prompts) - 1)) / self.decode_rate)
+        return [''.join(tokens) for tokens in outputs]
+
+    def generate(self, max_new, stream):
+        tokens = re.findall(r'\s*\S+', self.reply)[:max_new]
+        step = 1 / self.decode_rate + (self.context / self.attn_rate if self.attn_rate else 0) if self.decode_rate else 0
+        f = open(stream, 'a', encoding='utf-8') if stream else None
+        try:
+            for token in tokens:
+                if f:
+                    f.write(token)
+                    f.flush()
+                if step:
+                    time.sleep(step)
+                yield_to_fim()
+        finally:
+            if f:
+                f.close()
+        self.context += len(tokens)
+        self.peak = max(self.peak, self.context)
+        return dict(text=''.join(tokens))
+
+    def fim(self, prefix, suffix, current_path=None):
+        ntok = self.get_ntok(prefix) + self.get_ntok(suffix)
+        self.prefilled += ntok
+        if self.prefill_rate:
+            time.sleep(ntok / self.prefill_rate)
+        return dict(autocomplete=self.reply.splitlines()[0])
+
+    def set_cache_repo(self, dict_repo, cache_dir=None):
+        old, self.dict_repo = self.dict_repo or {}, dict_repo
+        if not dict_repo:
+            return
+        keep = shared_prefix(old.get('list_digest', []), dict_repo.get('list_digest', []))
+        ntok = sum(self.get_ntok(text) for text in dict_repo['list_content'][1 + keep:])
+        self.prefilled += ntok
+        if self.prefill_rate:
+            time.sleep(ntok / self.prefill_rate)
+
+class TinyLM:
+    pattern = re.compile(r'\s*\S+')
+    eos = '</s>'
+
+    def __init__(self, corpus, noise=0.0, step_cost=0.0):
+        toks = self.pattern.findall(corpus)
+        counts = {}
+        for a, b, c in zip(toks, toks[1:], toks[2:] + [self.eos]):
+            counts.setdefault((a, b), Counter())[c] += 1
+        self.best = {ctx: c.most_common(1)[0][0] for ctx, c in counts.items()}
+        self.noise = noise
+        self.step_cost = step_cost
+        self.history = ''
+        self.stop = False
+
+    def next(self, ids):
+        tok = self.best.get(tuple(ids[-2:]), self.eos)
+        if self.noise and int(content_digest(len(ids), *ids[-2:])[:8], 16) < self.noise * 16**8:
+            tok = ' <noise>'
+        return tok
+
+    def propose(self, ids, k):
+        out = []
+        for _ in range(k):
+            time.sleep(self.step_cost)
+            out.append(self.next(ids + out))
+            if out[-1] == self.eos:
+                break
+        return out
+
+    def verify(self, ids, draft):
+        time.sleep(self.step_cost)
+        ctx, preds = list(ids), []
+        for tok in draft + [None]:
+            preds.append(self.next(ctx))
+            if tok is not None:
+                ctx.append(tok)
+        return preds
+
+    def encode(self, prompt):
+        return self.pattern.findall(self.history + prompt)
+
+    def decode(self, ids):
+        return ''.join(ids)
+
+    def commit(self, prompt, text):
+        self.history += prompt + text
+
+    def reset(self):
+        self.history = ''
+
+    def get_ntok(self, s):
+        return len(self.pattern.findall(s))
+
+@contextmanager
+def sandbox(model=None, fim_model=None):
+    keys = ('WATCH_DIR', 'OUT_PATH', 'SOCK_PATH', 'SESSIONS_DIR', 'LTM_STORE', 'LOG_STORE', 'METRICS_STORE', 'CODE_INDEX', 'PREFIX_CACHE', 'READY', 'LOAD_ERROR', 'ENGINE', 'CONVERSATION', 'TAIL', 'REPO', 'chat', 'fim')
+    saved = {k: globals()[k] for k in keys if k in globals()}
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix='vimlm_bench_')
+    model = StubChat() if model is None else model
+    globals().update(WATCH_DIR=os.path.join(tmp_dir, 'watch_dir'), OUT_PATH=os.path.join(tmp_dir, 'watch_dir', OUT_FILE), SOCK_PATH=os.path.join(tmp_dir, SOCK_FILE), SESSIONS_DIR=os.path.join(tmp_dir, 'sessions'), LTM_STORE=SummaryStore(os.path.join(tmp_dir, LTM_FILE)), LOG_STORE=LogStore(os.path.join(tmp_dir, LOG_FILE)), METRICS_STORE=LogStore(os.path.join(tmp_dir, METRICS_FILE)), CODE_INDEX=CodeIndex(os.path.join(tmp_dir, INDEX_FILE)), PREFIX_CACHE=PrefixCache(KV_CACHE_MB * 2**20, os.path.join(tmp_dir, KV_DIR)), READY=threading.Event(), LOAD_ERROR=None, ENGINE=Engine(ChatBackend(model)), CONVERSATION=Conversation(), chat=model, fim=model if fim_model is None else fim_model)
+    READY.set()
+    os.makedirs(globals()['WATCH_DIR'])
+    try:
+        yield tmp_dir
+    finally:
+        for sid in list(SESSIONS):
+            SESSIONS.pop(sid).close()
+        OWNERS.update(chat=None, fim=None)
+        os.chdir(cwd)
+        for k in keys:
+            if k in saved:
+                globals()[k] = saved[k]
+            else:
+                globals().pop(k, None)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def summarize_times(times):
+    times = sorted(times)
+    pick = lambda q: round(1000 * times[min(len(times) - 1, int(q * len(times)))], 2)
+    return dict(n=len(times), mean_ms=round(1000 * statistics.mean(times), 2), p50_ms=pick(.5), p95_ms=pick(.95))
+
+def bench_transport(n=50):
+    request = dict(context='\n'.join(f'line {i}' for i in range(200)), yank='line 10', user='Explain this line', tree='bench.py')
+    async def via_file(msg_id):
+        for file, content in [('id', str(msg_id)), *request.items()]:
+            with open(os.path.join(WATCH_DIR, file), 'w', encoding='utf-8') as f:
+                f.write(content)
+        while not os.path.exists(done_path := os.path.join(WATCH_DIR, f'done_{msg_id}')):
+            await asyncio.sleep(0.001)
+        os.remove(done_path)
+    async def via_socket(reader, writer, decoder, msg_id):
+        writer.write(json.dumps([msg_id, dict(request, id=msg_id)]).encode('utf-8'))
+        await writer.drain()
+        buf = ''
+        while True:
+            buf += (await reader.read(65536)).decode('utf-8')
+            while buf := buf.lstrip():
+                try:
+                    (_, msg), end = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    break
+                buf = buf[end:]
+                if msg.get('type') == 'done':
+                    return
+    async def measure():
+        tasks = [asyncio.create_task(monitor_directory()), asyncio.create_task(serve_socket())]
+        await asyncio.sleep(0.5)
+        reader, writer = await asyncio.open_unix_connection(SOCK_PATH)
+        decoder = json.JSONDecoder()
+        result = {}
+        for name, step in [('file', via_file), ('socket', lambda msg_id: via_socket(reader, writer, decoder, msg_id))]:
+            times = []
+            for i in range(n):
+                t0 = time.perf_counter()
+                await asyncio.wait_for(step(i + 1), timeout=10)
+                times.append(time.perf_counter() - t0)
+            result[name] = summarize_times(times)
+        writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return result
+    with sandbox():
+        return asyncio.run(measure())
+
+def bench_split(n=2000, max_len=NUM_TOKEN, call_overhead=20e-6):
+    doc = '\n\n'.join(f'def function_{i}(x, y):\n    """Return a value."""\n' + '\n'.join(f'    x = x * {j} + y  # step {j}' for j in range(i % 12)) for i in range(n))
+    model = StubChat(call_overhead=call_overhead)
+    legacy = TokenCounter(model.get_ntok, maxsize=0)
+    t0 = time.perf_counter()
+    chunks = split_str(doc, max_len=max_len, get_len=legacy)
+    t_legacy = time.perf_counter() - t0
+    counter = TokenCounter(model.get_ntok, model.tokenizer)
+    t0 = time.perf_counter()
+    token_chunks = split_tokens(doc, max_len=max_len, counter=counter)
+    t_tokens = time.perf_counter() - t0
+    return dict(doc_mb=round(len(doc) / 2**20, 2), call_overhead_us=round(call_overhead * 1e6),
+                split_str=dict(ms=round(1000 * t_legacy, 1), tokenizer_calls=legacy.calls, chunks=len(chunks)),
+                split_tokens=dict(ms=round(1000 * t_tokens, 1), tokenizer_calls=counter.calls, chunks=len(token_chunks), max_chunk_ntok=max(n for _, n in token_chunks)),
+                same_chunks=[c for c, _ in token_chunks] == chunks)
+
+def bench_scan(n=10000, per_dir=100):
+    with tempfile.TemporaryDirectory(prefix='vimlm_bench_') as root:
+        for i in range(n):
+            sub = os.path.join(root, f'pkg_{i // per_dir}', 'build' if i % 50 == 7 else '')
+            os.makedirs(sub, exist_ok=True)
+            if i % 100 == 3:
+                data = bytes(range(256)) * 8
+            elif i % 500 == 11:
+                data = b'x = 1\n' * (SCAN_MAX_BYTES // 6 + 1)
+            else:
+                data = ''.join(f'def f_{i}_{j}(x):\n    return x + {j}\n\n' for j in range(20)).encode('utf-8')
+            with open(os.path.join(sub, f'mod_{i}.py' if i % 100 != 3 else f'blob_{i}.bin'), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(root, '.gitignore'), 'w') as f:
+            f.write('build/\n')
+        def legacy():
+            found, nbytes = 0, 0
+            for dir_path, _, names in os.walk(root):
+                for name in names:
+                    file_path = os.path.join(dir_path, name)
+                    if name.startswith('.') or is_binary(file_path):
+                        continue
+                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                        nbytes += len(f.read())
+                    found += 1
+            return found, nbytes
+        t0 = time.perf_counter()
+        legacy_files, legacy_bytes = legacy()
+        t_legacy = time.perf_counter() - t0
+        t0, t_first, found, nbytes = time.perf_counter(), None, 0, 0
+        for _, _, content in scan_files(root, depth=8):
+            t_first = t_first or time.perf_counter() - t0
+            found += 1
+            nbytes += len(content)
+        t_scan = time.perf_counter() - t0
+    return dict(files=n, legacy=dict(ms=round(1000 * t_legacy, 1), files=legacy_files, mb=round(legacy_bytes / 2**20, 1)),
+                scan=dict(ms=round(1000 * t_scan, 1), first_file_ms=round(1000 * t_first, 1), files=found, mb=round(nbytes / 2**20, 1), workers=SCAN_WORKERS))
+
+def bench_startup(load_delay=2.0, budget=0.5):
+    args = argparse.Namespace(args_vim=[])
+    with sandbox():
+        globals()['READY'] = threading.Event()
+        t0 = time.perf_counter()
+        loader = start_models(None, make_chat=lambda model_path, **kwargs: StubChat(load_delay=load_delay))
+        asyncio.run(main(args, vim='true'))
+        t_launch = time.perf_counter() - t0
+        loader.join()
+        t_ready = time.perf_counter() - t0
+    if t_launch >= budget:
+        raise RuntimeError(f'Vim launched after {t_launch:.3f}s (budget {budget}s)')
+    return dict(load_delay_ms=round(1000 * load_delay), launch_ms=round(1000 * t_launch, 1), ready_ms=round(1000 * t_ready, 1), budget_ms=round(1000 * budget),
+                heavy_imports=[m for m in ('mlx', 'mlx_lm_utils', 'nanollama') if m in sys.modules])
+
+def bench_prefix(n=20, prefill_rate=8000):
+    context = '\n'.join(f'def handler_{i}(request):\n    return respond(request, status={i})' for i in range(100))
+    result = {}
+    for name, enabled in [('no_cache', False), ('prefix_cache', True)]:
+        model = StubChat(prefill_rate=prefill_rate)
+        if not enabled:
+            model.snapshot = None
+        with sandbox(model):
+            t0 = time.perf_counter()
+            for i in range(n):
+                process_files(dict(context=context, yank=f'def handler_{i}(request):', user=f'Explain handler_{i}', tree='/tmp/bench/app.py'))
+            elapsed = time.perf_counter() - t0
+            result[name] = dict(ms=round(1000 * elapsed, 1), prefilled_tokens=model.prefilled, **({'cache': PREFIX_CACHE.stats()} if enabled else {}))
+    return dict(requests=n, prefill_tok_per_s=prefill_rate, **result)
+
+def bench_fim(sizes=(500, 2000, 8000), n=10, prefill_rate=50000):
+    result = {}
+    for size in sizes:
+        lines = [f'    v{i} = f(v{i - 1})' for i in range(size)]
+        cursor = size // 2
+        with sandbox(StubChat(prefill_rate=prefill_rate)):
+            legacy, incremental = [], []
+            for i in range(n):
+                lines[cursor - 1] = lines[cursor - 1][:8] + 'x' * i
+                t0 = time.perf_counter()
+                process_command(dict(fim=True, context='\n'.join(lines[:cursor]), yank='\n'.join(lines[cursor:]), user='', tree='/tmp/bench/big.py'))
+                legacy.append(time.perf_counter() - t0)
+                full = i == 0
+                diff = dict(key='bench', base=i if i else -1, rev=i + 1, start=0 if full else cursor - 1, end=0 if full else cursor, n=size if full else 1, line=cursor, col=9 + i)
+                t0 = time.perf_counter()
+                data = receive_fim(dict(fim=True, context='\n'.join(lines if full else lines[cursor - 1:cursor]), yank='', user='', tree='/tmp/bench/big.py'), diff)
+                process_command(data)
+                incremental.append(time.perf_counter() - t0)
+        result[size] = dict(legacy=summarize_times(legacy[1:]), incremental=summarize_times(incremental[1:]))
+    return dict(fim_tokens=FIM_TOKENS, prefill_tok_per_s=prefill_rate, lines=result)
+
+def bench_repo(n_files=50, edits=20, target=10, prefill_rate=STUB_MODEL['prefill_rate']):
+    legacy_model, model = StubChat(), StubChat()
+    with tempfile.TemporaryDirectory(prefix='vimlm_bench_') as root:
+        paths = [os.path.join(root, f'module_{i:02d}.py') for i in range(n_files)]
+        for i, path in enumerate(paths):
+            with open(path, 'w') as f:
+                f.write(''.join(f'def func_{i}_{j}(x):\n    return x * {j}\n\n' for j in range(60)))
+            os.utime(path, ns=(i * 10**9, i * 10**9))
+        repo = RepoContext('bench', paths, [os.path.basename(p) for p in paths])
+        model.set_cache_repo(repo.context())
+        counter = TokenCounter(model.get_ntok)
+        for path in repo.order:
+            counter(repo.segments[path]['text'])
+        legacy_times, times = [], []
+        legacy_model.prefilled = model.prefilled = 0
+        for k in range(edits):
+            with open(paths[target], 'a') as f:
+                f.write(f'# edit {k}\n')
+            t0 = time.perf_counter()
+            list_content = ['<|repo_name|>bench\n']
+            for path in paths:
+                with open(path, 'r') as f:
+                    list_content.append(f'<|file_sep|>{os.path.basename(path)}\n{f.read()}\n')
+            legacy_model.set_cache_repo(dict(repo_files=paths, list_content=list_content))
+            legacy_times.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            repo.mark([paths[target]])
+            if dict_repo := repo.context(counter=counter):
+                model.set_cache_repo(dict_repo)
+            times.append(time.perf_counter() - t0)
+    prefill = lambda m: dict(prefilled_tokens=m.prefilled, prefill_ms_per_edit=round(1000 * m.prefilled / edits / prefill_rate, 1))
+    return dict(files=n_files, edits=edits, prefill_rate=prefill_rate, legacy=dict(summarize_times(legacy_times), **prefill(legacy_model)),
+                incremental=dict(summarize_times(times), **prefill(model), **repo.stats()))
+
+def bench_rank(n_files=3000, queries=50, budget=REPO_TOKENS):
+    model = StubChat()
+    with tempfile.TemporaryDirectory(prefix='vimlm_bench_') as root:
+        paths = [os.path.join(root, f'mod_{i}.py') for i in range(n_files)]
+        for i, path in enumerate(paths):
+            with open(path, 'w') as f:
+                f.write(f'import mod_{(i * 7) % n_files}\n\n' + ''.join(f'def op_{i}_{j}(self, value):\n    return self.apply(value, {j})\n\n' for j in range(10)))
+        t0 = time.perf_counter()
+        repo = RepoContext('bench', paths, [os.path.basename(p) for p in paths])
+        t_index = time.perf_counter() - t0
+        counter = TokenCounter(model.get_ntok)
+        times, hits = [], 0
+        for k in range(queries):
+            target, imported = (k * 37) % n_files, (k * 53) % n_files
+            query = f'import mod_{imported}\n\nresult = op_{target}_3(self, value)\n'
+            t0 = time.perf_counter()
+            selected = repo.select(query, find_imports(query), 'current', budget, counter)
+            times.append(time.perf_counter() - t0)
+            hits += (paths[target] in selected) + (paths[imported] in selected)
+    return dict(files=n_files, budget=budget, index_ms=round(1000 * t_index, 1), select=summarize_times(times[1:]), recall=round(hits / (2 * queries), 3))
+
+def bench_search(n_files=2000, queries=50):
+    with sandbox() as tmp_dir:
+        root = os.path.join(tmp_dir, 'project')
+        for i in range(n_files):
+            os.makedirs(sub := os.path.join(root, f'pkg_{i // 100}'), exist_ok=True)
+            with open(os.path.join(sub, f'mod_{i}.py'), 'w') as f:
+                f.write(f'import os\n\nclass Handler{i}:\n    def handle_{i}(self, request):\n        return self.route_{i % 97}(request)\n\n' + ''.join(f'def helper_{i}_{j}(value):\n    return value + {j}\n\n' for j in range(8)))
+        t0 = time.perf_counter()
+        CODE_INDEX.update(root)
+        t_index = time.perf_counter() - t0
+        with open(os.path.join(root, 'pkg_0', 'mod_5.py'), 'a') as f:
+            f.write('\ndef added_helper(value):\n    return value\n')
+        t0 = time.perf_counter()
+        reindexed = CODE_INDEX.update(root)
+        t_update = time.perf_counter() - t0
+        times, hits = [], 0
+        for k in range(queries):
+            target = (k * 37) % n_files
+            t0 = time.perf_counter()
+            rows = CODE_INDEX.query(root, f'Where is handle_{target} defined and what does it route to?')
+            times.append(time.perf_counter() - t0)
+            hits += any(name == f'Handler{target}' or name == f'handle_{target}' for _, name, *_ in rows)
+    return dict(files=n_files, index_ms=round(1000 * t_index, 1), update_ms=round(1000 * t_update, 1), reindexed=reindexed, query=summarize_times(times), hit_rate=round(hits / queries, 3))
+
+def bench_engine(n_files=16, decode_rate=200, prefill_rate=4000):
+    reply = ' '.join(f'- point {i}' for i in range(40))
+    result = {}
+    for name, max_batch in [('serial', 1), ('batched', BATCH_SIZE)]:
+        model = StubChat(reply=reply, decode_rate=decode_rate, prefill_rate=prefill_rate)
+        with sandbox(model) as tmp_dir:
+            globals()['ENGINE'] = Engine(ChatBackend(model), max_batch=max_batch)
+            src = os.path.join(tmp_dir, 'project')
+            os.makedirs(src)
+            for i in range(n_files):
+                with open(os.path.join(src, f'mod_{i}.py'), 'w') as f:
+                    f.write(''.join(f'def op_{i}_{j}(value):\n    return value * {j}\n\n' for j in range(40)))
+            t0 = time.perf_counter()
+            ingest(src, max_len=500)
+            elapsed = time.perf_counter() - t0
+            result[name] = dict(s=round(elapsed, 2), sequences=ENGINE.sequences, batches=ENGINE.batches, seq_per_s=round(ENGINE.sequences / elapsed, 2))
+    return dict(files=n_files, decode_tok_per_s=decode_rate, speedup=round(result['serial']['s'] / result['batched']['s'], 2), **result)
+
+def bench_speculative(max_new=200, target_step=0.02, draft_step=0.004, noise=0.2, prompts=5):
+    with open(__file__, 'r', encoding='utf-8') as f:
+        corpus = f.read()
+    target, draft = TinyLM(corpus, step_cost=target_step), TinyLM(corpus, noise=noise, step_cost=draft_step)
+    starts = [corpus[i:i + 400] for i in range(0, len(corpus), len(corpus) // prompts)][:prompts]
+    t0, plain = time.perf_counter(), 0
+    for prompt in starts:
+        ids = target.encode(prompt)
+        for _ in range(max_new):
+            tok = target.verify(ids, [])[0]
+            if tok == target.eos:
+                break
+            ids.append(tok)
+            plain += 1
+    t_plain = time.perf_counter() - t0
+    before = dict(SPEC_STATS)
+    model = SpeculativeChat(target, draft)
+    t0 = time.perf_counter()
+    for prompt in starts:
+        model.reset()
+        model(prompt, max_new=max_new)
+    t_spec = time.perf_counter() - t0
+    stats = {k: SPEC_STATS[k] - before[k] for k in SPEC_STATS}
+    return dict(plain=dict(tok_per_s=round(plain / t_plain, 1), tokens=plain),
+                speculative=dict(tok_per_s=round(stats['generated'] / t_spec, 1), tokens=stats['generated'], acceptance=round(stats['accepted'] / stats['proposed'], 3), target_calls=stats['target_calls']),
+                speedup=round(stats['generated'] * t_plain / (plain * t_spec), 2))
+
+def bench_deploy(n_files=200, lines=50, chunk=16):
+    header = lambda i: f'**mod_{i}.py**\n' if i % 4 else f'Step {i}:\n'
+    response = ''.join(header(i) + '```python\n' + ''.join(f'value_{j} = {i} * {j}\n' for j in range(lines)) + '```\n\n' for i in range(n_files))
+    with sandbox(StubChat(reply='**step.py**')) as tmp_dir:
+        TAIL.write('', 'w')
+        t0 = time.perf_counter()
+        for i in range(0, len(response), chunk):
+            with open(OUT_PATH, 'a', encoding='utf-8') as f:
+                f.write(response[i:i + chunk])
+            TAIL.poll()
+        t_stream = time.perf_counter() - t0
+        chat('Write the files', max_new=8)
+        state = (list(chat.history), chat.context)
+        t0 = time.perf_counter()
+        written = deploy(os.path.join(tmp_dir, 'out'))
+        t_deploy = time.perf_counter() - t0
+        if (chat.history, chat.context) != state:
+            raise RuntimeError('deploy changed the chat state')
+        with open(os.path.join(WATCH_DIR, MODEL_FILE), 'r', encoding='utf-8') as f:
+            blocks = len(json.load(f)['blocks'])
+        report = [log['log'] for log in LOG_STORE.iter(key=['deploy']) if isinstance(log['log'], dict) and 'tokens_saved' in log['log']][-1]
+        if len(written) != blocks:
+            raise RuntimeError(f'deploy wrote {len(written)} files for {blocks} blocks')
+    return dict(response_kb=round(len(response) / 1024), chunks=-(-len(response) // chunk), blocks=blocks,
+                stream_us_per_chunk=round(1e6 * t_stream * chunk / len(response), 1), deploy_ms=round(1000 * t_deploy, 1), files=len(written),
+                renamed=report['renamed'], asked=report['asked'], tokens_used=report['tokens_used'], tokens_saved=report['tokens_saved'])
+
+def bench_conversation(turns=50, budget=HISTORY_TOKENS, decode_rate=4000, attn_rate=20e6):
+    reply = ' '.join(f'word{i}' for i in range(200))
+    result = {}
+    for name, conversation in [('unbounded', Conversation(10**9)), ('summary', Conversation(budget, 'summary')), ('drop', Conversation(budget, 'drop'))]:
+        model = StubChat(reply=reply, decode_rate=decode_rate, attn_rate=attn_rate)
+        with sandbox(model):
+            globals()['CONVERSATION'] = conversation
+            times, ntoks = [], []
+            for i in range(turns):
+                data = dict(context='', yank='', user=f'Turn {i}: ' + ' '.join(f'ask{j}' for j in range(60)), tree='bench.py')
+                if i:
+                    data['followup'] = True
+                t0 = time.perf_counter()
+                process_files(data)
+                times.append(time.perf_counter() - t0)
+                ntoks.append(conversation.ntok)
+            stats = conversation.stats()
+        result[name] = dict(peak_context=model.peak, final_ntok=ntoks[-1], peak_kv_mb=round(model.peak * model.kv_bytes_per_token / 2**20, 1),
+                            last10_ms=round(1000 * statistics.mean(times[-10:]), 1), total_s=round(sum(times), 2),
+                            compactions=stats['compactions'], summarized=stats['summarized'], dropped=stats['dropped'], summary_tokens=stats['summary_tokens'])
+    return dict(turns=turns, budget=budget, **result)
+
+def bench_trace(n=200):
+    result = {}
+    model = StubChat(reply=' '.join(f'word{i}' for i in range(100)))
+    with sandbox(model):
+        saved = TRACE
+        try:
+            for name, enabled in [('off', False), ('on', True), ('off_again', False)]:
+                globals()['TRACE'] = enabled
+                t0 = time.perf_counter()
+                for i in range(n):
+                    done_path = os.path.join(WATCH_DIR, f'done_{i}')
+                    SCHEDULER.submit(dict(id=i, context='\n'.join(f'line {j}' for j in range(200)), yank='line 10', user=f'Explain line {i} ({name})', tree='bench.py'))
+                    while not os.path.exists(done_path):
+                        time.sleep(0.0002)
+                    os.remove(done_path)
+                result[name] = round(1000 * (time.perf_counter() - t0) / n, 3)
+            span_ns = {}
+            for name, enabled in [('off', False), ('on', True)]:
+                globals()['TRACE'] = enabled
+                t0 = time.perf_counter()
+                for _ in range(100000):
+                    with span('bench'):
+                        pass
+                span_ns[name] = round(1e4 * (time.perf_counter() - t0))
+        finally:
+            globals()['TRACE'] = saved
+        METRICS_STORE.flush()
+        stages = {}
+        for entry in METRICS_STORE.iter(key=['metrics:']):
+            for stage, ms in entry['ms'].items():
+                stages.setdefault(stage, []).append(ms)
+    return dict(requests=n, ms_per_request=result, span_ns=span_ns,
+                p50_ms={stage: percentile(v, .5) for stage, v in stages.items()}, p99_ms={stage: percentile(v, .99) for stage, v in stages.items()})
+
+def bench_suite(chats=5, followups=5, keystrokes=20, typing_interval=0.03, n_files=24):
+    reply = "**app.py**\n```python\ndef main():\n    return 0\n```\n\n**util.py**\n```python\nVALUE = 1\n```\n"
+    context = '\n'.join(f'def handler_{i}(request):\n    return request.json()["field_{i}"]' for i in range(100))
+    def write(name, content):
+        with open(os.path.join(WATCH_DIR, name), 'w', encoding='utf-8') as f:
+            f.write(content)
+    def send(msg_id, user='', yank='', tree='/tmp/bench/app.py', **flags):
+        for flag, value in flags.items():
+            write(flag, '' if value is True else json.dumps(value))
+        write('id', str(msg_id))
+        for name, content in [('context', context), ('yank', yank), ('user', user), ('tree', tree)]:
+            write(name, content)
+    async def wait(msg_id):
+        done_path = os.path.join(WATCH_DIR, f'done_{msg_id}')
+        status = ''
+        while not status:
+            try:
+                with open(done_path, 'r', encoding='utf-8') as f:
+                    status = f.read()
+            except FileNotFoundError:
+                pass
+            if not status:
+                await asyncio.sleep(0.001)
+        os.remove(done_path)
+        return status
+    async def request(msg_id, **kwargs):
+        t0 = time.perf_counter()
+        send(msg_id, **kwargs)
+        status = await asyncio.wait_for(wait(msg_id), timeout=60)
+        if status != 'done':
+            raise RuntimeError(f'request {msg_id} ended with {status}')
+        return time.perf_counter() - t0
+    async def measure(tmp_dir):
+        task = asyncio.create_task(monitor_directory())
+        await asyncio.sleep(0.5)
+        ids, result = iter(range(1, 10**6)), {}
+        result['chat'] = summarize_times([await request(next(ids), user='Explain handler_10', yank='def handler_10(request):') for _ in range(chats)])
+        await request(next(ids), user='Refactor handler_20', yank='def handler_20(request):')
+        result['followup'] = summarize_times([await request(next(ids), user=f'Now add logging, variant {i}', followup=True) for i in range(followups)])
+        first, t_last = next(ids), None
+        for i in range(keystrokes):
+            t_last = time.perf_counter()
+            send(first + i, tree='/tmp/bench/app.py', fim=True)
+            await asyncio.sleep(typing_interval)
+        last = first + keystrokes - 1
+        status = await asyncio.wait_for(wait(last), timeout=60)
+        t_fim = time.perf_counter() - t_last
+        await asyncio.sleep(0.2)
+        statuses = Counter([status] + [await wait(i) for i in range(first, last) if os.path.exists(os.path.join(WATCH_DIR, f'done_{i}'))])
+        result['fim_burst'] = dict(keystrokes=keystrokes, last_ms=round(1000 * t_fim, 1), completed=statuses['done'], superseded=statuses['cancelled'], dropped=keystrokes - sum(statuses.values()))
+        if status != 'done' or result['fim_burst']['dropped']:
+            raise RuntimeError(f'FIM burst lost requests: {result["fim_burst"]}')
+        for _ in range(keystrokes):
+            next(ids)
+        src = os.path.join(tmp_dir, 'project')
+        os.makedirs(src)
+        for i in range(n_files):
+            with open(os.path.join(src, f'module_{i}.py'), 'w') as f:
+                f.write(''.join(f'def op_{i}_{j}(value):\n    return value * {j}\n\n' for j in range(60)))
+        result['include'] = dict(files=n_files, cold_ms=round(1000 * await request(next(ids), user=f'Summarize !include {src}'), 1),
+                                 warm_ms=round(1000 * await request(next(ids), user=f'Summarize !include {src}'), 1))
+        dest = os.path.join(tmp_dir, 'deployed')
+        t_deploy = await request(next(ids), user=f'Create the app !deploy {dest}')
+        result['deploy'] = dict(ms=round(1000 * t_deploy, 1), files=len(os.listdir(dest)) if os.path.isdir(dest) else 0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return result
+    with sandbox(StubChat(reply=reply, **STUB_MODEL)) as tmp_dir:
+        return dict(stub=STUB_MODEL, **asyncio.run(measure(tmp_dir)))
+
+def bench_stream(tokens=5000, progress=1000):
+    words = [f' token{i}' + ('\n' if i % 12 == 11 else '') for i in range(tokens)]
+    def legacy(s, mode):
+        with open(OUT_PATH, mode, encoding='utf-8') as f:
+            f.write(s)
+        tolog(s, key='tovim:' + mode)
+    result = {}
+    with sandbox():
+        TAIL.start()
+        TAIL.active.set()
+        try:
+            for name in ('legacy', 'buffered'):
+                toout('')
+                TAIL.flush()
+                flushes = TAIL.flushes
+                t0, text = time.perf_counter(), ''
+                for word in words:
+                    text += word
+                    if name == 'legacy':
+                        legacy(text, 'w')
+                    else:
+                        toout(word, mode='a')
+                TAIL.finish(text)
+                t_stream = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                for i in range(progress):
+                    if name == 'legacy':
+                        legacy(f'Ingesting: {i}/{progress} parts', 'w')
+                    else:
+                        toout(f'Ingesting: {i}/{progress} parts')
+                TAIL.flush()
+                t_progress = time.perf_counter() - t0
+                LOG_STORE.flush()
+                with open(OUT_PATH, 'r', encoding='utf-8') as f:
+                    if (text := f.read()) != f'Ingesting: {progress - 1}/{progress} parts':
+                        raise RuntimeError(f'progress output ended with {text!r}')
+                result[name] = dict(stream_ms=round(1000 * t_stream, 1), max_tok_per_s=round(tokens / t_stream), progress_us=round(1e6 * t_progress / progress, 1),
+                                    flushes=TAIL.flushes - flushes if name == 'buffered' else tokens + progress)
+        finally:
+            TAIL.active.clear()
+    return dict(tokens=tokens, response_kb=round(len(''.join(words)) / 1024), **result)
+
+def bench_sessions(clients=3, burst=6, decode_rate=100):
+    async def client(c, sid, n):
+        reader, writer = await asyncio.open_unix_connection(SOCK_PATH)
+        ids = {1000 * c + i + 1 for i in range(n)}
+        t0 = time.perf_counter()
+        for msg_id in sorted(ids):
+            request = dict(id=msg_id, context='', yank='', user=f'Explain step {msg_id}', tree=f'client{c}_{msg_id}.py', session=sid)
+            writer.write(json.dumps([msg_id, request]).encode('utf-8'))
+        await writer.drain()
+        decoder, buf, done, foreign, first = json.JSONDecoder(), '', set(), 0, None
+        while done != ids:
+            buf += (await reader.read(65536)).decode('utf-8')
+            while buf := buf.lstrip():
+                try:
+                    (_, msg), end = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    break
+                buf = buf[end:]
+                if msg.get('type') == 'done':
+                    if msg['id'] in ids:
+                        done.add(msg['id'])
+                        first = time.perf_counter() - t0 if first is None else first
+                    else:
+                        foreign += 1
+        writer.close()
+        return first, time.perf_counter() - t0, foreign
+    async def measure(shared):
+        sids = [None if shared else str(100000 + c) for c in range(clients)]
+        kb = []
+        for sid in filter(None, sids):
+            watch_dir = os.path.join(SESSIONS_DIR, sid)
+            os.makedirs(watch_dir)
+            write_atomic(os.path.join(watch_dir, SESSION_FILE), json.dumps(dict(pid=os.getpid(), cwd=os.getcwd())))
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            open_session(sid)
+            kb.append((tracemalloc.get_traced_memory()[0] - before) / 1024)
+            tracemalloc.stop()
+        tasks = [asyncio.create_task(monitor_sessions()), asyncio.create_task(serve_socket())]
+        await asyncio.sleep(0.3)
+        first = asyncio.create_task(client(0, sids[0], burst))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(client(c, sids[c], 1)) for c in range(1, clients)]
+        results = await asyncio.wait_for(asyncio.gather(first, *rest), timeout=60)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        waits = [r[0] for r in results[1:]]
+        return dict(burst_ms=round(1000 * results[0][1]), others_first_ms=round(1000 * max(waits)), foreign_msgs=sum(r[2] for r in results),
+                    **(dict(session_kb=round(max(kb), 1)) if kb else {}))
+    result = {}
+    for name, shared in (('shared', True), ('sessions', False)):
+        with sandbox(StubChat(decode_rate=decode_rate)):
+            result[name] = asyncio.run(measure(shared))
+    return dict(clients=clients, burst=burst, **result)
+
+def bench_preempt(fims=5, tokens=300, decode_rate=100, interval=0.2, budget=0.25):
+    reply = ' '.join(f'word{i}' for i in range(tokens))
+    result = {}
+    for name, split in (('shared', False), ('split', True)):
+        with sandbox(StubChat(reply=reply, decode_rate=decode_rate), StubChat(prefill_rate=50000) if split else None):
+            done = lambda i: os.path.join(WATCH_DIR, f'done_{i}')
+            t_chat = time.time()
+            SCHEDULER.submit(dict(id=0, context='', yank='', user='Explain everything', tree='bench.py'))
+            time.sleep(interval)
+            waits, streaming = [], 0
+            for i in range(1, fims + 1):
+                t0 = time.perf_counter()
+                SCHEDULER.submit(dict(id=i, fim=True, context='def f(x):\n    return', yank='', user='', tree='/tmp/bench/app.py'))
+                while not os.path.exists(done(i)):
+                    time.sleep(0.001)
+                waits.append(time.perf_counter() - t0)
+                streaming += not os.path.exists(done(0))
+                time.sleep(interval)
+            while not os.path.exists(done(0)):
+                time.sleep(0.001)
+            t_chat = os.path.getmtime(done(0)) - t_chat
+            with open(OUT_PATH, 'r', encoding='utf-8') as f:
+                text = f.read()
+        result[name] = dict(chat_s=round(t_chat, 2), fim=summarize_times(waits), during_chat=streaming)
+        if split and (max(waits) > budget or text != reply):
+            raise RuntimeError(f'FIM waited {max(waits):.2f}s behind a streaming chat' if max(waits) > budget else 'FIM output clobbered the streaming chat response')
+    return dict(tokens=tokens, decode_tok_per_s=decode_rate, budget_s=budget, **result)
+
+def bench_context(mb=20, budget=CONTEXT_TOKENS, n=5):
+    model = StubChat()
+    tmp_dir = tempfile.mkdtemp(prefix='vimlm_bench_')
+    path = os.path.join(tmp_dir, 'big.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        i = 0
+        while f.tell() < mb * 2**20:
+            f.write(f'def f{i}(x):\n    return x * {i} + len("spam and eggs")\n\n')
+            i += 1
+    with open(path, 'rb') as f:
+        head = f.read(os.path.getsize(path) // 2)
+    start = head.rfind(b'\n') + 1
+    line = head.count(b'\n', 0, start) + 1
+    ctx = dict(path=path, start=start, end=start + 40, line=line)
+    def legacy():
+        with open(path, 'r', encoding='utf-8') as f:
+            context = f.read().strip()
+        prompt = f'**big.py**\n```py\n{context}\n```\n\nExplain this'
+        return TokenCounter(model.get_ntok)(prompt)
+    def windowed(snapshot):
+        counter = TokenCounter(model.get_ntok)
+        context, lines = read_context(dict(ctx, snapshot=snapshot), budget, counter)
+        return counter(f'**big.py (lines {lines[0]}-{lines[1]})**\n```py\n{context.strip()}\n```\n\nExplain this')
+    result = dict(file_mb=round(os.path.getsize(path) / 2**20, 1), budget=budget)
+    try:
+        for name, step in (('legacy', legacy), ('file', lambda: windowed(False)), ('mmap', lambda: windowed(True))):
+            times = []
+            for _ in range(n):
+                t0 = time.perf_counter()
+                ntok = step()
+                times.append(time.perf_counter() - t0)
+            tracemalloc.start()
+            step()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result[name] = dict(ms=round(1000 * min(times), 2), peak_mb=round(peak / 2**20, 2), prompt_tokens=ntok)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
+
+def compare_bench(result, baseline, tolerance=BENCH_TOLERANCE, path=''):
+    regressions = []
+    for k, v in result.items():
+        old = baseline.get(k) if isinstance(baseline, dict) else None
+        name = f'{path}.{k}' if path else str(k)
+        if isinstance(v, dict):
+            regressions += compare_bench(v, old, tolerance, name)
+        elif isinstance(v, (int, float)) and isinstance(old, (int, float)) and not isinstance(v, bool) and old > 0:
+            if k.endswith('per_s') or k.endswith('_tps') or k in ('speedup', 'hit_rate', 'acceptance', 'recall', 'completed'):
+                worse = v < old * (1 - tolerance)
+            elif k.endswith('ms') or k == 's' or k.endswith('_s'):
+                worse = v > old * (1 + tolerance) and (v - old > 1.0 if k.endswith('ms') else True)
+            else:
+                continue
+            if worse:
+                regressions.append(f'{name}: {old} -> {v}')
+    return regressions
+
+BENCHES = dict(transport=bench_transport, split=bench_split, scan=bench_scan, startup=bench_startup, prefix=bench_prefix, fim=bench_fim, repo=bench_repo, rank=bench_rank, search=bench_search, engine=bench_engine, speculative=bench_speculative, deploy=bench_deploy, conversation=bench_conversation, trace=bench_trace, suite=bench_suite, stream=bench_stream, sessions=bench_sessions, preempt=bench_preempt, context=bench_context)
 
 def run():
     parser = argparse.ArgumentParser(description="VimLM - LLM-powered Vim assistant")
     parser.add_argument('--test', action='store_true', help="Run in test mode")
     parser.add_argument('args_vim', nargs='*', help="Vim arguments")
     parser.add_argument('--repo', nargs='*', help="Paths to directories or files (e.g., assets/*, path/to/file)")
+    parser.add_argument('--transport', choices=['file', 'socket'], help="How Vim talks to VimLM (default: TRANSPORT in cfg.json)")
+    parser.add_argument('--bench', nargs='*', metavar='NAME', help=f"Run benchmarks against a stub model ({', '.join(BENCHES)})")
+    parser.add_argument('--save-baseline', action='store_true', help=f"With --bench, store the results in {BENCH_PATH} to compare later runs against")
+    parser.add_argument('--backend', help="Model backend: mlx, stub, or package.module:factory (default: MODEL_BACKEND in cfg.json)")
+    parser.add_argument('--daemon', action='store_true', help="Run the shared model server that Vim sessions connect to")
+    parser.add_argument('--no-daemon', action='store_true', help="Load the models in this process instead of the shared daemon")
+    parser.add_argument('--log', nargs='*', metavar='KEY', help="Print the log, optionally only entries whose key contains KEY")
+    parser.add_argument('--stats', nargs='*', metavar='KIND', help="Print p50/p95/p99 per stage from the metrics file, optionally only for KIND (fim, chat, ingest)")
+    parser.add_argument('--since', help="Print log entries from this timestamp (e.g., 2025_02_28_09)")
+    parser.add_argument('--until', help="Print log entries up to this timestamp (e.g., 2025_02_28_17)")
     args = parser.parse_args()
-    dict_repo = get_repo(args.repo, args.args_vim)
-    tolog(dict_repo, 'debug:get_repo()')
+    LOG_STORE.migrate(os.path.join(VIMLM_DIR, LEGACY_LOG_FILE))
+    LTM_STORE.migrate(os.path.join(VIMLM_DIR, LEGACY_LTM_FILE))
+    if args.log is not None:
+        print_log(key=args.log or None, since=args.since, until=args.until)
+        return
+    if args.stats is not None:
+        print_stats(kinds=args.stats or None, since=args.since, until=args.until)
+        return
+    if args.transport:
+        globals()['TRANSPORT'] = args.transport
+    if args.backend:
+        globals()['MODEL_BACKEND'] = args.backend
+    if args.bench is not None:
+        try:
+            with open(BENCH_PATH, 'r') as f:
+                baseline = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            baseline = {}
+        regressions = []
+        for name in args.bench or BENCHES:
+            result = json.loads(json.dumps(BENCHES[name]()))
+            print(f'{name}: {json.dumps(result)}')
+            if args.save_baseline:
+                baseline[name] = result
+            elif name in baseline:
+                regressions += [f'{name}.{r}' for r in compare_bench(result, baseline[name])]
+        if args.save_baseline:
+            with open(BENCH_PATH, 'w') as f:
+                json.dump(baseline, f, indent=2)
+            print(f'Saved baseline to {BENCH_PATH}')
+        for r in regressions:
+            print(f'\033[31mREGRESSION {r}\033[0m')
+        if regressions:
+            sys.exit(1)
+        return
+    if args.daemon:
+        run_daemon()
+        return
+    spec = select_repo(args.repo, args.args_vim)
+    tolog(spec, 'debug:get_repo()')
     if args.test:
         return
-    reset_dir(WATCH_DIR)
-    toout('Loading LLM...')
-    if LLM_MODEL is None:
-        globals()['chat'] = nanollama.Chat(model_path='uncn_llama_32_3b_it')
-        toout(f'LLM is ready')
-    else:
-        globals()['chat'] = mlx_lm_utils.Chat(model_path=LLM_MODEL, think=THINK)
-        toout(f'{LLM_MODEL.split('/')[-1]} is ready')
-    if FIM_MODEL and FIM_MODEL != LLM_MODEL:
-        globals()['fim'] = mlx_lm_utils.Chat(model_path=FIM_MODEL, cache_dir=VIMLM_DIR, dict_repo=dict_repo)
-        toout(f'\n\n{FIM_MODEL.split("/")[-1]} is ready', mode='a')
-    else:
-        globals()['fim'] = chat
-        chat.set_cache_repo(dict_repo, cache_dir=VIMLM_DIR)
-    asyncio.run(main(args))
+    if DAEMON and not args.no_daemon:
+        watch_dir = new_session(spec)
+        try:
+            if ensure_daemon() and TRANSPORT == 'socket':
+                deadline = time.monotonic() + 5
+                while not os.path.exists(SOCK_PATH) and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            asyncio.run(main(args, session=os.path.basename(watch_dir)))
+        finally:
+            shutil.rmtree(watch_dir, ignore_errors=True)
+        return
+    prune_dirs(WATCH_DIR)
+    watch_dir = os.path.join(WATCH_DIR, str(os.getpid()))
+    reset_dir(watch_dir)
+    globals().update(WATCH_DIR=watch_dir, OUT_PATH=os.path.join(watch_dir, OUT_FILE), SOCK_PATH=os.path.join(watch_dir, SOCK_FILE))
+    globals()['REPO'], dict_repo = make_repo(spec)
+    start_models(dict_repo)
+    try:
+        asyncio.run(main(args))
+    finally:
+        shutil.rmtree(watch_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     run()